@@ -1,14 +1,39 @@
 import os
-import re
 import shutil
 from dotenv import load_dotenv
 import handlers.file_handler as filehandler
-import handlers.metadata_handler as metadatahandler
+import handlers.dedupe_handler as dedupehandler
+import handlers.pipeline_handler as pipelinehandler
+import handlers.cache_handler as cachehandler
+import handlers.audit_handler as audithandler
+import handlers.queue_handler as queuehandler
+import handlers.takeout_handler as takeouthandler
+import handlers.cluster_handler as clusterhandler
+import handlers.triage_handler as triagehandler
+import handlers.deadline_handler as deadlinehandler
 import handlers.llm_handler as llmhandler
+import handlers.log_handler as loghandler
 import time
 
 load_dotenv()
 
+
+def _get_int_env(name, default):
+    """Reads a positive int from the environment, falling back to default."""
+    try:
+        value = int(os.getenv(name, default))
+        return value if value > 0 else default
+    except ValueError:
+        return default
+
+
+def _is_cross_device(path_a, path_b):
+    try:
+        return os.stat(path_a).st_dev != os.stat(path_b).st_dev
+    except OSError:
+        return False
+
+
 def main():
     start_time = time.time()
 
@@ -24,7 +49,7 @@ def main():
 
     music_folder_raw = os.getenv("MUSIC_PATH") # This is the folder with the unorganized files
     if not music_folder_raw:
-        print("Error: MUSIC_PATH environment variable is not set (folder with unorganized files). Please set it and try again.")
+        loghandler.error("run", "MUSIC_PATH environment variable is not set (folder with unorganized files). Please set it and try again.")
         return
     
     test_run_file_limit = 0
@@ -37,9 +62,9 @@ def main():
     if not os.path.isdir(organized_music_root):
         try:
             os.makedirs(organized_music_root, exist_ok=True)
-            print(f"Created ORGANIZED_MUSIC_ROOT directory: {organized_music_root}")
+            loghandler.info("run", "Created ORGANIZED_MUSIC_ROOT directory: %s", organized_music_root)
         except Exception as e:
-            print(f"Error: ORGANIZED_MUSIC_ROOT ('{organized_music_root}') does not exist and could not be created: {e}")
+            loghandler.error("run", "ORGANIZED_MUSIC_ROOT ('%s') does not exist and could not be created: %s", organized_music_root, e)
             return
 
 
@@ -49,176 +74,306 @@ def main():
     allow_apostrophe_in_filename_str = os.getenv("ALLOW_APOSTROPHE_FILENAME", "false").lower()
     allow_apostrophe_in_filename = allow_apostrophe_in_filename_str == "true" or allow_apostrophe_in_filename_str == "1"
 
+    dedupe_enabled_str = os.getenv("DEDUPE_ENABLED", "true").lower()
+    dedupe_enabled = dedupe_enabled_str == "true" or dedupe_enabled_str == "1"
+
+    duplicate_policy = os.getenv("DUPLICATE_POLICY", "skip").lower()
+    if duplicate_policy not in dedupehandler.DUPLICATE_POLICIES:
+        loghandler.warning("run", "Unknown DUPLICATE_POLICY '%s'. Falling back to 'skip'.", duplicate_policy)
+        duplicate_policy = "skip"
+
+    organize_mode = os.getenv("ORGANIZE_MODE", "move").lower()
+    if organize_mode not in filehandler.ORGANIZE_MODES:
+        loghandler.warning("run", "Unknown ORGANIZE_MODE '%s'. Falling back to 'move'.", organize_mode)
+        organize_mode = "move"
+
+    tag_write_timing = os.getenv("TAG_WRITE_TIMING", "after_move").lower()
+    if tag_write_timing not in ("after_move", "before_move"):
+        loghandler.warning("run", "Unknown TAG_WRITE_TIMING '%s'. Falling back to 'after_move'.", tag_write_timing)
+        tag_write_timing = "after_move"
+
+    cache_db_path = os.getenv("CACHE_DB_PATH", os.path.join(organized_music_root, ".music_cache.sqlite3"))
+
+    # Not defaulted to MUSIC_PATH: that is usually the organized library too, with this tool's own CSVs in it
+    takeout_metadata_path = os.getenv("TAKEOUT_METADATA_PATH")
+
+    triage_enabled_str = os.getenv("TRIAGE_ENABLED", "true").lower()
+    triage_enabled = triage_enabled_str == "true" or triage_enabled_str == "1"
+    triage_action = os.getenv("TRIAGE_ACTION", "quarantine").lower()
+    if triage_action not in triagehandler.TRIAGE_ACTIONS:
+        loghandler.warning("run", "Unknown TRIAGE_ACTION '%s'. Falling back to 'quarantine'.", triage_action)
+        triage_action = "quarantine"
+
+    cluster_enabled_str = os.getenv("CLUSTER_ENABLED", "true").lower()
+    cluster_enabled = cluster_enabled_str == "true" or cluster_enabled_str == "1"
+    try:
+        cluster_similarity = float(os.getenv("CLUSTER_SIMILARITY", str(clusterhandler.DEFAULT_SIMILARITY)))
+    except ValueError:
+        cluster_similarity = clusterhandler.DEFAULT_SIMILARITY
+
+    # Per-file time budget (0 = none) and the retry queue deferred files are written to
+    try:
+        file_time_budget = max(0.0, float(os.getenv("FILE_TIME_BUDGET_SECONDS", "300")))
+    except ValueError:
+        file_time_budget = 300.0
+    retry_queue_only_str = os.getenv("RETRY_QUEUE_ONLY", "false").lower()
+    retry_queue_only = retry_queue_only_str == "true" or retry_queue_only_str == "1"
+
+    # Distributed mode: several hosts share a work queue (and catalog) on shared storage
+    work_queue_path = os.getenv("WORK_QUEUE_PATH")
+    node_count = _get_int_env("NODE_COUNT", 1)
+    try:
+        node_index = int(os.getenv("NODE_INDEX", "0"))
+    except ValueError:
+        node_index = 0
+    if not 0 <= node_index < node_count:
+        loghandler.error("run", "NODE_INDEX (%d) must be between 0 and NODE_COUNT - 1 (%d).", node_index, node_count - 1)
+        return
+
+    audit_mode_str = os.getenv("AUDIT_MODE", "false").lower()
+    audit_mode = audit_mode_str == "true" or audit_mode_str == "1"
+    try:
+        audit_sample_percent = min(100.0, max(0.0, float(os.getenv("AUDIT_SAMPLE_PERCENT", "100"))))
+    except ValueError:
+        audit_sample_percent = 100.0
 
     # API Keys from environment (ensure these are set if functionality is used)
     ACOUSTID_API_KEY = os.getenv("ACOUSTID_API_KEY")
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") # Example
 
-    print(f"--- Song Normalizer ---")
-    print(f"Unorganized Music Folder: {music_folder_raw}")
-    print(f"Organized Music Root: {organized_music_root}")
-    print(f"Dry Run: {dry_run}")
-    print(f"Allow Apostrophe in Filenames: {allow_apostrophe_in_filename}")
+    loghandler.info("run", "--- Song Normalizer ---")
+    loghandler.info("run", "Unorganized Music Folder: %s", music_folder_raw)
+    loghandler.info("run", "Organized Music Root: %s", organized_music_root)
+    loghandler.info("run", "Dry Run: %s", dry_run)
+    loghandler.info("run", "Allow Apostrophe in Filenames: %s", allow_apostrophe_in_filename)
+    loghandler.info("run", "Organize Mode: %s", organize_mode)
+    loghandler.info("run", "Dedupe Identical Audio: %s (Duplicate Policy: %s)", dedupe_enabled, duplicate_policy)
+    loghandler.info("run", "Cache Database: %s", cache_db_path)
+    cachehandler.open_cache(cache_db_path)
+    if work_queue_path:
+        loghandler.info("run", "Work Queue: %s (node %d of %d)", work_queue_path, node_index + 1, node_count)
+
+    if audit_mode:
+        loghandler.info("audit", "--- Audit mode: checking organized files in '%s' for mismatches ---", organized_music_root)
+        audithandler.run_audit(
+            organized_music_root,
+            sample_percent=audit_sample_percent,
+            workers=_get_int_env("AUDIT_WORKERS", os.cpu_count() or 1),
+            report_path=os.getenv("AUDIT_REPORT_PATH"),
+            use_fingerprint=bool(ACOUSTID_API_KEY)
+        )
+        elapsed_minutes, elapsed_seconds = divmod(time.time() - start_time, 60)
+        loghandler.info("audit", "--- Audit complete in %d and %.2f seconds. ---", int(elapsed_minutes), elapsed_seconds)
+        cachehandler.close_cache()
+        loghandler.close()
+        return
+
     if dry_run:
-        print(f"Test File Limit (for dry run): {test_run_file_limit}")
+        loghandler.info("run", "Test File Limit (for dry run): %d", test_run_file_limit)
 
 
     all_found_audio_files = filehandler.find_audio_files(music_folder_raw)
-    print(f"Found {len(all_found_audio_files)} audio files in '{music_folder_raw}' (top level only).")
+    loghandler.info("scan", "Found %d audio files in '%s' (top level only).", len(all_found_audio_files), music_folder_raw)
+
+    # Files deferred by earlier runs go first (the work queue keeps its own deferred files in distributed mode)
+    retry_list_path = None
+    retry_paths = set()
+    if not work_queue_path:
+        retry_list_path = os.getenv("RETRY_QUEUE_PATH") or os.path.join(organized_music_root, "retry_queue.csv")
+        retry_paths = set(deadlinehandler.load_retry_queue(retry_list_path))
+        if retry_paths or retry_queue_only:
+            retried_files = [f for f in all_found_audio_files if f in retry_paths]
+            other_files = [] if retry_queue_only else [f for f in all_found_audio_files if f not in retry_paths]
+            all_found_audio_files = retried_files + other_files
+            loghandler.info("retry", "%d file(s) from the retry queue '%s' go first.%s", len(retried_files), retry_list_path,
+                            " Nothing else is processed (RETRY_QUEUE_ONLY)." if retry_queue_only else "")
 
     audio_files_to_process = all_found_audio_files[:test_run_file_limit] if test_run_file_limit > 0 else all_found_audio_files
     if dry_run:
-        print(f"DRY RUN active: Nothing will be moved or renamed.")
+        loghandler.info("run", "DRY RUN active: Nothing will be moved or renamed.")
     
     if len(all_found_audio_files) > test_run_file_limit:
-        print(f"Processing only the first {len(audio_files_to_process)} files for this test run.")
+        loghandler.info("run", "Processing only the first %d files for this test run.", len(audio_files_to_process))
     else:
-        print(f"Processing {len(audio_files_to_process)} files.")
-
-    processed_count = 0
-    for filepath in audio_files_to_process:
-        processed_count += 1
-        print(f"\n--- Processing file {processed_count}/{len(audio_files_to_process)}: {os.path.basename(filepath)} ---")
-
-        print("  Running direct fpcalc test...")
-        fpcalc_test_passed = metadatahandler.test_fpcalc_with_json_output(filepath) # Call the test function
-        
-        existing_meta = filehandler.get_existing_metadata(filepath)
-        print(f"  [Local Tags] Raw: {existing_meta}")
-
-        identified_meta = None
-        source_of_meta = "None"
-
-        # Priority 1: Use existing tags if they are complete enough (artist, title, album)
-        if existing_meta.get('artist') and existing_meta.get('title') and existing_meta.get('album'):
-            print(f"  [Decision] Sufficient metadata found in local tags. Prioritizing.")
-            identified_meta = existing_meta.copy() # Use a copy
-            identified_meta['source_comment'] = "Local Tags" # Add source comment
-            source_of_meta = "Local Tags"
-        else:
-            print(f"  [Decision] Local tags insufficient (Artist: {existing_meta.get('artist')}, Title: {existing_meta.get('title')}, Album: {existing_meta.get('album')}).")
-
-        # Priority 2: If local tags were insufficient, try AcoustID if fpcalc test passed
-        if not identified_meta and fpcalc_test_passed:
-            print(f"  Attempting AcoustID fingerprinting...")
-            if not ACOUSTID_API_KEY:
-                print("    ACOUSTID_API_KEY not set. Skipping AcoustID.")
-            else:
-                fingerprint_meta = metadatahandler.identify_song_fingerprint(filepath)
-                if fingerprint_meta and fingerprint_meta.get('artist') and fingerprint_meta.get('title') and fingerprint_meta.get('album'):
-                    identified_meta = fingerprint_meta
-                    source_of_meta = "AcoustID/MusicBrainz"
-                    print(f"    [AcoustID Result]: Artist: {identified_meta.get('artist')}, Title: {identified_meta.get('title')}, Album: {identified_meta.get('album')}")
-                else:
-                    print(f"    [AcoustID] Failed to get sufficient info (Artist, Title, Album) via fingerprinting. Result: {fingerprint_meta}")
-        
-        # Priority 3: If still no meta, try LLM (and verify with MusicBrainz)
-        if not identified_meta:
-            print(f"  Attempting LLM query on filename...")
-            if not OPENAI_API_KEY: # Check for OpenAI key specifically if using OpenAI
-                print("    OPENAI_API_KEY not set. Skipping LLM.")
-            else:
-                filename_no_ext = os.path.splitext(os.path.basename(filepath))[0]
-                cleaned_for_llm = llmhandler.clean_filename_for_llm(filename_no_ext)
-                if cleaned_for_llm:
-                    llm_guess = llmhandler.query_llm_for_song_details(cleaned_for_llm)
-                    if llm_guess and llm_guess.get('artist') and llm_guess.get('title'): # Album is desirable but not strictly required from LLM
-                        print(f"    [LLM Suggestion]: {llm_guess}")
-                        # Verify LLM guess with MusicBrainz
-                        verified_llm_meta = metadatahandler.get_musicbrainz_details(
-                            llm_guess['artist'],
-                            llm_guess['title'],
-                            llm_guess.get('album') 
-                        )
-                        if verified_llm_meta and verified_llm_meta.get('artist') and verified_llm_meta.get('title') and verified_llm_meta.get('album'):
-                            identified_meta = verified_llm_meta
-                            # Augment with LLM's track number if MB didn't provide one
-                            if not identified_meta.get('tracknumber') and llm_guess.get('original_prefix_number'):
-                                identified_meta['tracknumber'] = str(llm_guess['original_prefix_number']).zfill(2)
-                            source_of_meta = "LLM via MusicBrainz"
-                            print(f"    [LLM Verified by MusicBrainz]: Artist: {identified_meta.get('artist')}, Title: {identified_meta.get('title')}, Album: {identified_meta.get('album')}")
-                        else:
-                            print(f"    [LLM] Suggestion could not be reliably verified by MusicBrainz to get (Artist, Title, Album). Verified: {verified_llm_meta}")
-                    else:
-                        print(f"    [LLM] Could not provide a useful suggestion (Artist, Title) or failed.")
-                else:
-                    print(f"    [LLM] Filename too generic or empty after cleaning for LLM query.")
-
-        # --- Post-identification processing ---
-        if identified_meta and identified_meta.get('artist') and identified_meta.get('title') and identified_meta.get('album'):
-            print(f"  [Final Meta Choice] Using data from: {source_of_meta}")
-            
-            # Ensure tracknumber is reasonable if present
-            if 'tracknumber' in identified_meta and identified_meta['tracknumber']:
-                try:
-                    # Attempt to make it an int and zfill, handles cases like "1" -> "01"
-                    identified_meta['tracknumber'] = str(int(str(identified_meta['tracknumber']))).zfill(2)
-                except ValueError:
-                    print(f"    Warning: Invalid track number '{identified_meta['tracknumber']}'. Clearing it.")
-                    identified_meta['tracknumber'] = None # Or ""
-            
-            # If track number is still missing, try to extract from original filename as a last resort
-            if not identified_meta.get('tracknumber'):
-                original_filename_no_ext = os.path.splitext(os.path.basename(filepath))[0]
-                match = re.match(r"^\s*(\d+)\s*[-._ ]+\s*(.*)", original_filename_no_ext)
-                if match:
-                    potential_track_num = match.group(1).zfill(2)
-                    identified_meta['tracknumber'] = potential_track_num
-                    print(f"    Extracted track number '{potential_track_num}' from original filename as fallback.")
-
-            print(f"  [Proposed Metadata For Action]: {identified_meta}")
-
-            new_filepath_after_move = filehandler.rename_and_move_track(
-                filepath, 
-                identified_meta, 
-                organized_music_root, 
+        loghandler.info("run", "Processing %d files.", len(audio_files_to_process))
+
+    # Distributed mode: this node enqueues only its own shard; the others enqueue theirs
+    if work_queue_path and node_count > 1:
+        audio_files_to_process = [f for f in audio_files_to_process
+                                  if queuehandler.shard_of(queuehandler.queue_key(f, music_folder_raw), node_count) == node_index]
+        loghandler.info("queue", "%d files are in this node's shard.", len(audio_files_to_process))
+
+    # Pre-pass: only one copy of byte-identical audio goes through identification
+    duplicate_groups = {}
+    if dedupe_enabled and len(audio_files_to_process) > 1:
+        loghandler.info("dedupe", "--- Dedupe pre-pass: checking for identical audio ---")
+        duplicate_groups = dedupehandler.find_duplicate_groups(audio_files_to_process)
+        duplicate_paths = {dup for dups in duplicate_groups.values() for dup in dups}
+        if duplicate_paths:
+            audio_files_to_process = [f for f in audio_files_to_process if f not in duplicate_paths]
+            loghandler.info("dedupe", "%d duplicate(s) will reuse their representative's result. %d files left to identify.", len(duplicate_paths), len(audio_files_to_process))
+
+    # Worker counts for each stage
+    tag_workers = _get_int_env("TAG_WORKERS", 8)
+    fingerprint_workers = _get_int_env("FINGERPRINT_WORKERS", os.cpu_count() or 1)
+    llm_batch_size = _get_int_env("LLM_BATCH_SIZE", 20)
+    llm_workers = _get_int_env("LLM_WORKERS", 4)
+    try:
+        local_parse_min_confidence = float(os.getenv("LOCAL_PARSE_MIN_CONFIDENCE", "0.8"))
+    except ValueError:
+        local_parse_min_confidence = 0.8
+
+    pipeline_mode = os.getenv("PIPELINE_MODE", "staged").lower()
+    if pipeline_mode not in ("stream", "staged"):
+        loghandler.warning("run", "Unknown PIPELINE_MODE '%s'. Falling back to 'staged'.", pipeline_mode)
+        pipeline_mode = "staged"
+    # Files per staged pass and per clustering window. In distributed mode this is also about how many files a
+    # node claims ahead of its workers, so it is kept small there to leave work for the other nodes.
+    pipeline_window = _get_int_env("PIPELINE_WINDOW", 200 if work_queue_path else clusterhandler.DEFAULT_WINDOW)
+
+    fingerprint_enabled = True
+    if not ACOUSTID_API_KEY:
+        loghandler.warning("fingerprint", "Fingerprinting skipped: ACOUSTID_API_KEY not set.")
+        fingerprint_enabled = False
+    elif shutil.which('fpcalc') is None:
+        loghandler.warning("fingerprint", "Fingerprinting skipped: 'fpcalc' command not found in PATH. Install chromaprint-tools.")
+        fingerprint_enabled = False
+
+    # Across filesystems every move is a full copy, so run those on a pool of copier threads.
+    apply_workers = 1
+    if not dry_run and _is_cross_device(music_folder_raw, organized_music_root):
+        apply_workers = _get_int_env("COPY_WORKERS", 4)
+        loghandler.info("run", "'%s' is on a different filesystem than '%s'. Using %d copier threads.", organized_music_root, music_folder_raw, apply_workers)
+
+    stage_counts = {}
+    def settle_stage(records, label):
+        # staged mode: the stage finishes a window of pipeline_window files before the next one starts on them, and reports on it
+        if pipeline_mode != "staged":
+            return records
+        def report(window):
+            counts = stage_counts.setdefault(label, [0, 0])
+            counts[0] += sum(1 for record in window if record.resolved)
+            counts[1] += len(window)
+            loghandler.info(label.lower(), "%d of %d files settled so far.", counts[0], counts[1])
+        return pipelinehandler.window_stage(records, pipeline_window, report)
+
+    # scan -> triage -> tags -> takeout -> cluster -> fingerprint -> lookup -> expand -> plan -> apply. Each stage is a generator over TrackRecords.
+    loghandler.info("run", "--- Processing %d files (pipeline mode: %s, %d files per pass) ---", len(audio_files_to_process), pipeline_mode, pipeline_window)
+    known_artists = pipelinehandler.build_known_artists(organized_music_root)
+    takeout_index = takeouthandler.TakeoutIndex()
+    if takeout_metadata_path and os.path.isdir(takeout_metadata_path):
+        # this tool's own CSVs (retry queue, quarantine list, audit report) are not Takeout exports
+        own_outputs = [
+            os.getenv("RETRY_QUEUE_PATH") or os.path.join(organized_music_root, "retry_queue.csv"),
+            os.getenv("QUARANTINE_LIST_PATH") or os.path.join(organized_music_root, "quarantine.csv"),
+            os.getenv("AUDIT_REPORT_PATH") or os.path.join(organized_music_root, "audit_report.csv"),
+        ]
+        takeout_index.load(takeout_metadata_path, skip_dirs=[organized_music_root], skip_files=own_outputs)
+        loghandler.info("takeout", "Indexed %d tracks from Takeout metadata in '%s'.", len(takeout_index), takeout_metadata_path)
+    work_queue = None
+    if work_queue_path and dry_run:
+        loghandler.info("queue", "Dry run: previewing this node's shard only. The work queue is not touched.")
+    elif work_queue_path:
+        work_queue = queuehandler.WorkQueue(
+            work_queue_path,
+            node_index=node_index,
+            node_count=node_count,
+            node_id=os.getenv("NODE_ID"),
+            lease_seconds=_get_int_env("WORK_LEASE_SECONDS", queuehandler.DEFAULT_LEASE_SECONDS),
+            max_attempts=_get_int_env("WORK_MAX_ATTEMPTS", queuehandler.DEFAULT_MAX_ATTEMPTS),
+            library_root=music_folder_raw # queue items are keyed relative to it, so nodes may mount the library anywhere
+        )
+        pending_count = work_queue.enqueue(audio_files_to_process, duplicate_groups)
+        loghandler.info("queue", "Enqueued this node's shard. %d files pending across all nodes.", pending_count)
+        cachehandler.merge_cache(work_queue_path) # start with what the other nodes already looked up
+        work_queue.start_heartbeat()
+        def handle_shared_duplicates(duplicate_paths, owner_path, owner_result):
+            # same audio as an item another node (or an earlier run) identified: apply the duplicate policy with its result
+            owner_result = owner_result or {}
+            dedupehandler.handle_duplicates(
+                duplicate_paths,
+                owner_path,
+                owner_result if pipelinehandler.is_complete(owner_result) else None,
+                owner_result.get('new_filepath'),
+                organized_music_root,
+                policy=duplicate_policy,
                 dry_run=dry_run,
                 allow_apostrophe_in_filename=allow_apostrophe_in_filename
             )
+        records = queuehandler.claim_stage(work_queue, _get_int_env("WORK_CLAIM_BATCH", 10), on_duplicates=handle_shared_duplicates)
+    else:
+        records = pipelinehandler.scan_stage(audio_files_to_process, duplicate_groups)
+    if triage_enabled:
+        records = pipelinehandler.triage_stage(records, workers=tag_workers)
+    records = settle_stage(pipelinehandler.tag_stage(records, workers=tag_workers, known_artists=known_artists), "Tags")
+    if len(takeout_index):
+        records = settle_stage(takeouthandler.takeout_stage(records, takeout_index), "Takeout")
+    if cluster_enabled:
+        records = clusterhandler.cluster_stage(records, similarity=cluster_similarity, window=pipeline_window)
+    if fingerprint_enabled:
+        records = settle_stage(pipelinehandler.fingerprint_stage(records, workers=fingerprint_workers, file_budget=file_time_budget), "Fingerprint")
+    records = settle_stage(pipelinehandler.lookup_stage(
+        records,
+        batch_size=llm_batch_size,
+        workers=llm_workers,
+        known_artists=known_artists,
+        min_local_confidence=local_parse_min_confidence,
+        llm_enabled=bool(OPENAI_API_KEY), # Check for OpenAI key specifically if using OpenAI
+        file_budget=file_time_budget
+    ), "Lookup")
+    if cluster_enabled:
+        records = settle_stage(clusterhandler.expand_stage(records), "Cluster")
+    records = pipelinehandler.plan_stage(records)
+    records = pipelinehandler.apply_stage(
+        records,
+        organized_music_root,
+        dry_run=dry_run,
+        allow_apostrophe_in_filename=allow_apostrophe_in_filename,
+        organize_mode=organize_mode,
+        duplicate_policy=duplicate_policy,
+        workers=apply_workers,
+        tag_write_timing=tag_write_timing,
+        triage_action=triage_action,
+        quarantine_list_path=os.getenv("QUARANTINE_LIST_PATH"),
+        retry_list_path=retry_list_path
+    )
+    if work_queue:
+        records = queuehandler.complete_stage(work_queue, records, on_duplicates=handle_shared_duplicates)
 
-            if new_filepath_after_move and (dry_run or os.path.exists(new_filepath_after_move)):
-                filehandler.update_tags(new_filepath_after_move, identified_meta, dry_run=dry_run)
-            elif not new_filepath_after_move and not dry_run:
-                print(f"  Skipping tag update for {os.path.basename(filepath)} as its primary organization failed or it was moved to 'reviewed'.")
-            # Optional: A warning if dry_run is false, new_filepath_after_move is set, but the file isn't there.
-            elif new_filepath_after_move and not dry_run and not os.path.exists(new_filepath_after_move):
-                print(f"  [Tag Update Warning] Proposed new path {new_filepath_after_move} does not exist. Skipping tag update.")
-
-        else: # This 'else' corresponds to: if NOT (identified_meta and artist and title and album)
-            print(f"  [Failure] Could not obtain sufficient metadata (Artist, Title, Album) for {os.path.basename(filepath)} from any source.")
-            if identified_meta: print(f"    Partially identified meta was: {identified_meta}")
-            
-            # If all identification fails, move to 'reviewed' folder if not dry_run
-            if not dry_run:
-                reviewed_dir_fallback = os.path.join(organized_music_root, "reviewed")
-                try:
-                    os.makedirs(reviewed_dir_fallback, exist_ok=True)
-                    original_filename = os.path.basename(filepath)
-                    reviewed_filepath_fallback = os.path.join(reviewed_dir_fallback, original_filename)
-
-                    counter = 1
-                    original_reviewed_filepath_fb = reviewed_filepath_fallback
-                    while os.path.exists(reviewed_filepath_fallback): # Avoid overwriting
-                        name, ext = os.path.splitext(original_filename)
-                        reviewed_filepath_fallback = os.path.join(reviewed_dir_fallback, f"{name}_{counter}{ext}")
-                        counter += 1
-                    if original_reviewed_filepath_fb != reviewed_filepath_fallback:
-                         print(f"    WARNING: File '{os.path.basename(original_reviewed_filepath_fb)}' already in reviewed. Renaming to '{os.path.basename(reviewed_filepath_fallback)}'.")
-                    
-                    shutil.move(filepath, reviewed_filepath_fallback)
-                    print(f"    MOVED TO REVIEWED: '{original_filename}' moved to '{reviewed_filepath_fallback}' due to failure in all metadata identification stages.")
-                except Exception as e_review_ident_fail:
-                    print(f"    ERROR moving '{os.path.basename(filepath)}' to reviewed folder after all identification failed: {e_review_ident_fail}")
-            else: # dry_run is True
-                print(f"    Dry run: Would move '{os.path.basename(filepath)}' to 'reviewed' folder due to failure in all metadata identification stages.")
-
+    # Pull everything through; only counters (and which queued retries got done) are kept
+    settled_count = deferred_count = unresolved_count = rejected_count = 0
+    finished_retries = set()
+    for record in records:
+        if retry_paths and not (record.deferred and not record.resolved):
+            # the pre-pass' duplicates of a file never come through here; they are done when it is
+            finished_retries.update(path for path in [record.filepath] + (record.duplicates or []) if path in retry_paths)
+        if record.rejected:
+            rejected_count += 1
+        elif record.resolved:
+            settled_count += 1
+        elif record.deferred:
+            deferred_count += 1
+        else:
+            unresolved_count += 1
+    loghandler.info("summary", "%d identified, %d unresolved, %d deferred (a service was unavailable or the time budget ran out), %d rejected as broken.",
+                    settled_count, unresolved_count, deferred_count, rejected_count,
+                    identified=settled_count, unresolved=unresolved_count, deferred=deferred_count, rejected=rejected_count)
+    llmhandler.log_usage_summary()
+    if retry_list_path and not dry_run:
+        deadlinehandler.prune_retry_queue(retry_list_path, finished_retries) # files deferred by this run were added as they went
+    if work_queue:
+        cachehandler.merge_cache(work_queue_path) # leave this node's lookups for the others
+        loghandler.info("queue", "Queue status across all nodes: %s", work_queue.status_counts())
+        work_queue.close()
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     minutes, seconds = divmod(elapsed_time, 60)
 
-    print(f"\n--- Processing complete for {len(audio_files_to_process)} files in {int(minutes)} and {seconds:.2f} seconds. ---")
-    # ... (final summary print statements) ...
+    loghandler.info("run", "--- Processing complete for %d files in %d and %.2f seconds. ---", len(audio_files_to_process), int(minutes), seconds,
+                    duration=elapsed_time)
+    cachehandler.close_cache()
+    loghandler.close()
 
 if __name__ == "__main__":
     # Ensure environment variables for API keys and paths are set before running.
@@ -230,6 +385,52 @@ if __name__ == "__main__":
     # export DRY_RUN="true" # or "false"
     # export TEST_FILE_COUNT="5"
     # export ALLOW_APOSTROPHE_FILENAME="true" # or "false"
+    # export DEDUPE_ENABLED="true" # or "false"
+    # export DUPLICATE_POLICY="skip" # or "move" (to <ORGANIZED_MUSIC_ROOT>/duplicates) or "hardlink"
+    # export PIPELINE_MODE="staged" # cheapest-first passes: tags for a window of files, then their fingerprints, then their lookups (prints per-stage counts); or "stream": each file flows straight through
+    # export PIPELINE_WINDOW="10000" # files per staged pass and per clustering window; bounds memory (and in distributed mode, defaults to 200 so a node doesn't claim everyone's work)
+    # export CLUSTER_ENABLED="true" # look up only one file per group of similar names ("Song (1)", "song_", "01 Song")
+    # export CLUSTER_SIMILARITY="0.8" # how alike two names must be to share a lookup (0-1)
+    # export TRIAGE_ENABLED="true" # check MPEG frame headers first; broken files never reach fpcalc
+    # export TRIAGE_ACTION="quarantine" # or "reviewed": also move broken files to <ORGANIZED_MUSIC_ROOT>/reviewed
+    # export QUARANTINE_LIST_PATH="/path/to/quarantine.csv" # defaults to <ORGANIZED_MUSIC_ROOT>/quarantine.csv
+    # export FILE_TIME_BUDGET_SECONDS="300" # per-file budget for fingerprint + lookups; files over it are deferred (0 = no budget)
+    # export HEDGED_LOOKUPS="true" # send a second AcoustID/MusicBrainz request when the first is slower than the usual p95
+    # export RETRY_QUEUE_PATH="/path/to/retry_queue.csv" # deferred files, processed first next run; defaults to <ORGANIZED_MUSIC_ROOT>/retry_queue.csv
+    # export RETRY_QUEUE_ONLY="false" # "true": process only the files in the retry queue
+    # export LOG_LEVEL="info" # or "debug" (per-file detail, raw LLM responses), "warning", "error"
+    # export LOG_FORMAT="text" # or "json": console output as JSON lines
+    # export LOG_FILE="/path/to/run.jsonl" # also write every event as a JSON line (file id, stage, outcome, duration)
+    # export LLM_MODEL="gpt-4.1-mini"
+    # export LLM_OUTPUT_MODE="json_schema" # or "text" for models without structured output (JSON is then recovered from the reply)
+    # export TAG_WORKERS="8" # tag and triage stages
+    # export TAKEOUT_METADATA_PATH="/path/to/Takeout" # Google Takeout CSV/JSON metadata; not read unless set
+    # export FINGERPRINT_WORKERS="4" # fingerprint stage (fpcalc + AcoustID), defaults to the CPU count
+    # export LLM_BATCH_SIZE="20" # lookup stage, filenames per LLM request
+    # export LLM_WORKERS="4" # lookup stage, concurrent LLM requests
+    # export LOCAL_PARSE_MIN_CONFIDENCE="0.8" # lookup stage, filenames parsed locally at or above this skip the LLM
+    # export OPENAI_REQUESTS_PER_MINUTE="500" # match your OpenAI account tier
+    # export SERVICE_MAX_RETRIES="4" # retries for 429/5xx/timeouts (AcoustID, MusicBrainz, OpenAI)
+    # export SERVICE_BREAKER_FAILURES="5" # consecutive failures before a service is paused
+    # export SERVICE_BREAKER_RESET_SECONDS="60" # how long a paused service is left alone
+    # export ORGANIZE_MODE="move" # or "hardlink" / "reflink" (btrfs/XFS): link into the organized tree, originals stay
+    # export COPY_WORKERS="4" # parallel copies when ORGANIZED_MUSIC_ROOT is on another filesystem
+    # export VERIFY_COPIES="true" # compare each cross-filesystem copy with its source before deleting the source
+    # export TAG_WRITE_TIMING="after_move" # or "before_move": write tags at the original path, then move (not with reflinks)
+    # export TAG_PADDING="keep" # or "mutagen": keep = never shrink ID3 padding, so tag edits don't rewrite the audio
+    # export TAG_PADDING_BYTES="8192" # padding given to a tag that outgrew its space
+    # export CACHE_DB_PATH="/path/to/organized_music_library/.music_cache.sqlite3" # fingerprint / AcoustID cache
+    # export WORK_QUEUE_PATH="/mnt/shared/music_queue.sqlite3" # distributed mode: shared work queue + catalog on shared storage
+    # export NODE_COUNT="3" # distributed mode, number of hosts
+    # export NODE_INDEX="0" # distributed mode, this host's shard (0 .. NODE_COUNT - 1)
+    # export NODE_ID="host-a" # distributed mode, lease owner name, defaults to <hostname>-<pid>
+    # export WORK_LEASE_SECONDS="900" # distributed mode, a claimed file goes back to the queue if its node stops renewing for this long
+    # export WORK_MAX_ATTEMPTS="3" # distributed mode, a file whose lease expires this many times is marked failed, not claimed again
+    # export WORK_CLAIM_BATCH="10" # distributed mode, files claimed per queue transaction
+    # export AUDIT_MODE="true" # check ORGANIZED_MUSIC_ROOT for mismatches instead of organizing MUSIC_PATH
+    # export AUDIT_SAMPLE_PERCENT="5" # audit at most this share of the library per run
+    # export AUDIT_WORKERS="4"
+    # export AUDIT_REPORT_PATH="/path/to/audit_report.csv" # defaults to <ORGANIZED_MUSIC_ROOT>/audit_report.csv
     # export MB_APP_NAME="MyCoolMusicSorter"
     # export MB_APP_VERSION="1.0"
     # export MB_APP_CONTACT="me@example.com"
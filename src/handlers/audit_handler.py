@@ -0,0 +1,168 @@
+import os
+import re
+import csv
+import math
+import shutil
+import hashlib
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
+
+import handlers.file_handler as filehandler
+import handlers.metadata_handler as metadatahandler
+import handlers.cache_handler as cachehandler
+import handlers.traffic_handler as traffichandler
+import handlers.log_handler as loghandler
+
+# Folders under ORGANIZED_MUSIC_ROOT that are not part of the organized Artist/Album tree
+SKIPPED_FOLDERS = ("reviewed", "duplicates")
+# Below this similarity two names are treated as different
+MATCH_THRESHOLD = 0.8
+
+REPORT_COLUMNS = ["confidence", "source", "filepath", "fields", "tag_artist", "tag_title", "tag_album",
+                  "path_artist", "path_album", "path_title", "fingerprint_artist", "fingerprint_title",
+                  "fingerprint_album", "acoustid_score"]
+
+
+def find_organized_files(organized_music_root):
+    """Walks the organized Artist/Album tree and returns every .mp3 in it."""
+    audio_files = []
+    for root, dirs, files in os.walk(organized_music_root):
+        if root == organized_music_root:
+            dirs[:] = [d for d in dirs if d not in SKIPPED_FOLDERS and not d.startswith('.')]
+        for file in files:
+            if file.lower().endswith('.mp3'):
+                audio_files.append(os.path.join(root, file))
+    return audio_files
+
+
+def identity_from_path(filepath, organized_music_root):
+    """Reads (artist, album, title) back out of <root>/<Artist>/<Album>/<NN - Title>.mp3."""
+    parts = os.path.relpath(filepath, organized_music_root).split(os.sep)
+    if len(parts) != 3:
+        return None, None, None
+    title = os.path.splitext(parts[2])[0]
+    title = re.sub(r"^\s*\d+\s*-\s*", "", title) # drop the "NN - " track number prefix
+    return parts[0], parts[1], title
+
+
+def _normalize(value):
+    return re.sub(r"[\W_]+", " ", str(value or "")).casefold().strip()
+
+
+def similarity(a, b):
+    a, b = _normalize(a), _normalize(b)
+    if not a or not b:
+        return 1.0 # nothing to compare against is not evidence of a mismatch
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def select_audit_candidates(filepaths, sample_percent=100.0):
+    """
+    Keeps only files that changed (size/mtime) since their last audit or were never audited,
+    then trims them to the nightly budget: sample_percent of the whole library.
+    Never-audited files come first; the rest are spread by path hash so consecutive runs cover different folders.
+    """
+    changed = []
+    for filepath in filepaths:
+        state = cachehandler.get_audit_state(filepath)
+        if state is None:
+            changed.append((0, filepath))
+            continue
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            continue
+        if (st.st_size, st.st_mtime_ns) != (state[0], state[1]):
+            changed.append((1, filepath))
+
+    changed.sort(key=lambda item: (item[0], hashlib.blake2b(item[1].encode('utf-8', 'replace'), digest_size=8).digest()))
+    budget = len(changed)
+    if sample_percent < 100:
+        budget = min(budget, math.ceil(len(filepaths) * sample_percent / 100.0))
+    return [filepath for _, filepath in changed[:budget]]
+
+
+def audit_file(filepath, organized_music_root, use_fingerprint=True):
+    """
+    Compares a file's tags with its place in the tree and with its fingerprint identity.
+    Fingerprints and AcoustID answers come from the cache when the file has not changed.
+    Returns (report_rows, completed); report_rows is empty when nothing looks wrong and completed is False
+    if a service outage cut the audit short (so the file is audited again next run).
+    """
+    tags = filehandler.get_existing_metadata(filepath)
+    path_artist, path_album, path_title = identity_from_path(filepath, organized_music_root)
+    rows = []
+
+    base_row = {
+        "filepath": filepath,
+        "tag_artist": tags.get('artist'), "tag_title": tags.get('title'), "tag_album": tags.get('album'),
+        "path_artist": path_artist, "path_album": path_album, "path_title": path_title,
+    }
+
+    # Tags vs path (no network needed). Compare sanitized forms, since the path was built with sanitize_filename.
+    path_fields = []
+    if path_artist and tags.get('artist') and similarity(filehandler.sanitize_filename(filehandler.format_artist_for_directory(tags['artist'])), path_artist) < MATCH_THRESHOLD:
+        path_fields.append("artist")
+    if path_album and tags.get('album') and similarity(filehandler.sanitize_filename(tags['album']), path_album) < MATCH_THRESHOLD:
+        path_fields.append("album")
+    if path_title and tags.get('title') and similarity(filehandler.sanitize_filename(tags['title'], allow_apostrophe_in_filename=True), path_title) < MATCH_THRESHOLD:
+        path_fields.append("title")
+    if path_fields:
+        worst = min(similarity(tags.get(f), {"artist": path_artist, "album": path_album, "title": path_title}[f]) for f in path_fields)
+        rows.append(dict(base_row, source="tags vs path", fields=",".join(path_fields), confidence=round(0.5 * (1 - worst), 3)))
+
+    # Tags vs fingerprint identity
+    if use_fingerprint:
+        try:
+            fingerprint_meta = metadatahandler.identify_song_fingerprint(filepath)
+        except traffichandler.ServiceUnavailableError as e:
+            loghandler.warning("audit", "AcoustID unavailable: %s", e, file=filepath, outcome="deferred")
+            return rows, False
+        if fingerprint_meta:
+            score = float(fingerprint_meta.get('acoustid_score') or 0.5)
+            fp_fields = [f for f in ("artist", "title") if similarity(tags.get(f), fingerprint_meta.get(f)) < MATCH_THRESHOLD]
+            if fp_fields:
+                worst = min(similarity(tags.get(f), fingerprint_meta.get(f)) for f in fp_fields)
+                rows.append(dict(base_row, source="tags vs fingerprint", fields=",".join(fp_fields),
+                                 confidence=round(score * (1 - worst), 3),
+                                 fingerprint_artist=fingerprint_meta.get('artist'),
+                                 fingerprint_title=fingerprint_meta.get('title'),
+                                 fingerprint_album=fingerprint_meta.get('album'),
+                                 acoustid_score=score))
+    return rows, True
+
+
+def run_audit(organized_music_root, sample_percent=100.0, workers=4, report_path=None, use_fingerprint=True):
+    """
+    Audit mode: walks ORGANIZED_MUSIC_ROOT in parallel and writes a CSV mismatch report ranked by confidence.
+    Only files changed since their last audit are looked at, limited to sample_percent of the library per run.
+    """
+    all_files = find_organized_files(organized_music_root)
+    candidates = select_audit_candidates(all_files, sample_percent)
+    loghandler.info("audit", "%d organized files. Auditing %d (changed since last audit, budget %g%%).", len(all_files), len(candidates), sample_percent)
+    if use_fingerprint and not shutil.which('fpcalc'):
+        loghandler.warning("audit", "'fpcalc' not found. Only comparing tags with paths.")
+        use_fingerprint = False
+
+    def audit_one(filepath):
+        rows, completed = audit_file(filepath, organized_music_root, use_fingerprint)
+        if completed:
+            cachehandler.record_audit(filepath)
+        return rows
+
+    report_rows = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for rows in executor.map(audit_one, candidates):
+            report_rows.extend(rows)
+    report_rows.sort(key=lambda row: row["confidence"], reverse=True)
+
+    report_path = report_path or os.path.join(organized_music_root, "audit_report.csv")
+    try:
+        with open(report_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(report_rows)
+        loghandler.info("audit", "%d possible mismatch(es) written to '%s'.", len(report_rows), report_path)
+    except OSError as e:
+        loghandler.error("audit", "Could not write report '%s': %s", report_path, e)
+    return report_rows
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import handlers.log_handler as loghandler
+
+# Negative AcoustID answers (no match / low score) are re-asked after this long, since the AcoustID database keeps growing
+NEGATIVE_RESULT_TTL_SECONDS = 7 * 24 * 3600
+
+_connection = None
+_lock = threading.Lock()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    duration INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS payload_fingerprints (
+    payload_hash TEXT PRIMARY KEY,
+    duration INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS acoustid_results (
+    fingerprint_hash TEXT PRIMARY KEY,
+    result_json TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS audits (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    audited_at REAL NOT NULL
+);
+"""
+
+# What merge_cache() shares: only content-keyed tables. Paths are host-local (another node may mount the
+# library elsewhere), so fingerprints go through the shared catalog keyed by their audio payload hash.
+_SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared.payload_fingerprints (
+    payload_hash TEXT PRIMARY KEY,
+    duration INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shared.acoustid_results (
+    fingerprint_hash TEXT PRIMARY KEY,
+    result_json TEXT,
+    fetched_at REAL NOT NULL
+);
+"""
+
+
+def open_cache(db_path):
+    """
+    Opens (or creates) the SQLite cache shared by the pipeline and the audit mode.
+    All other functions are no-ops until this has been called.
+    """
+    global _connection
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        connection = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        connection.commit()
+    except sqlite3.Error as e:
+        loghandler.warning("cache", "Could not open cache database '%s': %s. Continuing without a cache.", db_path, e)
+        return False
+    with _lock:
+        _connection = connection
+    return True
+
+
+def close_cache():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+
+def _file_stat(filepath):
+    try:
+        st = os.stat(filepath)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return None, None
+
+
+def _fingerprint_hash(fingerprint):
+    return hashlib.blake2b(fingerprint.encode('ascii', 'replace'), digest_size=16).hexdigest()
+
+
+def _execute(sql, params=(), fetch=False):
+    with _lock:
+        if _connection is None:
+            return None
+        try:
+            cursor = _connection.execute(sql, params)
+            rows = cursor.fetchall() if fetch else None
+            _connection.commit()
+            return rows
+        except sqlite3.Error as e:
+            loghandler.error("cache", "Database error: %s", e)
+            return None
+
+
+def get_cached_fingerprint(filepath):
+    """Returns (duration, fingerprint) if the file has not changed since it was fingerprinted, else (None, None)."""
+    size, mtime_ns = _file_stat(filepath)
+    if size is None:
+        return None, None
+    rows = _execute("SELECT size, mtime_ns, duration, fingerprint FROM fingerprints WHERE path = ?", (filepath,), fetch=True)
+    if rows and rows[0][0] == size and rows[0][1] == mtime_ns:
+        return rows[0][2], rows[0][3]
+    return None, None
+
+
+def get_fingerprint_for_payload(payload_hash):
+    """Returns (duration, fingerprint) of any file with this audio payload (see dedupe_handler.payload_hash), else (None, None)."""
+    rows = _execute("SELECT duration, fingerprint FROM payload_fingerprints WHERE payload_hash = ?", (payload_hash,), fetch=True)
+    return tuple(rows[0]) if rows else (None, None)
+
+
+def store_fingerprint(filepath, duration, fingerprint, payload_hash=None):
+    """Caches the fingerprint by path (until the file changes) and, if payload_hash is given, by content."""
+    size, mtime_ns = _file_stat(filepath)
+    if size is None:
+        return
+    _execute("INSERT OR REPLACE INTO fingerprints (path, size, mtime_ns, duration, fingerprint) VALUES (?, ?, ?, ?, ?)",
+             (filepath, size, mtime_ns, int(duration), fingerprint))
+    if payload_hash:
+        _execute("INSERT OR REPLACE INTO payload_fingerprints (payload_hash, duration, fingerprint) VALUES (?, ?, ?)",
+                 (payload_hash, int(duration), fingerprint))
+
+
+def move_fingerprint(old_filepath, new_filepath):
+    """
+    Keeps a fingerprint attached to a file after it is moved/renamed/re-tagged.
+    Tag writes don't change the audio, so the fingerprint is still valid; only the path and stat are refreshed.
+    """
+    size, mtime_ns = _file_stat(new_filepath)
+    if size is None:
+        return
+    _execute("UPDATE OR REPLACE fingerprints SET path = ?, size = ?, mtime_ns = ? WHERE path = ?",
+             (new_filepath, size, mtime_ns, old_filepath))
+
+
+def get_cached_acoustid(fingerprint):
+    """
+    Returns (found, result). result is the identify_song_fingerprint() dict, or None for a cached "no match".
+    """
+    rows = _execute("SELECT result_json, fetched_at FROM acoustid_results WHERE fingerprint_hash = ?",
+                    (_fingerprint_hash(fingerprint),), fetch=True)
+    if not rows:
+        return False, None
+    result_json, fetched_at = rows[0]
+    result = json.loads(result_json) if result_json else None
+    if result is None and time.time() - fetched_at > NEGATIVE_RESULT_TTL_SECONDS:
+        return False, None
+    return True, result
+
+
+def store_acoustid(fingerprint, result):
+    _execute("INSERT OR REPLACE INTO acoustid_results (fingerprint_hash, result_json, fetched_at) VALUES (?, ?, ?)",
+             (_fingerprint_hash(fingerprint), json.dumps(result) if result else None, time.time()))
+
+
+def merge_cache(shared_db_path):
+    """
+    Two-way merge of fingerprints and AcoustID answers with a shared database (the distributed mode's catalog),
+    so each node starts with what the others already looked up and leaves its own lookups behind.
+    Only content-keyed rows are shared: fingerprints by audio payload hash (the same audio always has the
+    same fingerprint, so either side's row will do), AcoustID answers by fingerprint hash, where the most
+    recently fetched answer wins in both directions. The path-keyed tables stay local.
+    """
+    with _lock:
+        if _connection is None:
+            return False
+        try:
+            _connection.execute("ATTACH DATABASE ? AS shared", (shared_db_path,))
+        except sqlite3.Error as e:
+            loghandler.error("cache", "Could not open shared database '%s': %s", shared_db_path, e)
+            return False
+        try:
+            _connection.executescript(_SHARED_SCHEMA)
+            _connection.execute("INSERT OR IGNORE INTO main.payload_fingerprints SELECT * FROM shared.payload_fingerprints")
+            _connection.execute("INSERT OR IGNORE INTO shared.payload_fingerprints SELECT * FROM main.payload_fingerprints")
+            for target, source in (("main", "shared"), ("shared", "main")):
+                _connection.execute(
+                    f"INSERT INTO {target}.acoustid_results SELECT * FROM {source}.acoustid_results WHERE true "
+                    "ON CONFLICT(fingerprint_hash) DO UPDATE SET result_json = excluded.result_json, fetched_at = excluded.fetched_at "
+                    "WHERE excluded.fetched_at > fetched_at"
+                )
+            _connection.commit()
+            return True
+        except sqlite3.Error as e:
+            _connection.rollback()
+            loghandler.error("cache", "Could not merge with shared database '%s': %s", shared_db_path, e)
+            return False
+        finally:
+            _connection.execute("DETACH DATABASE shared")
+
+
+def get_audit_state(filepath):
+    """Returns (size, mtime_ns, audited_at) from the last audit of the file, or None if it was never audited."""
+    rows = _execute("SELECT size, mtime_ns, audited_at FROM audits WHERE path = ?", (filepath,), fetch=True)
+    return tuple(rows[0]) if rows else None
+
+
+def record_audit(filepath):
+    size, mtime_ns = _file_stat(filepath)
+    if size is None:
+        return
+    _execute("INSERT OR REPLACE INTO audits (path, size, mtime_ns, audited_at) VALUES (?, ?, ?, ?)",
+             (filepath, size, mtime_ns, time.time()))
@@ -0,0 +1,161 @@
+import os
+import re
+from collections import Counter
+
+import handlers.file_handler as filehandler
+import handlers.llm_handler as llmhandler
+import handlers.log_handler as loghandler
+
+# Takeout dumps hold many variants of the same mangled name ("Song (1).mp3", "Song(2).mp3", "song_.mp3",
+# "01 Song.mp3"). The cluster stage groups the unresolved files by name, only the representative of each
+# group goes through fingerprinting and lookup, and the expand stage hands its answer to the other members.
+# Files are clustered in bounded windows, so the stage never waits for the whole library.
+
+# Minimum trigram Jaccard similarity for two names to be merged
+DEFAULT_SIMILARITY = 0.8
+# Trigrams shared by more names than this are too common to block on (e.g. " th", "the")
+MAX_BLOCK_SIZE = 500
+# Members of a cluster must be within this many seconds of each other
+DURATION_TOLERANCE_SECONDS = 3.0
+# Records per clustering window (see cluster_stage)
+DEFAULT_WINDOW = 10000
+
+
+def cluster_key(filename_no_ext):
+    """Normalized name for clustering: no copy suffix, track number prefix, case or punctuation."""
+    name = llmhandler.normalize_filename_for_parsing(filename_no_ext)
+    name = llmhandler.clean_filename_for_llm(name)
+    name = filehandler.sanitize_filename(name)
+    return re.sub(r"[\W_]+", " ", name).casefold().strip()
+
+
+def trigrams(key):
+    padded = f" {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def cluster_names(keys, similarity=DEFAULT_SIMILARITY):
+    """
+    Groups similar keys. Identical keys are merged directly; the distinct ones are compared only with
+    names that share a trigram (an inverted trigram index), never all pairs. Names whose numbers differ
+    ("Symphony 5" / "Symphony 6") are never merged.
+    Returns a list of clusters, each a list of indexes into keys.
+    """
+    distinct_keys = list(dict.fromkeys(keys))
+    key_index = {key: i for i, key in enumerate(distinct_keys)}
+    grams = [trigrams(key) for key in distinct_keys]
+    numbers = [re.findall(r"\d+", key) for key in distinct_keys]
+
+    postings = {}
+    for i, key_grams in enumerate(grams):
+        for gram in key_grams:
+            postings.setdefault(gram, []).append(i)
+
+    union_find = UnionFind(len(distinct_keys))
+    for i, key_grams in enumerate(grams):
+        shared = Counter()
+        for gram in key_grams:
+            block = postings[gram]
+            if len(block) <= MAX_BLOCK_SIZE:
+                shared.update(j for j in block if j > i)
+        for j, count in shared.items():
+            if numbers[i] == numbers[j] and count / (len(key_grams) + len(grams[j]) - count) >= similarity:
+                union_find.union(i, j)
+
+    clusters = {}
+    for i, key in enumerate(keys):
+        clusters.setdefault(union_find.find(key_index[key]), []).append(i)
+    return list(clusters.values())
+
+
+def split_by_duration(records):
+    """
+    Splits a name cluster into groups whose lengths (read from the MP3 headers) agree.
+    Files whose length can't be read can't be checked, so they are left on their own.
+    """
+    timed, groups = [], []
+    for record in records:
+        duration = filehandler.get_audio_duration(record.filepath)
+        if duration is None:
+            groups.append([record])
+        else:
+            timed.append((duration, record))
+    timed.sort(key=lambda item: item[0])
+    group_start = None
+    for duration, record in timed:
+        if group_start is None or duration - group_start > DURATION_TOLERANCE_SECONDS:
+            groups.append([])
+            group_start = duration
+        groups[-1].append(record)
+    return groups
+
+
+def _cluster_window(unresolved, similarity):
+    """Clusters one window of unresolved records and yields a representative per cluster (see cluster_stage)."""
+    keys = [cluster_key(os.path.splitext(os.path.basename(record.filepath))[0]) for record in unresolved]
+    cluster_count = variant_count = 0
+    for cluster in cluster_names(keys, similarity):
+        members = [unresolved[i] for i in cluster]
+        for group in (split_by_duration(members) if len(members) > 1 else [members]):
+            group.sort(key=lambda record: len(os.path.basename(record.filepath)), reverse=True)
+            representative = group[0]
+            if len(group) > 1:
+                representative.variants = group[1:]
+                variant_count += len(group) - 1
+                loghandler.info("cluster", "%d variant(s) will reuse its result: %s", len(group) - 1,
+                                ", ".join(os.path.basename(record.filepath) for record in group[1:]), file=representative.filepath)
+            cluster_count += 1
+            yield representative
+    loghandler.info("cluster", "%d unresolved files in %d cluster(s). %d lookup(s) saved.", len(unresolved), cluster_count, variant_count)
+
+
+def cluster_stage(records, similarity=DEFAULT_SIMILARITY, window=DEFAULT_WINDOW):
+    """
+    Pipeline stage: settled (and rejected) records pass straight through; the unresolved ones are held until
+    window records have come through (or the input is exhausted), clustered, and yielded one representative
+    per cluster, with the other members in record.variants. The representative is the member with the
+    longest name (the most to look up from). Only variants within the same window are found, which keeps
+    the stage from holding (or, in distributed mode, claiming) the whole library before any lookup starts.
+    """
+    unresolved = []
+    seen_count = 0
+    for record in records:
+        seen_count += 1
+        if record.needs_lookup:
+            unresolved.append(record)
+        else:
+            yield record
+        if seen_count >= window:
+            yield from _cluster_window(unresolved, similarity)
+            unresolved, seen_count = [], 0
+    if unresolved:
+        yield from _cluster_window(unresolved, similarity)
+
+
+def expand_stage(records):
+    """Pipeline stage (after lookup): hands each representative's answer to its variants and yields them after it."""
+    for record in records:
+        variants, record.variants = record.variants or [], None
+        for variant in variants:
+            if record.resolved:
+                variant.settle(record.metadata(), f"Filename Cluster ({record.source})")
+            elif record.deferred:
+                variant.deferred = record.deferred
+        yield record
+        yield from variants
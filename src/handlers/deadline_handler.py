@@ -0,0 +1,236 @@
+import os
+import csv
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import handlers.traffic_handler as traffichandler
+import handlers.file_handler as filehandler
+import handlers.log_handler as loghandler
+
+# Per-file time budget. A file gets a Deadline when it reaches its first network stage (fingerprint or
+# lookup), paused while the file waits between staged passes; every call made for it after that is bounded
+# by what is left of it: fpcalc and the AcoustID/OpenAI clients get it as their timeout, and call() stops
+# waiting when it runs out. A file whose budget is used up is deferred (like one whose service is unavailable)
+# and written to the retry queue for a later run, instead of holding a worker.
+# Lookups that take longer than their service's usual p95 get one hedged (duplicate) request; whichever
+# answers first wins. LLM calls are bounded by the deadline but not hedged, since a duplicate costs tokens.
+
+# Upper bounds for a single request, with or without a deadline
+REQUEST_TIMEOUTS = {"fpcalc": 30.0, "acoustid": 20.0, "musicbrainz": 20.0, "openai": 60.0}
+MIN_TIMEOUT_SECONDS = 1.0
+
+LATENCY_WINDOW = 200     # recent successful calls per service that the p95 is taken from
+HEDGE_MIN_SAMPLES = 20   # no hedging until a service has this many samples
+HEDGE_THREADS = 32
+SEND_POLL_SECONDS = 0.05 # how often call() checks whether its request has been sent, to start the hedge clock
+
+# TrackRecord.deferred reasons
+DEFERRED_UNAVAILABLE = "service_unavailable"
+DEFERRED_DEADLINE = "deadline"
+
+HEDGING_ENABLED = os.getenv("HEDGED_LOOKUPS", "true").lower() in ("true", "1")
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix="hedge")
+
+
+class DeadlineExceeded(traffichandler.ServiceUnavailableError):
+    """The file's time budget ran out. A ServiceUnavailableError, so every handler already passes it up and the file is deferred."""
+
+
+class Deadline:
+    """
+    The budget only runs while the file is being worked on: pause() stops the clock while it waits for other
+    files (e.g. at a staged pass barrier, see pipeline_handler.window_stage) and resume() restarts it.
+    """
+    __slots__ = ('budget', 'expires_at', 'paused_at')
+
+    def __init__(self, budget_seconds):
+        self.budget = budget_seconds
+        self.expires_at = time.monotonic() + budget_seconds
+        self.paused_at = None
+
+    def remaining(self):
+        now = self.paused_at if self.paused_at is not None else time.monotonic()
+        return max(0.0, self.expires_at - now)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0.0
+
+    def pause(self):
+        if self.paused_at is None:
+            self.paused_at = time.monotonic()
+
+    def resume(self):
+        if self.paused_at is not None:
+            self.expires_at += time.monotonic() - self.paused_at
+            self.paused_at = None
+
+    def check(self, what):
+        if self.expired:
+            raise DeadlineExceeded(f"time budget of {self.budget:g}s used up before {what}")
+
+
+def timeout_for(deadline, service_name):
+    """Timeout for one request to service_name: its REQUEST_TIMEOUTS cap, or less if the deadline is closer."""
+    cap = REQUEST_TIMEOUTS[service_name]
+    if deadline is None:
+        return cap
+    return max(MIN_TIMEOUT_SECONDS, min(cap, deadline.remaining()))
+
+
+def defer_reason(exc):
+    return DEFERRED_DEADLINE if isinstance(exc, DeadlineExceeded) else DEFERRED_UNAVAILABLE
+
+
+class LatencyTracker:
+    """Rolling window of a service's successful call latencies."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def p95(self):
+        """None until there are HEDGE_MIN_SAMPLES samples."""
+        with self.lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def timed(self, fn):
+        """Wraps fn so each successful call is added to the window (rate limiter waits and retries not included)."""
+        def timed_call(*args, **kwargs):
+            start = time.monotonic()
+            result = fn(*args, **kwargs)
+            self.add(time.monotonic() - start)
+            return result
+        return timed_call
+
+
+def get_tracker(service_name):
+    with _trackers_lock:
+        if service_name not in _trackers:
+            _trackers[service_name] = LatencyTracker()
+        return _trackers[service_name]
+
+
+def call(service_name, fn, *args, deadline=None, hedge=True, **kwargs):
+    """
+    traffic_handler.call(service_name, fn, *args, **kwargs), bounded by deadline, with one hedged request
+    if the first one has been out for longer than the service's p95 latency (hedge=False for calls too costly to send twice).
+    The hedge clock starts when the request is actually sent, not while it waits for the rate limiter or a
+    concurrency slot, and no hedge is sent while the service is at its concurrency limit.
+    Raises DeadlineExceeded when the deadline passes first. Once there is an answer, a request still waiting
+    for its slot or token is cancelled; one already sent runs on in the background until its own timeout
+    and its answer is dropped.
+    """
+    tracker = get_tracker(service_name)
+    timed_fn = tracker.timed(fn)
+    hedge_after = tracker.p95() if hedge and HEDGING_ENABLED else None
+    if deadline is None and hedge_after is None:
+        return traffichandler.call(service_name, timed_fn, *args, **kwargs)
+    if deadline is not None:
+        deadline.check(f"the {service_name} request")
+
+    sent_at = [] # when the first request went out
+    def send_first(*fn_args, **fn_kwargs):
+        if not sent_at:
+            sent_at.append(time.monotonic())
+        return timed_fn(*fn_args, **fn_kwargs)
+
+    cancel_event = threading.Event()
+    pending = {_executor.submit(traffichandler.call, service_name, send_first, *args, cancel_event=cancel_event, **kwargs)}
+    try:
+        while True:
+            wait_for = deadline.remaining() if deadline is not None else None
+            if hedge_after is not None:
+                # until the first request is sent, check back every SEND_POLL_SECONDS for when it was
+                until_hedge = max(0.0, sent_at[0] + hedge_after - time.monotonic()) if sent_at else SEND_POLL_SECONDS
+                wait_for = until_hedge if wait_for is None else min(wait_for, until_hedge)
+            done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            # the primary and the hedge can finish in the same wait(); any success wins over a failure
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            if done and not pending:
+                raise next(iter(done)).exception()
+            if done:
+                continue # the other request may still answer
+
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(f"time budget of {deadline.budget:g}s used up waiting for {service_name}")
+            if hedge_after is not None and sent_at and time.monotonic() >= sent_at[0] + hedge_after:
+                if traffichandler.get_controller(service_name).is_saturated():
+                    loghandler.debug("hedge", "%s request slower than its p95 (%.2fs), but the service is at its concurrency limit. Not hedging.",
+                                     service_name, hedge_after, service=service_name, outcome="not_hedged")
+                else:
+                    loghandler.debug("hedge", "%s request slower than its p95 (%.2fs). Sending a hedged request.", service_name, hedge_after,
+                                     service=service_name, outcome="hedged")
+                    pending.add(_executor.submit(traffichandler.call, service_name, timed_fn, *args, cancel_event=cancel_event, **kwargs))
+                hedge_after = None
+    finally:
+        cancel_event.set()
+        for future in pending:
+            future.cancel() # not started yet
+
+
+def record_retry(list_path, filepath, reason):
+    """Appends a deferred file to the retry queue (CSV: path, reason)."""
+    try:
+        filehandler.append_csv_row(list_path, ["path", "reason"], [filepath, reason])
+    except OSError as e:
+        loghandler.error("retry", "Could not write retry queue '%s': %s", list_path, e)
+
+
+def load_retry_queue(list_path):
+    """Paths in the retry queue that still exist, oldest first, without repeats."""
+    try:
+        with open(list_path, newline='', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+    except FileNotFoundError:
+        return []
+    except (OSError, csv.Error) as e:
+        loghandler.error("retry", "Could not read retry queue '%s': %s", list_path, e)
+        return []
+    return [path for path in dict.fromkeys(row.get("path") for row in rows) if path and os.path.exists(path)]
+
+
+def prune_retry_queue(list_path, finished_paths):
+    """
+    Rewrites the retry queue at the end of a run without the files this run finished (settled, sent to 'reviewed'
+    or rejected) and the ones that no longer exist; a file deferred again keeps its latest reason. Until this
+    runs, the queue still holds every earlier entry, so a crashed or interrupted run loses none of them.
+    """
+    with filehandler.csv_list_lock:
+        try:
+            with open(list_path, newline='', encoding='utf-8') as f:
+                rows = list(csv.DictReader(f))
+        except FileNotFoundError:
+            return
+        except (OSError, csv.Error) as e:
+            loghandler.error("retry", "Could not read retry queue '%s': %s", list_path, e)
+            return
+        reasons = {}
+        for row in rows:
+            path = row.get("path")
+            if path and path not in finished_paths and os.path.exists(path):
+                reasons.pop(path, None)
+                reasons[path] = row.get("reason") or ""
+        temp_path = f"{list_path}.tmp"
+        try:
+            with open(temp_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(["path", "reason"])
+                writer.writerows(reasons.items())
+            os.replace(temp_path, list_path)
+        except OSError as e:
+            loghandler.error("retry", "Could not rewrite retry queue '%s': %s", list_path, e)
@@ -0,0 +1,144 @@
+import os
+import mmap
+import hashlib
+
+import handlers.file_handler as filehandler
+import handlers.log_handler as loghandler
+
+DUPLICATE_POLICIES = ("skip", "move", "hardlink")
+
+
+def hash_audio_payload(filepath, start, end):
+    """
+    Hashes only the audio payload (bytes start..end) of a file, so copies that differ
+    only in their ID3 tags hash the same. The file is mmap'ed and handed to the hasher
+    as a memoryview, so the audio is never copied into Python memory.
+    Returns the hex digest, or None for an empty payload (tag-only files are not duplicates
+    of each other) or on failure.
+    """
+    if end <= start:
+        return None
+    hasher = hashlib.blake2b(digest_size=16)
+    try:
+        with open(filepath, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    hasher.update(view[start:end])
+        return hasher.hexdigest()
+    except (OSError, ValueError) as e:
+        loghandler.error("dedupe", "Could not hash audio payload: %s", e, file=filepath)
+        return None
+
+
+def payload_hash(filepath):
+    """hash_audio_payload() over the file's own payload. None if it has none or could not be read."""
+    start, end = filehandler.get_audio_payload_bounds(filepath)
+    if start is None:
+        return None
+    return hash_audio_payload(filepath, start, end)
+
+
+def find_duplicate_groups(filepaths):
+    """
+    Groups files whose audio payload is byte-identical.
+    Files are first bucketed by payload length (which only needs the tag headers),
+    and only buckets with more than one file get hashed. Files without audio between their
+    tags are never grouped.
+    Returns a dict of {representative_path: [duplicate_path, ...]}; the representative
+    is the first file of each group in the order given.
+    """
+    by_payload_size = {}
+    bounds = {}
+    for filepath in filepaths:
+        try:
+            file_size = os.path.getsize(filepath)
+        except OSError as e:
+            loghandler.error("dedupe", "Could not stat: %s", e, file=filepath)
+            continue
+        start, end = filehandler.get_audio_payload_bounds(filepath, file_size)
+        if start is None or end <= start:
+            continue
+        bounds[filepath] = (start, end)
+        by_payload_size.setdefault(end - start, []).append(filepath)
+
+    duplicate_groups = {}
+    hashed_count = 0
+    for same_size_files in by_payload_size.values():
+        if len(same_size_files) < 2:
+            continue
+        by_hash = {}
+        for filepath in same_size_files:
+            start, end = bounds[filepath]
+            digest = hash_audio_payload(filepath, start, end)
+            hashed_count += 1
+            if digest:
+                by_hash.setdefault(digest, []).append(filepath)
+        for group in by_hash.values():
+            if len(group) > 1:
+                duplicate_groups[group[0]] = group[1:]
+
+    duplicate_count = sum(len(dups) for dups in duplicate_groups.values())
+    loghandler.info("dedupe", "Hashed %d of %d files. Found %d duplicate(s) in %d group(s).", hashed_count, len(filepaths), duplicate_count, len(duplicate_groups))
+    return duplicate_groups
+
+
+def handle_duplicates(duplicate_paths, representative_path, representative_meta, representative_new_path,
+                      root_music_folder, policy="skip", dry_run=True, allow_apostrophe_in_filename=False):
+    """
+    Applies the duplicate policy to the copies of a representative file, reusing the
+    representative's identification instead of looking the copies up again.
+      skip     - leave the copies where they are
+      move     - move the copies into a 'duplicates' folder, named after the representative's identification
+      hardlink - replace each copy with a hardlink to the organized representative (frees the space)
+    """
+    rep_name_log = os.path.basename(representative_path)
+    duplicates_dir = os.path.join(root_music_folder, "duplicates")
+
+    identified_name = None
+    if representative_meta and representative_meta.get('artist') and representative_meta.get('title'):
+        identified_name = filehandler.sanitize_filename(
+            f"{representative_meta['artist']} - {representative_meta['title']}",
+            allow_apostrophe_in_filename=allow_apostrophe_in_filename
+        )
+
+    for dup_path in duplicate_paths:
+        dup_name_log = os.path.basename(dup_path)
+        loghandler.info("duplicate", "Identical audio to '%s'. Policy: %s", rep_name_log, policy, file=dup_path)
+
+        if policy == "move":
+            _, ext = os.path.splitext(dup_path)
+            target_name = f"{identified_name}{ext}" if identified_name else dup_name_log
+            if dry_run:
+                loghandler.info("duplicate", "Dry run: Would move to '%s'.", os.path.join(duplicates_dir, target_name), file=dup_path, outcome="dry_run")
+                continue
+            try:
+                os.makedirs(duplicates_dir, exist_ok=True)
+                target_path = filehandler.get_unique_filepath(duplicates_dir, target_name, reserve=True)
+                try:
+                    filehandler.transfer_file(dup_path, target_path)
+                finally:
+                    filehandler.release_filepath(target_path)
+                loghandler.info("duplicate", "Moved to '%s'.", target_path, file=dup_path, outcome="moved")
+            except Exception as e:
+                loghandler.error("duplicate", "Could not move to the duplicates folder: %s", e, file=dup_path, outcome="error")
+
+        elif policy == "hardlink":
+            if not representative_new_path:
+                loghandler.info("duplicate", "Representative was not organized. Leaving it in place.", file=dup_path, outcome="skipped")
+                continue
+            if dry_run:
+                loghandler.info("duplicate", "Dry run: Would replace with a hardlink to '%s'.", representative_new_path, file=dup_path, outcome="dry_run")
+                continue
+            temp_link_path = f"{dup_path}.dedupe-link"
+            try:
+                os.link(representative_new_path, temp_link_path)
+                os.replace(temp_link_path, dup_path)
+                loghandler.info("duplicate", "Now a hardlink to '%s'.", representative_new_path, file=dup_path, outcome="hardlinked")
+            except OSError as e:
+                if os.path.exists(temp_link_path):
+                    os.remove(temp_link_path)
+                loghandler.error("duplicate", "Could not hardlink (different filesystem?): %s. Leaving it in place.", e, file=dup_path, outcome="error")
+
+        else:
+            loghandler.info("duplicate", "Left in place.", file=dup_path, outcome="skipped")
+
@@ -1,10 +1,42 @@
 import os
+import csv
 import shutil
 import re
+import mmap
+import errno
+import hashlib
+import threading
+try:
+    import fcntl # reflinks need ioctl(FICLONE), which is Linux only
+except ImportError:
+    fcntl = None
 
 from mutagen.easyid3 import EasyID3
 from mutagen.id3 import ID3NoHeaderError
-from mutagen.mp3 import HeaderNotFoundError
+from mutagen.mp3 import MP3, HeaderNotFoundError
+
+import handlers.log_handler as loghandler
+
+ORGANIZE_MODES = ("move", "hardlink", "reflink")
+ORGANIZE_MODE_VERBS = {"move": "moved", "hardlink": "hardlinked", "reflink": "reflinked"}
+VERIFY_COPIES = os.getenv("VERIFY_COPIES", "true").lower() in ("true", "1")
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+FICLONE = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+TAG_PADDING = os.getenv("TAG_PADDING", "keep").lower() # "keep" or "mutagen", see tag_padding()
+DEFAULT_TAG_PADDING_BYTES = 8192
+try:
+    TAG_PADDING_BYTES = int(os.getenv("TAG_PADDING_BYTES", str(DEFAULT_TAG_PADDING_BYTES)))
+    if TAG_PADDING_BYTES < 0:
+        raise ValueError
+except ValueError:
+    loghandler.warning("tag_update", "Invalid TAG_PADDING_BYTES '%s'. Falling back to %d.", os.getenv("TAG_PADDING_BYTES"), DEFAULT_TAG_PADDING_BYTES)
+    TAG_PADDING_BYTES = DEFAULT_TAG_PADDING_BYTES
+
+_reserved_filepaths = set()
+_reserved_filepaths_lock = threading.Lock()
+# Held while one of the CSV lists (quarantine list, retry queue) is written, so worker threads don't interleave rows
+csv_list_lock = threading.Lock()
+_csv_list_keys = {} # list path -> first-column values already in it (see append_csv_row's unique)
 
 
 def find_audio_files(folder_path):
@@ -25,20 +57,281 @@ def find_audio_files(folder_path):
         #             audio_files.append(os.path.join(root, file))
 
     except FileNotFoundError:
-        print(f"Error: The folder '{folder_path}' was not found.")
+        loghandler.error("scan", "The folder '%s' was not found.", folder_path)
         return [] # Return an empty list if folder doesn't exist
     except PermissionError:
-        print(f"Error: Permission denied to access the folder '{folder_path}'.")
+        loghandler.error("scan", "Permission denied to access the folder '%s'.", folder_path)
         return [] # Return an empty list if permission is denied        
     return audio_files
 
 
-def get_existing_metadata(filepath):
+def _read_csv_keys(list_path):
+    try:
+        with open(list_path, newline='', encoding='utf-8') as f:
+            return {row[0] for row in list(csv.reader(f))[1:] if row}
+    except FileNotFoundError:
+        return set()
+    except csv.Error as e:
+        raise OSError(f"unreadable CSV: {e}") from e
+
+
+def append_csv_row(list_path, header, row, unique=False):
     """
-    Extracts existing metadata (artist, title, album, tracknumber, year) from an audio file.
-    """    
+    Appends row to the CSV list at list_path, writing header first if the file is new. Raises OSError.
+    unique: leave the list alone if a row with the same first column (the file path) is in it already;
+    the list is read for that once per run. Returns True if the row was written.
+    """
+    with csv_list_lock:
+        keys = None
+        if unique:
+            keys = _csv_list_keys.get(list_path)
+            if keys is None:
+                keys = _csv_list_keys[list_path] = _read_csv_keys(list_path)
+            if row[0] in keys:
+                return False
+        new_file = not os.path.exists(list_path)
+        with open(list_path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(header)
+            writer.writerow(row)
+        if keys is not None:
+            keys.add(row[0])
+        return True
+
+
+def get_audio_payload_bounds(filepath, file_size=None):
+    """
+    Finds where the audio payload starts and ends, skipping any ID3v2 header(s) at the
+    front and the ID3v1 / APEv2 trailers at the back. Only the tag headers are read.
+    Returns (start_offset, end_offset) or (None, None) if the file could not be read.
+    """
+    try:
+        if file_size is None:
+            file_size = os.path.getsize(filepath)
+        start, end = 0, file_size
+        with open(filepath, 'rb') as f:
+            # ID3v2: "ID3" + version(2) + flags(1) + syncsafe size(4). There can be more than one.
+            while end - start >= 10:
+                f.seek(start)
+                header = f.read(10)
+                if len(header) < 10 or header[:3] != b'ID3':
+                    break
+                tag_size = (header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f)
+                footer_size = 10 if header[5] & 0x10 else 0
+                start += 10 + tag_size + footer_size
+
+            # ID3v1: fixed 128 byte "TAG" block at the very end
+            if end - start >= 128:
+                f.seek(end - 128)
+                if f.read(3) == b'TAG':
+                    end -= 128
+
+            # APEv2: 32 byte "APETAGEX" footer (its size field covers items + footer, not the optional header)
+            if end - start >= 32:
+                f.seek(end - 32)
+                footer = f.read(32)
+                if footer[:8] == b'APETAGEX':
+                    ape_size = int.from_bytes(footer[12:16], 'little')
+                    ape_flags = int.from_bytes(footer[20:24], 'little')
+                    if ape_flags & 0x80000000:
+                        ape_size += 32
+                    end = max(start, end - ape_size)
+
+        return min(start, end), end
+    except OSError as e:
+        loghandler.error("payload", "Could not read tag boundaries: %s", e, file=filepath)
+        return None, None
+
+
+def reserve_filepath(filepath):
+    """
+    Claims a target path for this process so parallel workers never pick the same one.
+    Returns False if the path already exists or another worker has claimed it.
+    """
+    with _reserved_filepaths_lock:
+        if filepath in _reserved_filepaths or os.path.exists(filepath):
+            return False
+        _reserved_filepaths.add(filepath)
+        return True
+
+
+def release_filepath(filepath):
+    with _reserved_filepaths_lock:
+        _reserved_filepaths.discard(filepath)
+
+
+def get_unique_filepath(directory, filename, reserve=False):
+    """
+    Returns a path for filename inside directory that does not exist yet,
+    appending _1, _2, ... to the name the same way the 'reviewed' fallback does.
+    With reserve=True the path is also claimed (see reserve_filepath); release it with release_filepath.
+    """
+    candidate = os.path.join(directory, filename)
+    name, ext = os.path.splitext(filename)
+    is_taken = (lambda path: not reserve_filepath(path)) if reserve else os.path.exists
+    counter = 1
+    while is_taken(candidate):
+        candidate = os.path.join(directory, f"{name}_{counter}{ext}")
+        counter += 1
+    return candidate
+
+
+def _copy_data(src_fd, dst_fd, size):
+    """
+    Copies size bytes between two open files inside the kernel: copy_file_range first (which btrfs/XFS/NFS
+    can turn into a server-side or extent-sharing copy), then sendfile, then a plain read/write loop.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_SIZE, size - copied))
+                if n == 0:
+                    break
+                copied += n
+            if copied >= size:
+                return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            while copied < size:
+                n = os.sendfile(dst_fd, src_fd, copied, min(COPY_CHUNK_SIZE, size - copied))
+                if n == 0:
+                    break
+                copied += n
+            if copied >= size:
+                return
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while True:
+        chunk = os.read(src_fd, COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        os.write(dst_fd, chunk)
+
+
+def _file_digest(filepath, start=0, end=None):
+    """Hash of the bytes start..end (default: the whole file)."""
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    hasher.update(view[start:end])
+    return hasher.digest()
+
+
+def is_same_audio(path_a, path_b):
+    """
+    True if path_b is path_a itself (the same inode, e.g. a hardlink) or holds the same audio payload
+    (a reflink or copy whose tags were rewritten afterwards).
+    """
+    try:
+        if os.path.samefile(path_a, path_b):
+            return True
+    except OSError:
+        return False
+    start_a, end_a = get_audio_payload_bounds(path_a)
+    start_b, end_b = get_audio_payload_bounds(path_b)
+    if start_a is None or start_b is None or end_a <= start_a or end_a - start_a != end_b - start_b:
+        return False
+    try:
+        return _file_digest(path_a, start_a, end_a) == _file_digest(path_b, start_b, end_b)
+    except (OSError, ValueError):
+        return False
+
+
+def copy_file_fast(src, dst, verify=True, reflink=False):
+    """
+    Copies src to a new file dst (never overwrites) without pulling the bytes through Python,
+    optionally as a reflink (copy-on-write clone, btrfs/XFS). With verify=True a data copy is compared
+    against the source (size + hash) and removed if it differs; a clone shares the source's extents,
+    so it is not read back.
+    """
+    with open(src, 'rb') as fsrc:
+        src_stat = os.fstat(fsrc.fileno())
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, src_stat.st_mode & 0o777)
+        try:
+            cloned = False
+            if reflink and fcntl is not None:
+                try:
+                    fcntl.ioctl(dst_fd, FICLONE, fsrc.fileno())
+                    cloned = True
+                except OSError as e:
+                    loghandler.info("copy", "Reflink not supported (%s). Copying instead.", e.strerror, file=dst)
+            if not cloned:
+                _copy_data(fsrc.fileno(), dst_fd, src_stat.st_size)
+            os.fsync(dst_fd)
+        except BaseException:
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+    shutil.copystat(src, dst)
+
+    if verify and not cloned and (os.path.getsize(dst) != src_stat.st_size or _file_digest(src) != _file_digest(dst)):
+        os.remove(dst)
+        raise OSError(errno.EIO, f"Copy verification failed for '{dst}'")
+
+
+def transfer_file(src, dst, mode="move", verify=VERIFY_COPIES):
+    """
+    Puts src at dst according to the organize mode:
+      move     - rename on the same filesystem; across filesystems, fast copy + verify, then unlink the source
+      hardlink - link dst to the same inode (no bytes copied); the source stays
+      reflink  - copy-on-write clone (btrfs/XFS); the source stays
+    hardlink/reflink fall back to a verified copy when the filesystem can't do them.
+    """
+    if os.path.exists(dst):
+        raise FileExistsError(errno.EEXIST, "Target already exists", dst)
+
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            loghandler.info("copy", "Hardlink not possible (%s). Copying instead.", e.strerror, file=src)
+        copy_file_fast(src, dst, verify=verify)
+        return
+
+    if mode == "reflink":
+        copy_file_fast(src, dst, verify=verify, reflink=True)
+        return
+
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # Cross-device move
+    copy_file_fast(src, dst, verify=verify)
+    os.remove(src)
+
+
+def _metadata_from_easyid3(audio):
     metadata = {}
-    filename_log = os.path.basename(filepath)
+    if 'artist' in audio: metadata['artist'] = audio['artist'][0]
+    if 'title' in audio: metadata['title'] = audio['title'][0]
+    if 'album' in audio: metadata['album'] = audio['album'][0]
+    if 'tracknumber' in audio: metadata['tracknumber'] = audio['tracknumber'][0].split('/')[0] # Get just the track number
+    if 'date' in audio: metadata['year'] = str(audio['date'][0])[:4]
+    elif 'originaldate' in audio: metadata['year'] = str(audio['originaldate'][0])[:4] # TDRC (ID3v2.4) vs TYER (ID3v2.3)
+    return metadata
+
+
+def read_tags(filepath):
+    """
+    Extracts existing metadata (artist, title, album, tracknumber, year) from an audio file.
+    Returns (metadata, tags): tags is the parsed EasyID3 object (empty if the file has no ID3 header yet),
+    which update_tags() can save without parsing the file again, or None if it could not be read.
+    """
     try:
         file_ext = os.path.splitext(filepath)[1].lower()
         audio = None
@@ -46,30 +339,39 @@ def get_existing_metadata(filepath):
             try:
                 audio = EasyID3(filepath)
             except ID3NoHeaderError:
-                print(f"  [Tags] No ID3 header found for MP3: {filename_log}")
-                return {}
+                loghandler.info("tags", "No ID3 header found.", file=filepath)
+                return {}, EasyID3()
             except HeaderNotFoundError:
-                print(f"  [Tags] MP3 header not found for: {filename_log}")
-                return {}
+                loghandler.warning("tags", "MP3 header not found.", file=filepath)
+                return {}, None
         # elif filepath.lower().endswith('.flac'):
         #     audio = FLAC(filepath)
         # elif filepath.lower().endswith('.m4a'):
         #     audio = MP4(filepath)
         else:
-            print(f"  [Tags] Unsupported file type for metadata extraction: {filename_log}")
-            return {} # Or handle other types
-
-        if 'artist' in audio: metadata['artist'] = audio['artist'][0]
-        if 'title' in audio: metadata['title'] = audio['title'][0]
-        if 'album' in audio: metadata['album'] = audio['album'][0]
-        if 'tracknumber' in audio: metadata['tracknumber'] = audio['tracknumber'][0].split('/')[0] # Get just the track number
-        if 'date' in audio: metadata['year'] = str(audio['date'][0])[:4]
-        elif 'originaldate' in audio: metadata['year'] = str(audio['originaldate'][0])[:4] # TDRC (ID3v2.4) vs TYER (ID3v2.3)
-        
-        return metadata
+            loghandler.warning("tags", "Unsupported file type for metadata extraction.", file=filepath)
+            return {}, None # Or handle other types
+
+        return _metadata_from_easyid3(audio), audio
     except Exception as e:
-        print(f"  [Tags] Error reading metadata for {filename_log}: {e} (type: {type(e).__name__})")
-        return {}
+        loghandler.error("tags", "Error reading metadata: %s (type: %s)", e, type(e).__name__, file=filepath)
+        return {}, None
+
+
+def get_existing_metadata(filepath):
+    """Extracts existing metadata (artist, title, album, tracknumber, year) from an audio file (see read_tags)."""
+    return read_tags(filepath)[0]
+
+def get_audio_duration(filepath):
+    """
+    Returns the track length in seconds from the MP3 headers (Xing/VBRI or frame header + file size),
+    without decoding any audio. None if it could not be read.
+    """
+    try:
+        return MP3(filepath).info.length
+    except Exception as e:
+        loghandler.warning("tags", "Could not read duration: %s", e, file=filepath)
+        return None
 
 def format_artist_for_directory(artist_name):
     """
@@ -89,7 +391,7 @@ def format_artist_for_directory(artist_name):
         # Check if both parts are non-empty to avoid weird reordering of ", Artist" or "Artist ,"
         if last_name and first_name:
             formatted_name = f"{first_name} {last_name}"
-            print(f"    [Artist Format] Reordered '{artist_name}' to '{formatted_name}' for directory.")
+            loghandler.debug("rename", "Reordered artist '%s' to '%s' for directory.", artist_name, formatted_name)
             return formatted_name
     return artist_name # Return original if no match or parts are empty
 
@@ -124,9 +426,41 @@ def sanitize_filename(name, allow_apostrophe_in_filename=False):
     return sanitized_name if sanitized_name else "Unknown"
 
 
-def rename_and_move_track(current_filepath, corrected_metadata, root_music_folder, dry_run=True, allow_apostrophe_in_filename=False):
+def move_to_reviewed(current_filepath, root_music_folder, reason, organize_mode="move"):
+    """
+    Moves (or links, per organize_mode) a file into the 'reviewed' subfolder without overwriting anything there.
+    Returns the path in 'reviewed', or None if that failed too.
+    """
+    current_filename_log = os.path.basename(current_filepath)
+    reviewed_dir = os.path.join(root_music_folder, "reviewed")
+    reviewed_filepath = None
+    # hardlink/reflink leave the original in place, so a later run sees it again
+    earlier_link = os.path.join(reviewed_dir, current_filename_log)
+    if organize_mode != "move" and os.path.exists(earlier_link) and is_same_audio(current_filepath, earlier_link):
+        loghandler.info("reviewed", "Already in reviewed as '%s' from an earlier run. Skipping.", earlier_link, file=current_filepath, outcome="already_reviewed")
+        return earlier_link
+    try:
+        os.makedirs(reviewed_dir, exist_ok=True)
+        reviewed_filepath = get_unique_filepath(reviewed_dir, current_filename_log, reserve=True)
+        if os.path.basename(reviewed_filepath) != current_filename_log:
+             loghandler.warning("reviewed", "Already in reviewed. Renaming to '%s'.", os.path.basename(reviewed_filepath), file=current_filepath)
+
+        transfer_file(current_filepath, reviewed_filepath, mode=organize_mode)
+        loghandler.info("reviewed", "Moved to '%s' %s.", reviewed_filepath, reason, file=current_filepath, outcome="reviewed")
+        return reviewed_filepath
+    except Exception as e_review:
+        loghandler.error("reviewed", "Could not move to reviewed folder (%s): %s", reason, e_review, file=current_filepath, outcome="error")
+        return None
+    finally:
+        if reviewed_filepath:
+            release_filepath(reviewed_filepath)
+
+
+def rename_and_move_track(current_filepath, corrected_metadata, root_music_folder, dry_run=True, allow_apostrophe_in_filename=False, organize_mode="move"):
     """
     Renames the track and moves it into an Artist/Album directory structure.
+    With organize_mode 'hardlink' or 'reflink' the file is linked into place instead and the original stays where it is;
+    when a later run finds that link (or a clone of the same audio) at the target, it is returned as already organized.
     If that fails (and not dry_run), moves the original file to a 'reviewed' subfolder.
     Returns the new filepath of the successfully organized file, or None if the primary organization failed.
     """
@@ -139,29 +473,11 @@ def rename_and_move_track(current_filepath, corrected_metadata, root_music_folde
     reviewed_dir = os.path.join(root_music_folder, "reviewed")
 
     if not (raw_artist and raw_title and raw_album):
-        print(f"  [Rename] Insufficient metadata (artist, title, or album missing) for {current_filename_log}. Skipping primary organization.")
+        loghandler.warning("rename", "Insufficient metadata (artist, title, or album missing). Skipping primary organization.", file=current_filepath)
         if not dry_run:
-            try:
-                os.makedirs(reviewed_dir, exist_ok=True)
-                reviewed_filepath = os.path.join(reviewed_dir, current_filename_log)
-                
-                # Avoid overwriting in reviewed folder if file with same name already exists
-                counter = 1
-                original_reviewed_filepath = reviewed_filepath
-                while os.path.exists(reviewed_filepath):
-                    name, ext = os.path.splitext(current_filename_log)
-                    reviewed_filepath = os.path.join(reviewed_dir, f"{name}_{counter}{ext}")
-                    counter += 1
-                if original_reviewed_filepath != reviewed_filepath:
-                     print(f"    WARNING: File '{os.path.basename(original_reviewed_filepath)}' already in reviewed. Renaming to '{os.path.basename(reviewed_filepath)}'.")
-
-
-                shutil.move(current_filepath, reviewed_filepath)
-                print(f"    MOVED TO REVIEWED: '{current_filename_log}' moved to '{reviewed_filepath}' due to insufficient metadata.")
-            except Exception as e_review:
-                print(f"    ERROR moving '{current_filename_log}' to reviewed folder: {e_review}")
+            move_to_reviewed(current_filepath, root_music_folder, "due to insufficient metadata", organize_mode)
         else:
-            print(f"    Dry run: Would move '{current_filename_log}' to '{reviewed_dir}' due to insufficient metadata.")
+            loghandler.info("rename", "Dry run: Would move to '%s' due to insufficient metadata.", reviewed_dir, file=current_filepath, outcome="dry_run")
         return None # Primary organization failed
 
     # --- Proceed with primary organization ---
@@ -171,7 +487,7 @@ def rename_and_move_track(current_filepath, corrected_metadata, root_music_folde
 
     # use the raw_title which may have an apostrophy if allow_apostrophe_in_filename is True
     s_title_file = sanitize_filename(raw_title, allow_apostrophe_in_filename=allow_apostrophe_in_filename)
-    print(f"    DEBUG: Raw title for sanitize: '{raw_title}', Sanitized title for file: '{s_title_file}', Allow apostrophe: {allow_apostrophe_in_filename}")
+    loghandler.debug("rename", "Raw title for sanitize: '%s', Sanitized title for file: '%s', Allow apostrophe: %s", raw_title, s_title_file, allow_apostrophe_in_filename, file=current_filepath)
 
     raw_tracknumber = corrected_metadata.get('tracknumber')
     tracknum_str = ""
@@ -179,7 +495,7 @@ def rename_and_move_track(current_filepath, corrected_metadata, root_music_folde
         try:
             tracknum_str = str(int(float(str(raw_tracknumber)))).zfill(2) 
         except ValueError:
-            print(f"    Warning: Invalid track number format '{raw_tracknumber}'. Omitting from filename.")
+            loghandler.warning("rename", "Invalid track number format '%s'. Omitting from filename.", raw_tracknumber, file=current_filepath)
             tracknum_str = ""
 
     _, ext = os.path.splitext(current_filepath)
@@ -187,7 +503,7 @@ def rename_and_move_track(current_filepath, corrected_metadata, root_music_folde
     
     if not new_filename_parts: # If both tracknum and title are empty after processing
         new_track_filename = f"{sanitize_filename(current_filename_log, False)}{ext}" # Sanitize original name as fallback
-        print(f"    Warning: Track number and title are empty. Using sanitized original filename: {new_track_filename}")
+        loghandler.warning("rename", "Track number and title are empty. Using sanitized original filename: %s", new_track_filename, file=current_filepath)
     else:
         new_track_filename = " - ".join(new_filename_parts) + ext
 
@@ -196,194 +512,135 @@ def rename_and_move_track(current_filepath, corrected_metadata, root_music_folde
     relative_new_path_log = os.path.join(s_artist_dir, s_album_dir, new_track_filename)
 
     if current_filepath == new_filepath:
-        print(f"  [Rename] Filename and location already correct for: {current_filename_log}")
+        loghandler.info("rename", "Filename and location already correct.", file=current_filepath, outcome="unchanged")
         return current_filepath # Still return path for potential tag update
 
-    print(f"  [Rename] Current: {current_filepath}")
-    print(f"  [Rename] Proposed New Path for primary organization: {new_filepath}")
+    loghandler.debug("rename", "Proposed new path for primary organization: %s", new_filepath, file=current_filepath)
+
+    # hardlink/reflink leave the original in place; a later run finds its earlier link or clone at the target
+    if organize_mode != "move" and os.path.exists(new_filepath) and is_same_audio(current_filepath, new_filepath):
+        loghandler.info("rename", "Already organized as '%s' by an earlier run. Skipping.", relative_new_path_log, file=current_filepath, outcome="already_organized")
+        return new_filepath
 
     if not dry_run:
         try:
             os.makedirs(target_artist_album_dir, exist_ok=True)
-            # print(f"    Ensured directory exists: {target_artist_album_dir}") # Can be verbose
 
-            if os.path.exists(new_filepath):
-                print(f"    WARNING: Target path {new_filepath} already exists (primary organization). Skipping.")
+            # Reserve the target so a parallel worker can't pick the same path
+            if not reserve_filepath(new_filepath):
+                loghandler.warning("rename", "Target path %s already exists (primary organization). Skipping.", new_filepath, file=current_filepath)
                 # Fallback to moving to 'reviewed'
-                try:
-                    os.makedirs(reviewed_dir, exist_ok=True)
-                    reviewed_filepath = os.path.join(reviewed_dir, current_filename_log)
-                    
-                    counter = 1
-                    original_reviewed_filepath = reviewed_filepath
-                    while os.path.exists(reviewed_filepath):
-                        name, ext_rev = os.path.splitext(current_filename_log)
-                        reviewed_filepath = os.path.join(reviewed_dir, f"{name}_{counter}{ext_rev}")
-                        counter += 1
-                    if original_reviewed_filepath != reviewed_filepath:
-                         print(f"    WARNING: File '{os.path.basename(original_reviewed_filepath)}' already in reviewed. Renaming to '{os.path.basename(reviewed_filepath)}'.")
-
-                    shutil.move(current_filepath, reviewed_filepath)
-                    print(f"    MOVED TO REVIEWED: '{current_filename_log}' moved to '{reviewed_filepath}' because primary target existed.")
-                except Exception as e_review_alt:
-                    print(f"    ERROR moving '{current_filename_log}' to reviewed folder after primary target existed: {e_review_alt}")
+                move_to_reviewed(current_filepath, root_music_folder, "because primary target existed", organize_mode)
                 return None # Primary organization failed
 
-            shutil.move(current_filepath, new_filepath)
-            print(f"    SUCCESS: Moved '{current_filename_log}' to '{relative_new_path_log}'")
+            try:
+                transfer_file(current_filepath, new_filepath, mode=organize_mode)
+            finally:
+                release_filepath(new_filepath)
+            loghandler.info("rename", "%s to '%s'", ORGANIZE_MODE_VERBS[organize_mode].capitalize(), relative_new_path_log, file=current_filepath, outcome=ORGANIZE_MODE_VERBS[organize_mode])
             return new_filepath # Success for primary organization
         except Exception as e_primary:
-            print(f"    ERROR during primary rename/move of '{current_filename_log}' to '{relative_new_path_log}': {e_primary}")
+            loghandler.error("rename", "Primary rename/move to '%s' failed: %s", relative_new_path_log, e_primary, file=current_filepath, outcome="error")
             # Fallback to moving to 'reviewed'
-            try:
-                os.makedirs(reviewed_dir, exist_ok=True)
-                reviewed_filepath = os.path.join(reviewed_dir, current_filename_log)
-                
-                counter = 1
-                original_reviewed_filepath = reviewed_filepath
-                while os.path.exists(reviewed_filepath):
-                    name, ext_rev = os.path.splitext(current_filename_log)
-                    reviewed_filepath = os.path.join(reviewed_dir, f"{name}_{counter}{ext_rev}")
-                    counter += 1
-                if original_reviewed_filepath != reviewed_filepath:
-                     print(f"    WARNING: File '{os.path.basename(original_reviewed_filepath)}' already in reviewed. Renaming to '{os.path.basename(reviewed_filepath)}'.")
-
-                shutil.move(current_filepath, reviewed_filepath)
-                print(f"    MOVED TO REVIEWED: '{current_filename_log}' moved to '{reviewed_filepath}' after primary organization error.")
-            except Exception as e_review_final:
-                print(f"    CRITICAL ERROR: Failed primary organization AND failed to move '{current_filename_log}' to reviewed folder: {e_review_final}")
+            if not move_to_reviewed(current_filepath, root_music_folder, "after primary organization error", organize_mode):
+                loghandler.error("rename", "Failed primary organization AND failed to move to reviewed folder.", file=current_filepath, outcome="error")
             return None # Primary organization failed
     else: # dry_run is True
-        print(f"    Dry run: Would create directory '{target_artist_album_dir}' (if needed for primary organization).")
-        print(f"    Dry run: Would move '{current_filename_log}' to '{relative_new_path_log}'.")
+        loghandler.info("rename", "Dry run: Would %s to '%s'.", organize_mode, relative_new_path_log, file=current_filepath, outcome="dry_run")
         # In dry run, we still return the proposed new_filepath for tag update simulation
         return new_filepath
 
 
-def update_tags(filepath, corrected_metadata, dry_run=True):
+def _tag_changes(corrected_metadata, current_metadata):
     """
-    Updates the metadata tags of the audio file.
-    The artist tag should be stored in the standard format (e.g. "Cash, Johnny" or "Johnny Cash" as per original/MusicBrainz).
-    The `format_artist_for_directory` is only for directory naming.
+    Returns {EasyID3 key: value} for the fields of corrected_metadata that differ from current_metadata
+    (a get_existing_metadata() dict). Track numbers compare as numbers ("1", "01" and "1/12" are the same)
+    and years by their first four characters.
     """
-    if not filepath or not os.path.exists(filepath):
-        print(f"  [Tag Update] File not found for tagging: {filepath}. Skipping.")
-        return
-
-    filename_log = os.path.basename(filepath)
-
-    # Use the artist name as it is in corrected_metadata for tagging, not the directory-formatted one.
-    artist_for_tags = corrected_metadata.get('artist') 
-    title_for_tags = corrected_metadata.get('title')
-    album_for_tags = corrected_metadata.get('album')
-    tracknum_for_tags = corrected_metadata.get('tracknumber')
-    year_for_tags = corrected_metadata.get('year')
-
-    print(f"  [Tag Update] Preparing to update tags for: {filename_log} with Artist='{artist_for_tags}', Title='{title_for_tags}', Album='{album_for_tags}' etc.")
-
-    if dry_run:
-        print(f"    Dry run: Would update tags for '{filename_log}'.")
-        return
+    changes = {}
+    for field, key in (('artist', 'artist'), ('title', 'title'), ('album', 'album'), ('tracknumber', 'tracknumber'), ('year', 'date')):
+        new_value = corrected_metadata.get(field)
+        if not new_value:
+            continue
+        old_value = current_metadata.get(field)
+        if field == 'tracknumber':
+            try:
+                unchanged = old_value is not None and int(str(new_value)) == int(str(old_value))
+            except ValueError:
+                unchanged = str(new_value) == str(old_value)
+        elif field == 'year':
+            unchanged = str(new_value)[:4] == old_value
+        else:
+            unchanged = str(new_value) == old_value
+        if not unchanged:
+            changes[key] = str(new_value)
+    return changes
 
-    try:
-        audio = None
-        file_ext = os.path.splitext(filepath)[1].lower()
 
-        if file_ext == '.mp3':
-            audio = EasyID3(filepath)
-            if artist_for_tags: audio['artist'] = artist_for_tags
-            if title_for_tags: audio['title'] = title_for_tags
-            if album_for_tags: audio['album'] = album_for_tags
-            if tracknum_for_tags: audio['tracknumber'] = str(tracknum_for_tags)
-            if year_for_tags: audio['date'] = str(year_for_tags) # or originaldate
-        
-        if audio:
-            audio.save()
-            print(f"    SUCCESS: Tags updated for '{filename_log}'.")
-        else:
-            print(f"    No specific tag handling for {file_ext} in this version.")
+def tag_padding(info):
+    """
+    mutagen padding callback (see TAG_PADDING). With "keep", a tag that still fits keeps the space it has, so
+    only the tag is rewritten in place; only a tag that outgrows its padding moves the audio, and then it gets
+    TAG_PADDING_BYTES of room so the next edit fits. "mutagen" uses mutagen's default policy, which may
+    shrink or grow the padding (and so rewrite the whole file) on any save.
+    """
+    if TAG_PADDING == "mutagen":
+        return info.get_default_padding()
+    if info.padding >= 0:
+        return info.padding
+    return TAG_PADDING_BYTES
 
-    except Exception as e:
-        print(f"    ERROR updating tags for {filename_log}: {e} (Type: {type(e).__name__})")
 
+def update_tags(filepath, corrected_metadata, dry_run=True, existing_metadata=None, tags=None):
     """
-    Updates the metadata tags of the audio file.
+    Updates the metadata tags of the audio file, only where they differ from corrected_metadata.
+    existing_metadata is what get_existing_metadata() read earlier; if it already matches, the file is not
+    opened at all. tags is the EasyID3 object read_tags() parsed it from: the changes are made to it and it is
+    saved, so the tags are not parsed a second time. Without it, the file is opened once, compared with its
+    actual tags, and saved only if something changed. Returns True if the tags were (or in a dry run, would be) written.
     The artist tag should be stored in the standard format (e.g. "Cash, Johnny" or "Johnny Cash" as per original/MusicBrainz).
     The `format_artist_for_directory` is only for directory naming.
     """
-    if not filepath or not os.path.exists(filepath):
-        print(f"  [Tag Update] File not found for tagging: {filepath}. Skipping.")
-        return
-
-    filename_log = os.path.basename(filepath)
-    print(f"  [Tag Update] Preparing to update tags for: {filename_log} with {corrected_metadata}")
+    if not filepath or not (dry_run or os.path.exists(filepath)):
+        loghandler.warning("tag_update", "File not found for tagging. Skipping.", file=filepath)
+        return False
+
+    file_ext = os.path.splitext(filepath)[1].lower()
+    if file_ext != '.mp3':
+        loghandler.info("tag_update", "No specific tag handling for %s in this version.", file_ext, file=filepath)
+        return False
+
+    if existing_metadata is None and tags is not None:
+        existing_metadata = _metadata_from_easyid3(tags)
+    if existing_metadata is not None:
+        changes = _tag_changes(corrected_metadata, existing_metadata)
+        if not changes:
+            loghandler.info("tag_update", "Tags already up to date. Not rewriting.", file=filepath, outcome="unchanged")
+            return False
+        loghandler.debug("tag_update", "Changing %s", changes, file=filepath)
+    else:
+        loghandler.debug("tag_update", "Preparing to update tags with %s", corrected_metadata, file=filepath)
 
     if dry_run:
-        print(f"    Dry run: Would update tags for '{filename_log}'.")
-        return
+        loghandler.info("tag_update", "Dry run: Would update tags.", file=filepath, outcome="dry_run")
+        return True
 
     try:
-        audio = None
-        file_ext = os.path.splitext(filepath)[1].lower()
-
-        if file_ext == '.mp3':
-            audio = EasyID3(filepath)
-            if corrected_metadata.get('artist'): audio['artist'] = corrected_metadata['artist']
-            if corrected_metadata.get('title'): audio['title'] = corrected_metadata['title']
-            if corrected_metadata.get('album'): audio['album'] = corrected_metadata['album']
-            tn = corrected_metadata.get('tracknumber')
-            # EasyID3 often stores total tracks too, e.g., "1/12".
-            # If your corrected_metadata doesn't have total tracks, just save the number.
-            if tn: audio['tracknumber'] = str(tn)
-            if corrected_metadata.get('year'): audio['date'] = str(corrected_metadata['year'])
-
-        elif file_ext == '.flac':
-            audio = FLAC(filepath)
-            # FLAC tags are case-sensitive and usually uppercase
-            if corrected_metadata.get('artist'): audio['ARTIST'] = corrected_metadata['artist']
-            if corrected_metadata.get('title'): audio['TITLE'] = corrected_metadata['title']
-            if corrected_metadata.get('album'): audio['ALBUM'] = corrected_metadata['album']
-            if corrected_metadata.get('tracknumber'): audio['TRACKNUMBER'] = str(corrected_metadata['tracknumber'])
-            if corrected_metadata.get('year'): audio['DATE'] = str(corrected_metadata['year'])
-
-        elif file_ext in ('.m4a', '.mp4'):
-            audio = MP4(filepath)
-            if corrected_metadata.get('artist'): audio['\xa9ART'] = corrected_metadata['artist']
-            if corrected_metadata.get('title'): audio['\xa9nam'] = corrected_metadata['title']
-            if corrected_metadata.get('album'): audio['\xa9alb'] = corrected_metadata['album']
-            if corrected_metadata.get('tracknumber'):
-                # MP4 track number can be a tuple (track, total_tracks).
-                # If total_tracks isn't available, set it to 0.
-                audio['trkn'] = [(int(corrected_metadata['tracknumber']), 0)]
-            if corrected_metadata.get('year'): audio['\xa9day'] = str(corrected_metadata['year'])
-        
-        if audio:
-            audio.save()
-            print(f"    SUCCESS: Tags updated for '{filename_log}'.")
-        else:
-            print(f"    No specific tag handling for {file_ext} in this version.")
-
-    except Exception as e:
-        print(f"    ERROR updating tags for {filename_log}: {e} (Type: {type(e).__name__})")
-
-    if not filepath or not os.path.exists(filepath): # Check if file still exists (it might have been renamed)
-        print(f"File not found for tagging: {filepath}")
-        return
-
-    try:
-        audio = None
-        if filepath.lower().endswith('.mp3'):
-            audio = EasyID3(filepath)
-            if corrected_metadata.get('artist'): audio['artist'] = corrected_metadata['artist']
-            if corrected_metadata.get('title'): audio['title'] = corrected_metadata['title']
-            if corrected_metadata.get('album'): audio['album'] = corrected_metadata['album']
-            if corrected_metadata.get('tracknumber'):
-                # EasyID3 often stores total tracks too, e.g., "1/12"
-                # You might need to fetch total tracks if you want to store it this way
-                audio['tracknumber'] = str(corrected_metadata['tracknumber'])
-
-        if audio:
-            audio.save()
-            print(f"Updated tags for: {filepath}")
+        audio = tags
+        if audio is None:
+            try:
+                audio = EasyID3(filepath)
+            except ID3NoHeaderError:
+                audio = EasyID3() # no tag yet; save() will add one
+            changes = _tag_changes(corrected_metadata, _metadata_from_easyid3(audio))
+            if not changes:
+                loghandler.info("tag_update", "Tags already up to date. Not rewriting.", file=filepath, outcome="unchanged")
+                return False
+        for key, value in changes.items():
+            audio[key] = value
+        audio.save(filepath, padding=tag_padding)
+        loghandler.info("tag_update", "Tags updated.", file=filepath, outcome="written")
+        return True
     except Exception as e:
-        print(f"Error updating tags for {filepath}: {e}")    
\ No newline at end of file
+        loghandler.error("tag_update", "Error updating tags: %s (Type: %s)", e, type(e).__name__, file=filepath, outcome="error")
+        return False
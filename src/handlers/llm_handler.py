@@ -3,10 +3,67 @@ import os
 import re
 from openai import OpenAI
 import json
+import time
+import threading
+import handlers.traffic_handler as traffichandler
+import handlers.deadline_handler as deadlinehandler
+import handlers.log_handler as loghandler
 
 load_dotenv()
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI()
+client = OpenAI(max_retries=0, timeout=deadlinehandler.REQUEST_TIMEOUTS["openai"]) # retries and rate limiting are done by traffic_handler
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4.1-mini")
+# "json_schema": the API constrains the reply to SONG_DETAILS_FORMAT, so it always parses.
+# "text": free-form reply, JSON recovered by parse_llm_json (for models without structured output).
+LLM_OUTPUT_MODE = os.getenv("LLM_OUTPUT_MODE", "json_schema").lower()
+PROMPT_CACHE_KEY = "song-normalizer-filenames"
+
+# The system prompts never change between calls and everything per-file goes in the user message,
+# so every request starts with the same prefix and the API can serve it from its prompt cache.
+SYSTEM_PROMPT = (
+    "Identify the song from a possibly mangled filename: artist, album, title, and the track number prefix if it has one. "
+    "Undo truncation and underscores that replaced apostrophes or colons. Use null for what you can't tell. "
+    'Answer with a JSON object with keys "artist", "album", "title", "original_prefix_number".'
+)
+BATCH_SYSTEM_PROMPT = (
+    "Identify the song from each possibly mangled filename in a numbered list: artist, album, title, and the track number prefix if it has one. "
+    "Undo truncation and underscores that replaced apostrophes or colons. Use null for what you can't tell. "
+    'Answer with a JSON object {"songs": [...]} holding one object per filename with keys "index" (its number in the list), '
+    '"artist", "album", "title", "original_prefix_number".'
+)
+
+_SONG_FIELDS = {field: {"type": ["string", "null"]} for field in ("artist", "album", "title", "original_prefix_number")}
+SONG_DETAILS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "song_details",
+        "strict": True,
+        "schema": {"type": "object", "properties": _SONG_FIELDS, "required": list(_SONG_FIELDS), "additionalProperties": False}
+    }
+}
+SONG_DETAILS_BATCH_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "song_details_batch",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"songs": {"type": "array", "items": {
+                "type": "object",
+                "properties": dict(index={"type": "integer"}, **_SONG_FIELDS),
+                "required": ["index", *_SONG_FIELDS],
+                "additionalProperties": False
+            }}},
+            "required": ["songs"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Token and latency totals for this run, per call kind (see usage_summary)
+USAGE_FIELDS = ('calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'seconds', 'max_seconds', 'unparsed')
+_usage = {}
+_usage_lock = threading.Lock()
 
 
 def clean_filename_for_llm(filename_no_ext):
@@ -17,6 +74,79 @@ def clean_filename_for_llm(filename_no_ext):
     return name
 
 
+# Filename layouts that can be parsed without the LLM, with how much we trust each one.
+# They run on the name after normalize_filename_for_parsing(), so "_-_" has already become " - ".
+_FIELD = r"(?:(?! - ).)+" # anything up to the next " - " separator, so "Jay-Z" stays whole
+FILENAME_PATTERNS = [
+    ("artist - album - NN - title", re.compile(rf"^(?P<artist>{_FIELD}) - (?P<album>{_FIELD}) - (?P<track>\d{{1,3}}) - (?P<title>.+)$"), 0.9),
+    ("NN - artist - title", re.compile(rf"^(?P<track>\d{{1,3}})(?:\s*[-.]\s*|\s+)(?P<artist>{_FIELD}) - (?P<title>{_FIELD})$"), 0.8),
+    ("artist - NN - title", re.compile(rf"^(?P<artist>{_FIELD}) - (?P<track>\d{{1,3}}) - (?P<title>{_FIELD})$"), 0.8),
+    ("artist - title", re.compile(rf"^(?!\d{{1,3}}(?:\s*[-.]\s*|\s))(?P<artist>{_FIELD}) - (?P<title>{_FIELD})$"), 0.7),
+]
+GENERIC_NAME_PARTS = {"track", "unknown", "unknown artist", "untitled", "audio", "various", "various artists", "va"}
+KNOWN_ARTIST_BONUS = 0.2
+
+
+def normalize_filename_for_parsing(filename_no_ext):
+    """Turns "Artist_-_Album_-_01_-_Title (1)" style names into "Artist - Album - 01 - Title"."""
+    name = filename_no_ext.replace("_-_", " - ").replace("_", " ")
+    name = re.sub(r"\s*\(\d+\)\s*$", "", name) # " (1)" copy suffix
+    name = re.sub(r"\s+-\s*|\s*-\s+", " - ", name) # separators, but not hyphenated words like "Jay-Z"
+    return re.sub(r"\s+", " ", name).strip(" .-")
+
+
+def normalize_artist_key(artist_name):
+    """Lookup key for an artist: "Cash, Johnny", "Johnny_Cash" and "johnny cash" all give "johnnycash"."""
+    if not artist_name:
+        return ""
+    match = re.match(r"^([^,]+),\s*([^,]+)$", artist_name.strip())
+    if match:
+        artist_name = f"{match.group(2)} {match.group(1)}"
+    return re.sub(r"[\W_]+", "", artist_name).casefold()
+
+
+def parse_filename_locally(filename_no_ext, known_artists=None):
+    """
+    Rule-based alternative to query_llm_for_song_details() for well-formed names.
+    Tries each FILENAME_PATTERNS entry and scores the result: names that look generic are penalized,
+    and an artist found in known_artists (keys from normalize_artist_key) gets a bonus. If only the
+    "title" side is a known artist, the two are swapped ("Title - Artist" names).
+    Returns the best guess as a dict shaped like the LLM's answer plus "confidence", or None.
+    """
+    name = normalize_filename_for_parsing(filename_no_ext)
+    known_artists = known_artists or set()
+    best_guess = None
+    for pattern_name, pattern, base_confidence in FILENAME_PATTERNS:
+        match = pattern.match(name)
+        if not match:
+            continue
+        fields = {k: v.strip() for k, v in match.groupdict().items() if v and v.strip()}
+        artist, title = fields.get('artist'), fields.get('title')
+        if not artist or not title:
+            continue
+
+        confidence = base_confidence
+        if normalize_artist_key(artist) in known_artists:
+            confidence += KNOWN_ARTIST_BONUS
+        elif normalize_artist_key(title) in known_artists:
+            artist, title = title, artist
+            confidence += KNOWN_ARTIST_BONUS / 2
+        for part in (artist, title):
+            if len(part) < 2 or part.isdigit() or part.casefold() in GENERIC_NAME_PARTS:
+                confidence -= 0.5
+
+        if best_guess is None or confidence > best_guess['confidence']:
+            best_guess = {
+                "artist": artist,
+                "title": title,
+                "album": fields.get('album'),
+                "original_prefix_number": fields.get('track'),
+                "confidence": round(min(confidence, 1.0), 2),
+                "pattern": pattern_name,
+            }
+    return best_guess
+
+
 def extract_json_from_llm_response(llm_output_str):
     """
     Extracts a JSON string from a larger string, potentially with Markdown fences.
@@ -51,61 +181,164 @@ def extract_json_from_llm_response(llm_output_str):
             return stripped_output
         return None
 
-def query_llm_for_song_details(filename_no_ext):
+
+def parse_llm_json(llm_output_str):
     """
-    Conceptual LLM query.
+    Parses the JSON payload of an LLM response. Tries the whole response first
+    (needed for arrays of objects) and falls back to extract_json_from_llm_response.
+    Returns the parsed object or None.
     """
-    if not OPENAI_KEY:
-        print("  [LLM] OpenAI API key not set. Skipping LLM query.")
+    if not llm_output_str:
         return None
-    prompt = f"""
-    Given the following potentially mangled song filename part, identify the correct artist, album and title.
-    If it seems to have a track number prefix, please state it.
-    If parts are truncated or have underscores replacing other characters like apostrophes or colons, please correct them.
-    Provide the answer as a JSON object with keys "artist", "album", "title", and "original_prefix_number" (if any).
-    You don't have to fill in all of the fields.  Return as many as you can.
-
-    JSON:
+    stripped_output = llm_output_str.strip()
+    fence_match = re.match(r"^```(?:json)?\s*(.*?)\s*```$", stripped_output, re.DOTALL)
+    if fence_match:
+        stripped_output = fence_match.group(1)
+    try:
+        return json.loads(stripped_output)
+    except json.JSONDecodeError:
+        pass
+    json_to_parse = extract_json_from_llm_response(llm_output_str)
+    if not json_to_parse:
+        return None
+    try:
+        return json.loads(json_to_parse)
+    except json.JSONDecodeError as e:
+        loghandler.warning("llm", "JSONDecodeError after attempting to clean response: %s", e)
+        return None
+
+def _record_usage(kind, response, latency):
+    """Adds one call's tokens and latency to the run totals and logs them."""
+    usage = getattr(response, 'usage', None)
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', 0) or 0
+    with _usage_lock:
+        stats = _usage.setdefault(kind, dict.fromkeys(USAGE_FIELDS, 0))
+        stats['calls'] += 1
+        stats['prompt_tokens'] += prompt_tokens
+        stats['cached_tokens'] += cached_tokens
+        stats['completion_tokens'] += completion_tokens
+        stats['seconds'] += latency
+        stats['max_seconds'] = max(stats['max_seconds'], latency)
+    loghandler.info("llm", "%s call: %d prompt tokens (%d cached), %d completion tokens", kind, prompt_tokens, cached_tokens, completion_tokens,
+                    duration=latency, kind=kind, prompt_tokens=prompt_tokens, cached_tokens=cached_tokens, completion_tokens=completion_tokens)
+
+
+def _count_unparsed(kind):
+    with _usage_lock:
+        _usage.setdefault(kind, dict.fromkeys(USAGE_FIELDS, 0))['unparsed'] += 1
+
+
+def usage_summary():
+    """Per call kind ("single", "batch"): calls, prompt/cached/completion tokens, seconds, max_seconds, unparsed replies."""
+    with _usage_lock:
+        return {kind: dict(stats) for kind, stats in _usage.items()}
+
+
+def log_usage_summary():
+    for kind, stats in usage_summary().items():
+        loghandler.info("llm", "%s: %d call(s), %d prompt tokens (%d cached), %d completion tokens, %.1fs total (%.1fs max), %d unparsed repl%s.",
+                        kind, stats['calls'], stats['prompt_tokens'], stats['cached_tokens'], stats['completion_tokens'],
+                        stats['seconds'], stats['max_seconds'], stats['unparsed'], "y" if stats['unparsed'] == 1 else "ies",
+                        kind=kind, **stats)
+
+
+def _create_completion(kind, system_prompt, user_content, response_format, timeout=None):
+    """One chat completion (one attempt; traffic_handler retries), timed and counted."""
+    options = {} if LLM_OUTPUT_MODE == "text" else {"response_format": response_format}
+    started = time.monotonic()
+    response = client.with_options(timeout=timeout or deadlinehandler.REQUEST_TIMEOUTS["openai"]).chat.completions.create(
+        model=LLM_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ],
+        temperature=0.3, # Lower temperature for more deterministic output
+        prompt_cache_key=PROMPT_CACHE_KEY,
+        **options
+    )
+    _record_usage(kind, response, time.monotonic() - started)
+    return response
+
+
+def _reply_content(kind, response):
+    message = response.choices[0].message
+    if getattr(message, 'refusal', None):
+        loghandler.warning("llm", "The model refused: %s", message.refusal)
+        _count_unparsed(kind)
+        return None
+    loghandler.debug("llm", "Raw response: %s", message.content)
+    return message.content
+
+
+def query_llm_for_song_details(filename_no_ext, deadline=None):
     """
+    Asks the LLM about one filename, within deadline (see deadline_handler) if one is given.
+    Returns a dict with "artist", "album", "title" and "original_prefix_number" (missing ones None or absent), or None.
+    """
+    if not OPENAI_KEY:
+        loghandler.warning("llm", "OpenAI API key not set. Skipping LLM query.")
+        return None
     try:
-        # Example for OpenAI ChatCompletion
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini", # Or a more advanced model
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": f"Filename part: \"{filename_no_ext}\""}
-            ],
-            temperature=0.3 # Lower temperature for more deterministic output
-        )
-        # Parse the JSON response from the LLM
-        # This will require careful parsing and error handling
-        content = response.choices[0].message.content
-        print(f"LLM raw response: {content}")
-
-        json_to_parse = extract_json_from_llm_response(content)
-
-        if not json_to_parse:
-            print(f"  [LLM] Could not extract a valid JSON structure from the LLM response.")
+        response = deadlinehandler.call('openai', _create_completion, "single", SYSTEM_PROMPT, f"Filename part: \"{filename_no_ext}\"", SONG_DETAILS_FORMAT,
+                                        timeout=deadlinehandler.timeout_for(deadline, "openai"), deadline=deadline, hedge=False)
+        content = _reply_content("single", response)
+        if content is None:
             return None
+        parsed_data = parse_llm_json(content)
+        if not isinstance(parsed_data, dict):
+            loghandler.warning("llm", "Could not get a JSON object from the LLM response: %s", content)
+            _count_unparsed("single")
+            return None
+        return parsed_data
+    except traffichandler.ServiceUnavailableError:
+        raise
+    except Exception as e:
+        loghandler.error("llm", "API error: %s", e)
+        return None
 
-        try:
-            # Now parse the cleaned JSON string
-            parsed_data = json.loads(json_to_parse)
-            # Basic validation: ensure it's a dictionary and has expected keys (optional but good)
-            if not isinstance(parsed_data, dict):
-                print(f"  [LLM] Parsed JSON is not a dictionary: {parsed_data}")
-                return None
-            # You could add checks for parsed_data.get('artist'), etc. here if desired
-            return parsed_data
-        except json.JSONDecodeError as e:
-            print(f"  [LLM] JSONDecodeError after attempting to clean response: {e}")
-            print(f"    Attempted to parse: '{json_to_parse}'")
+
+def query_llm_for_song_details_batch(filenames_no_ext, deadline=None):
+    """
+    Asks the LLM about several filenames in one request, within deadline if one is given.
+    Returns a list aligned with filenames_no_ext holding a dict (or None) per filename,
+    or None if the whole request failed.
+    """
+    if not OPENAI_KEY:
+        loghandler.warning("llm", "OpenAI API key not set. Skipping LLM query.")
+        return None
+    if not filenames_no_ext:
+        return []
+    numbered_names = "\n".join(f"{i}. \"{name}\"" for i, name in enumerate(filenames_no_ext))
+    try:
+        response = deadlinehandler.call('openai', _create_completion, "batch", BATCH_SYSTEM_PROMPT, f"Filename parts:\n{numbered_names}", SONG_DETAILS_BATCH_FORMAT,
+                                        timeout=deadlinehandler.timeout_for(deadline, "openai"), deadline=deadline, hedge=False)
+        content = _reply_content("batch", response)
+        if content is None:
             return None
-        except Exception as e_generic: # Catch any other unexpected errors during parsing
-            print(f"  [LLM] Unexpected error parsing cleaned JSON: {e_generic}")
-            print(f"    Attempted to parse: '{json_to_parse}'")
+        parsed_data = parse_llm_json(content)
+        if isinstance(parsed_data, dict):
+            # {"songs": [...]} with structured output; some free-form answers wrap the array too
+            parsed_data = next((v for v in parsed_data.values() if isinstance(v, list)), None)
+        if not isinstance(parsed_data, list):
+            loghandler.warning("llm", "Batch response did not contain a JSON array. Raw response: %s", content)
+            _count_unparsed("batch")
             return None
 
+        results = [None] * len(filenames_no_ext)
+        for position, item in enumerate(parsed_data):
+            if not isinstance(item, dict):
+                continue
+            try:
+                index = int(item.pop('index', position))
+            except (TypeError, ValueError):
+                index = position
+            if 0 <= index < len(results):
+                results[index] = item
+        return results
+    except traffichandler.ServiceUnavailableError:
+        raise
     except Exception as e:
-        print(f"LLM API error: {e}")
+        loghandler.error("llm", "API error (batch of %d): %s", len(filenames_no_ext), e)
         return None
@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import hashlib
+import threading
+
+# Structured event log. Every event has a level, a stage (tags, fingerprint, llm, apply, ...), a message and
+# optionally the file it is about, an outcome and a duration, plus any extra fields. Events go onto an
+# in-memory queue and a background thread formats and writes them in batches, so logging never blocks
+# the pipeline on terminal or disk I/O.
+#   console: human-readable text (or JSON lines with LOG_FORMAT=json)
+#   LOG_FILE: JSON lines, one event per line
+# Messages use %-style arguments, which are only formatted by the writer thread, and only for events at or
+# above LOG_LEVEL; a disabled debug() call returns before touching its arguments.
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+BATCH_SIZE = 512
+FLUSH_INTERVAL_SECONDS = 0.2
+
+_level = LEVELS.get(os.getenv("LOG_LEVEL", "info").lower(), INFO)
+_console_format = os.getenv("LOG_FORMAT", "text").lower()
+_log_file_path = os.getenv("LOG_FILE")
+
+_events = queue.SimpleQueue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+_FLUSH = object()
+_STOP = object()
+
+
+def configure(level=None, console_format=None, log_file=None):
+    """Overrides LOG_LEVEL / LOG_FORMAT / LOG_FILE. Call before the first event to also catch the file."""
+    global _level, _console_format, _log_file_path
+    if level is not None:
+        _level = LEVELS.get(str(level).lower(), INFO)
+    if console_format is not None:
+        _console_format = console_format.lower()
+    if log_file is not None:
+        _log_file_path = log_file
+
+
+def is_enabled(level):
+    return level >= _level
+
+
+def file_id(filepath):
+    """Short stable id for a path, so a file's events can be found across stages (and renames, via the 'file' field)."""
+    return hashlib.blake2b(filepath.encode('utf-8', 'replace'), digest_size=6).hexdigest()
+
+
+def event(level, stage, message, *args, file=None, outcome=None, duration=None, **fields):
+    """Queues an event. message % args is only formatted if the event is written."""
+    if level < _level:
+        return
+    if _writer_thread is None:
+        _start_writer()
+    _events.put((time.time(), level, stage, message, args, file, outcome, duration, fields))
+
+
+def debug(stage, message, *args, **kwargs):
+    if DEBUG >= _level:
+        event(DEBUG, stage, message, *args, **kwargs)
+
+
+def info(stage, message, *args, **kwargs):
+    event(INFO, stage, message, *args, **kwargs)
+
+
+def warning(stage, message, *args, **kwargs):
+    event(WARNING, stage, message, *args, **kwargs)
+
+
+def error(stage, message, *args, **kwargs):
+    event(ERROR, stage, message, *args, **kwargs)
+
+
+def _format_message(message, args):
+    if not args:
+        return message
+    try:
+        return message % args
+    except (TypeError, ValueError):
+        return f"{message} {args}"
+
+
+def _to_json(timestamp, level, stage, message, file, outcome, duration, fields):
+    record = {"ts": round(timestamp, 3), "level": LEVEL_NAMES[level], "stage": stage}
+    if file:
+        record["file_id"] = file_id(file)
+        record["file"] = file
+    if outcome:
+        record["outcome"] = outcome
+    if duration is not None:
+        record["duration_ms"] = round(duration * 1000, 1)
+    record["msg"] = message
+    record.update(fields)
+    return json.dumps(record, default=str, ensure_ascii=False)
+
+
+def _to_text(level, stage, message, file, outcome, duration):
+    parts = []
+    if level >= WARNING:
+        parts.append(LEVEL_NAMES[level].upper())
+    parts.append(f"[{stage}]")
+    if file:
+        parts.append(f"{os.path.basename(file)}:")
+    parts.append(message)
+    if outcome:
+        parts.append(f"-> {outcome}")
+    if duration is not None:
+        parts.append(f"({duration * 1000:.0f} ms)")
+    return " ".join(parts)
+
+
+def _write_batch(batch, log_file):
+    console_lines, file_lines = [], []
+    for timestamp, level, stage, message, args, file, outcome, duration, fields in batch:
+        message = _format_message(message, args)
+        json_line = None
+        if _console_format == "json":
+            json_line = _to_json(timestamp, level, stage, message, file, outcome, duration, fields)
+            console_lines.append(json_line)
+        else:
+            console_lines.append(_to_text(level, stage, message, file, outcome, duration))
+        if log_file:
+            file_lines.append(json_line or _to_json(timestamp, level, stage, message, file, outcome, duration, fields))
+    try:
+        sys.stdout.write("\n".join(console_lines) + "\n")
+        sys.stdout.flush()
+    except (OSError, ValueError):
+        pass
+    if log_file:
+        log_file.write("\n".join(file_lines) + "\n")
+        log_file.flush()
+
+
+def _writer():
+    log_file = None
+    if _log_file_path:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(_log_file_path)), exist_ok=True)
+            log_file = open(_log_file_path, 'a', encoding='utf-8', buffering=1024 * 1024)
+        except OSError as e:
+            sys.stderr.write(f"Could not open LOG_FILE '{_log_file_path}': {e}\n")
+
+    stopping = False
+    while not stopping:
+        batch, waiters = [], []
+        try:
+            item = _events.get(timeout=FLUSH_INTERVAL_SECONDS)
+        except queue.Empty:
+            continue
+        while True:
+            if item is _STOP:
+                stopping = True
+            elif isinstance(item, tuple) and item[0] is _FLUSH:
+                waiters.append(item[1])
+            else:
+                batch.append(item)
+            if stopping or len(batch) >= BATCH_SIZE:
+                break
+            try:
+                item = _events.get_nowait()
+            except queue.Empty:
+                break
+        if batch:
+            _write_batch(batch, log_file)
+        for waiter in waiters:
+            waiter.set()
+
+    if log_file:
+        log_file.close()
+
+
+def _start_writer():
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer, name="log-writer", daemon=True)
+            _writer_thread.start()
+            atexit.register(close)
+
+
+def flush(timeout=5.0):
+    """Blocks until every event queued so far has been written."""
+    if _writer_thread is None:
+        return
+    done = threading.Event()
+    _events.put((_FLUSH, done))
+    done.wait(timeout)
+
+
+def close():
+    """Writes what is queued and stops the writer thread."""
+    global _writer_thread
+    with _writer_lock:
+        thread, _writer_thread = _writer_thread, None
+    if thread is not None and thread.is_alive():
+        _events.put(_STOP)
+        thread.join(5.0)
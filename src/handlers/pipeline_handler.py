@@ -0,0 +1,497 @@
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import handlers.file_handler as filehandler
+import handlers.metadata_handler as metadatahandler
+import handlers.llm_handler as llmhandler
+import handlers.traffic_handler as traffichandler
+import handlers.cache_handler as cachehandler
+import handlers.dedupe_handler as dedupehandler
+import handlers.triage_handler as triagehandler
+import handlers.deadline_handler as deadlinehandler
+import handlers.log_handler as loghandler
+
+# Stages are generators: each takes an iterable of TrackRecords and yields them on to the next stage.
+# main() chains them as scan -> triage -> tags -> takeout -> cluster -> fingerprint -> lookup -> expand -> plan -> apply. Because every stage only
+# holds the records it is working on (plus a small window for parallel work / LLM batches), memory stays
+# bounded no matter how big the library is. Any stage can be dropped, reordered or run on its own.
+
+
+class TrackRecord:
+    """
+    Compact per-file state. The identification lives in slots instead of a metadata dict
+    that gets copied and patched along the way; metadata() builds the dict the handlers take.
+    """
+    __slots__ = ('filepath', 'tags', 'artist', 'title', 'album', 'tracknumber', 'year', 'mb_recording_id',
+                 'source_comment', 'source', 'deferred', 'rejected', 'new_filepath', 'duplicates', 'variants', 'deadline',
+                 'duration', 'id3')
+
+    METADATA_FIELDS = ('artist', 'title', 'album', 'tracknumber', 'year', 'mb_recording_id', 'source_comment')
+
+    def __init__(self, filepath, duplicates=None):
+        self.filepath = filepath
+        self.tags = {}             # local tags as read in the tag stage (artist, title, album, tracknumber, year)
+        self.artist = None
+        self.title = None
+        self.album = None
+        self.tracknumber = None
+        self.year = None
+        self.mb_recording_id = None
+        self.source_comment = None
+        self.source = "None"
+        self.deferred = False      # deadline_handler reason if a service was unavailable or the time budget ran out; retry on a later run instead of 'reviewed'
+        self.rejected = None       # triage_handler reason code if the file is broken; no stage touches it after that
+        self.new_filepath = None
+        self.duplicates = duplicates # byte-identical copies that reuse this record's result (see dedupe_handler)
+        self.variants = None         # records with a similar name that reuse this record's result (see cluster_handler)
+        self.deadline = None         # deadline_handler.Deadline, started by the first network stage
+        self.duration = None         # track length in seconds, read on demand (see record_duration)
+        self.id3 = None              # the EasyID3 tags the tag stage parsed; update_tags saves them instead of parsing the file again
+
+    @property
+    def resolved(self):
+        return bool(self.artist and self.title and self.album)
+
+    @property
+    def needs_lookup(self):
+        return not self.resolved and not self.rejected
+
+    def start_deadline(self, budget_seconds):
+        if budget_seconds and self.deadline is None:
+            self.deadline = deadlinehandler.Deadline(budget_seconds)
+
+    def settle(self, meta, source):
+        """Takes the identification from a handler's metadata dict."""
+        for field in self.METADATA_FIELDS:
+            setattr(self, field, meta.get(field))
+        self.source = source
+
+    def metadata(self):
+        return {field: getattr(self, field) for field in self.METADATA_FIELDS if getattr(self, field) is not None}
+
+    def __repr__(self):
+        return f"TrackRecord({os.path.basename(self.filepath)!r}, source={self.source!r}, resolved={self.resolved})"
+
+
+def is_complete(meta):
+    return bool(meta and meta.get('artist') and meta.get('title') and meta.get('album'))
+
+
+def parallel_map(fn, items, workers):
+    """
+    Like executor.map, but lazy: pulls from items only as results are consumed, with at most
+    2 * workers calls in flight, and yields results in input order.
+    """
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(executor.submit(fn, item))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def window_stage(records, size, on_window=None):
+    """
+    A barrier over a bounded window: collects size records from the stage before, then passes them on.
+    Put after every stage, it runs the stages as passes (a window's tags, then its fingerprints, then its
+    lookups) while holding at most a window of records per stage. on_window(window) sees each window first.
+    Waiting here doesn't use up a record's time budget: its deadline is paused until the record is passed on.
+    """
+    def pass_on(window):
+        if on_window:
+            on_window(window)
+        for record in window:
+            if record.deadline:
+                record.deadline.resume()
+            yield record
+
+    window = []
+    for record in records:
+        if record.deadline:
+            record.deadline.pause()
+        window.append(record)
+        if len(window) >= size:
+            yield from pass_on(window)
+            window = []
+    if window:
+        yield from pass_on(window)
+
+
+# --- scan ---
+
+def scan_stage(filepaths, duplicate_groups=None):
+    """Turns file paths into TrackRecords, attaching each representative's duplicates."""
+    duplicate_groups = duplicate_groups or {}
+    for filepath in filepaths:
+        yield TrackRecord(filepath, duplicates=duplicate_groups.get(filepath))
+
+
+# --- triage ---
+
+def triage_stage(records, workers=8):
+    """
+    Reads the first MPEG frame headers of each file (triage_handler.triage_file) and marks broken ones as
+    rejected, so they never reach fpcalc. apply_record then quarantines them or moves them to 'reviewed'.
+    """
+    def check(record):
+        reason, detail = triagehandler.triage_file(record.filepath)
+        if reason:
+            record.rejected = reason
+            loghandler.warning("triage", "%s", detail, file=record.filepath, outcome=reason)
+        return record
+
+    yield from parallel_map(check, records, workers)
+
+
+# --- tags ---
+
+def tag_stage(records, workers=8, known_artists=None):
+    """
+    Reads local tags and settles the records whose tags are complete (artist, title, album).
+    Tag reads are I/O bound, so they run on a thread pool.
+    Artists seen in tags are added to known_artists for the lookup stage's filename parser.
+    """
+    def read_tags(record):
+        if record.rejected:
+            return record
+        record.tags, record.id3 = filehandler.read_tags(record.filepath)
+        if is_complete(record.tags):
+            record.settle(dict(record.tags, source_comment="Local Tags"), "Local Tags")
+        return record
+
+    for record in parallel_map(read_tags, records, workers):
+        if known_artists is not None and record.tags.get('artist'):
+            known_artists.add(llmhandler.normalize_artist_key(record.tags['artist']))
+        yield record
+
+
+# --- what lookups rank their candidates against (see ranking_handler) ---
+
+FILENAME_TRACK_PREFIX = re.compile(r"^\s*(\d+)\s*[-._ ]+\s*(.*)")
+
+
+def record_duration(record):
+    """The file's length in seconds: the cached fpcalc duration, else the MP3 headers. None if unreadable."""
+    if record.duration is None:
+        cached_duration, _ = cachehandler.get_cached_fingerprint(record.filepath)
+        record.duration = cached_duration or filehandler.get_audio_duration(record.filepath) or 0
+    return record.duration or None
+
+
+def lookup_hints(record):
+    """The file's own tags, with the filename's track number prefix if the tags have none."""
+    hints = dict(record.tags)
+    if not hints.get('tracknumber'):
+        match = FILENAME_TRACK_PREFIX.match(os.path.splitext(os.path.basename(record.filepath))[0])
+        if match:
+            hints['tracknumber'] = match.group(1)
+    return hints
+
+
+# --- fingerprint ---
+
+def _fingerprint_record(record, file_budget=None):
+    if not record.needs_lookup:
+        return record
+    filepath = record.filepath
+    record.start_deadline(file_budget)
+    started = time.monotonic()
+    try:
+        fingerprint_meta = metadatahandler.identify_song_fingerprint(filepath, record.deadline, lookup_hints(record))
+    except traffichandler.ServiceUnavailableError as e:
+        record.deferred = deadlinehandler.defer_reason(e)
+        loghandler.warning("fingerprint", "Deferred: %s", e, file=filepath, outcome=record.deferred, duration=time.monotonic() - started)
+        return record
+    if is_complete(fingerprint_meta):
+        record.settle(fingerprint_meta, "AcoustID/MusicBrainz")
+        loghandler.info("fingerprint", "%s - %s (%s)", record.artist, record.title, record.album,
+                        file=filepath, outcome="identified", duration=time.monotonic() - started)
+    else:
+        loghandler.info("fingerprint", "Not enough info (Artist, Title, Album).", file=filepath, outcome="unresolved",
+                        duration=time.monotonic() - started)
+        loghandler.debug("fingerprint", "Result: %s", fingerprint_meta, file=filepath)
+    return record
+
+
+def fingerprint_stage(records, workers=None, file_budget=None):
+    """
+    Fingerprints (fpcalc) and queries AcoustID for the records the tag stage could not settle.
+    fpcalc is CPU bound, so the default worker count is the CPU count; traffic_handler paces the lookups.
+    file_budget (seconds) starts each file's deadline (see deadline_handler).
+    """
+    yield from parallel_map(lambda record: _fingerprint_record(record, file_budget), records, workers or os.cpu_count() or 1)
+
+
+# --- lookup (filename parser / LLM, verified by MusicBrainz) ---
+
+def build_known_artists(organized_music_root):
+    """
+    Artist keys (llm_handler.normalize_artist_key) we already trust: the artist folders of the organized
+    library. tag_stage adds the artists from this run's tags. Used to score local filename parses.
+    """
+    known_artists = set()
+    try:
+        for entry in os.scandir(organized_music_root):
+            if entry.is_dir() and entry.name not in ("reviewed", "duplicates") and not entry.name.startswith('.'):
+                known_artists.add(llmhandler.normalize_artist_key(entry.name))
+    except OSError as e:
+        loghandler.warning("lookup", "Could not list organized library '%s': %s", organized_music_root, e)
+    known_artists.discard("")
+    return known_artists
+
+
+def _verify_llm_guess(record, llm_guess, source_label="LLM"):
+    filepath = record.filepath
+    if not (llm_guess and llm_guess.get('artist') and llm_guess.get('title')): # Album is desirable but not strictly required from LLM
+        loghandler.info("lookup", "%s could not provide a useful suggestion (Artist, Title).", source_label, file=filepath, outcome="no_suggestion")
+        return
+    loghandler.debug("lookup", "%s suggestion: %s", source_label, llm_guess, file=filepath)
+    started = time.monotonic()
+    try:
+        verified_llm_meta = metadatahandler.get_musicbrainz_details(
+            llm_guess['artist'],
+            llm_guess['title'],
+            llm_guess.get('album'),
+            deadline=record.deadline,
+            tracknumber=llm_guess.get('original_prefix_number') or lookup_hints(record).get('tracknumber'),
+            duration=record_duration(record)
+        )
+    except traffichandler.ServiceUnavailableError as e:
+        record.deferred = deadlinehandler.defer_reason(e)
+        loghandler.warning("lookup", "Deferred while verifying with MusicBrainz: %s", e, file=filepath, outcome=record.deferred)
+        return
+    if is_complete(verified_llm_meta):
+        record.settle(verified_llm_meta, f"{source_label} via MusicBrainz")
+        # Augment with LLM's track number if MB didn't provide one
+        if not record.tracknumber and llm_guess.get('original_prefix_number'):
+            record.tracknumber = str(llm_guess['original_prefix_number']).zfill(2)
+        loghandler.info("lookup", "%s verified by MusicBrainz: %s - %s (%s)", source_label, record.artist, record.title, record.album,
+                        file=filepath, outcome="identified", duration=time.monotonic() - started)
+    else:
+        loghandler.info("lookup", "%s suggestion could not be verified by MusicBrainz (Artist, Title, Album).", source_label,
+                        file=filepath, outcome="unverified", duration=time.monotonic() - started)
+        loghandler.debug("lookup", "Verified: %s", verified_llm_meta, file=filepath)
+
+
+def _query_llm_single(record, cleaned):
+    try:
+        return llmhandler.query_llm_for_song_details(cleaned, record.deadline)
+    except traffichandler.ServiceUnavailableError as e:
+        record.deferred = deadlinehandler.defer_reason(e)
+        loghandler.warning("llm", "Deferred: %s", e, file=record.filepath, outcome=record.deferred)
+        return None
+
+
+def _query_llm_batch(batch):
+    """
+    Returns one LLM guess per (record, cleaned_name) in batch, falling back to single queries if the batch call fails.
+    The batch call runs until the latest deadline in the batch; the single queries each use their own file's.
+    """
+    deadline = max((record.deadline for record, _ in batch if record.deadline), key=lambda d: d.expires_at, default=None)
+    try:
+        guesses = llmhandler.query_llm_for_song_details_batch([cleaned for _, cleaned in batch], deadline)
+    except traffichandler.ServiceUnavailableError as e:
+        reason = deadlinehandler.defer_reason(e)
+        loghandler.warning("llm", "Deferred a batch of %d files: %s", len(batch), e, outcome=reason)
+        for record, _ in batch:
+            record.deferred = reason
+        return [None] * len(batch)
+    if guesses is None:
+        loghandler.warning("llm", "Batch query failed. Falling back to one query per file for %d files.", len(batch))
+        guesses = [_query_llm_single(record, cleaned) for record, cleaned in batch]
+    return guesses
+
+
+def _run_llm_batches(pending, batch_size, workers):
+    """Sends the LLM batches concurrently; MusicBrainz verification stays serial (one request per second)."""
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    loghandler.info("llm", "Sending %d filenames in %d batch(es).", len(pending), len(batches))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch, guesses in zip(batches, executor.map(_query_llm_batch, batches)):
+            for (record, _), llm_guess in zip(batch, guesses):
+                _verify_llm_guess(record, llm_guess)
+            for record, _ in batch:
+                yield record
+
+
+def lookup_stage(records, batch_size=20, workers=4, known_artists=None, min_local_confidence=0.8, llm_enabled=True, file_budget=None):
+    """
+    Settles what is left from the filename.
+    Well-formed names are parsed locally (llm_handler.parse_filename_locally); only names the parser is not
+    confident about are queued for the LLM, which is asked workers * batch_size names at a time.
+    Every guess is verified with MusicBrainz. Records that are already settled pass straight through,
+    and so do records whose deadline (started here if fingerprinting didn't) has already run out.
+    """
+    batch_size = max(1, batch_size)
+    workers = max(1, workers)
+    pending = []
+    for record in records:
+        if not record.needs_lookup:
+            yield record
+            continue
+        record.start_deadline(file_budget)
+        if record.deadline and record.deadline.expired:
+            record.deferred = deadlinehandler.DEFERRED_DEADLINE
+            loghandler.warning("lookup", "Time budget used up before the filename lookup.", file=record.filepath, outcome=record.deferred)
+            yield record
+            continue
+
+        filename_no_ext = os.path.splitext(os.path.basename(record.filepath))[0]
+        local_guess = llmhandler.parse_filename_locally(filename_no_ext, known_artists)
+        if local_guess and local_guess['confidence'] >= min_local_confidence:
+            _verify_llm_guess(record, local_guess, source_label="Filename Parser")
+            if record.resolved or record.deferred:
+                yield record
+                continue
+
+        cleaned_for_llm = llmhandler.clean_filename_for_llm(filename_no_ext)
+        if not cleaned_for_llm:
+            loghandler.info("lookup", "Filename too generic or empty after cleaning for LLM query.", file=record.filepath, outcome="unresolved")
+            yield record
+        elif not llm_enabled:
+            yield record
+        else:
+            pending.append((record, cleaned_for_llm))
+            if len(pending) >= batch_size * workers:
+                yield from _run_llm_batches(pending, batch_size, workers)
+                pending = []
+
+    if pending:
+        yield from _run_llm_batches(pending, batch_size, workers)
+
+
+# --- plan ---
+
+def plan_stage(records):
+    """Settles the track number: normalizes it, or falls back to the original filename's numeric prefix."""
+    for record in records:
+        if record.resolved:
+            # Ensure tracknumber is reasonable if present
+            if record.tracknumber:
+                try:
+                    # Attempt to make it an int and zfill, handles cases like "1" -> "01"
+                    record.tracknumber = str(int(str(record.tracknumber))).zfill(2)
+                except ValueError:
+                    loghandler.warning("plan", "Invalid track number '%s'. Clearing it.", record.tracknumber, file=record.filepath)
+                    record.tracknumber = None
+
+            # If track number is still missing, try to extract from original filename as a last resort
+            if not record.tracknumber:
+                original_filename_no_ext = os.path.splitext(os.path.basename(record.filepath))[0]
+                match = FILENAME_TRACK_PREFIX.match(original_filename_no_ext)
+                if match:
+                    record.tracknumber = match.group(1).zfill(2)
+                    loghandler.debug("plan", "Extracted track number '%s' from original filename as fallback.", record.tracknumber, file=record.filepath)
+        yield record
+
+
+# --- apply ---
+
+def apply_record(record, organized_music_root, dry_run=True, allow_apostrophe_in_filename=False, organize_mode="move",
+                 duplicate_policy="skip", tag_write_timing="after_move", triage_action="quarantine", quarantine_list_path=None,
+                 retry_list_path=None):
+    """
+    Final step for one file: rename/move it and update its tags, or move it to 'reviewed' if nothing
+    could identify it. Then applies the duplicate policy to its byte-identical copies.
+    Files rejected by triage are added to the quarantine list (and with triage_action "reviewed", moved there).
+    Tags are diffed against record.tags, so files whose tags are already right are not rewritten.
+    tag_write_timing "before_move" writes them at the original path before the move (not with reflinks,
+    where the original must stay untouched).
+    Deferred files are left in place and, if retry_list_path is given, added to that retry queue.
+    Sets record.new_filepath (None if the file was not organized).
+    """
+    filepath = record.filepath
+    started = time.monotonic()
+    loghandler.debug("apply", "Applying.", file=filepath)
+
+    if record.rejected:
+        if dry_run:
+            if triage_action == "reviewed":
+                loghandler.info("apply", "Rejected as '%s'. Dry run: Would move it to 'reviewed' and add it to the quarantine list.", record.rejected, file=filepath, outcome="dry_run")
+            else:
+                loghandler.info("apply", "Rejected as '%s'. Dry run: Would add it to the quarantine list and leave it in place.", record.rejected, file=filepath, outcome="dry_run")
+            return record
+        quarantine_list_path = quarantine_list_path or os.path.join(organized_music_root, "quarantine.csv")
+        triagehandler.record_quarantine(quarantine_list_path, filepath, record.rejected)
+        if triage_action == "reviewed":
+            filehandler.move_to_reviewed(filepath, organized_music_root, f"as a broken file ({record.rejected})", organize_mode)
+        else:
+            loghandler.info("apply", "Rejected as '%s'. Left in place and added to the quarantine list '%s'.", record.rejected, quarantine_list_path,
+                            file=filepath, outcome="quarantined", duration=time.monotonic() - started)
+        return record
+
+    if record.resolved:
+        identified_meta = record.metadata()
+        loghandler.debug("apply", "Using data from %s: %s", record.source, identified_meta, file=filepath)
+
+        tags_written_before_move = tag_write_timing == "before_move" and organize_mode != "reflink"
+        if tags_written_before_move:
+            filehandler.update_tags(filepath, identified_meta, dry_run=dry_run, existing_metadata=record.tags, tags=record.id3)
+
+        record.new_filepath = filehandler.rename_and_move_track(
+            filepath,
+            identified_meta,
+            organized_music_root,
+            dry_run=dry_run,
+            allow_apostrophe_in_filename=allow_apostrophe_in_filename,
+            organize_mode=organize_mode
+        )
+
+        if record.new_filepath and (dry_run or os.path.exists(record.new_filepath)):
+            if not tags_written_before_move:
+                filehandler.update_tags(record.new_filepath, identified_meta, dry_run=dry_run, existing_metadata=record.tags, tags=record.id3)
+            if not dry_run:
+                cachehandler.move_fingerprint(filepath, record.new_filepath) # keeps the audit mode's cache warm
+        elif not record.new_filepath and not dry_run:
+            loghandler.info("apply", "Skipping tag update as its primary organization failed or it was moved to 'reviewed'.", file=filepath)
+        # Optional: A warning if dry_run is false, new_filepath is set, but the file isn't there.
+        elif record.new_filepath and not dry_run and not os.path.exists(record.new_filepath):
+            loghandler.warning("apply", "Proposed new path %s does not exist. Skipping tag update.", record.new_filepath, file=filepath)
+
+    else:
+        loghandler.info("apply", "Could not obtain sufficient metadata (Artist, Title, Album) from any source.", file=filepath)
+
+        # A service outage is not a failed identification: leave the file for the next run
+        if record.deferred:
+            loghandler.info("apply", "Deferred (%s). Leaving it in place for the next run.", record.deferred, file=filepath, outcome="deferred")
+            if retry_list_path and not dry_run:
+                deadlinehandler.record_retry(retry_list_path, filepath, record.deferred)
+        # If all identification fails, move to 'reviewed' folder if not dry_run
+        elif not dry_run:
+            filehandler.move_to_reviewed(filepath, organized_music_root, "due to failure in all metadata identification stages", organize_mode)
+        else: # dry_run is True
+            loghandler.info("apply", "Dry run: Would move it to 'reviewed' folder due to failure in all metadata identification stages.", file=filepath, outcome="dry_run")
+
+    if record.duplicates:
+        dedupehandler.handle_duplicates(
+            record.duplicates,
+            filepath,
+            record.metadata() if record.resolved else None,
+            record.new_filepath,
+            organized_music_root,
+            policy=duplicate_policy,
+            dry_run=dry_run,
+            allow_apostrophe_in_filename=allow_apostrophe_in_filename
+        )
+    loghandler.debug("apply", "Done.", file=filepath, outcome=record.source if record.resolved else "unresolved", duration=time.monotonic() - started)
+    return record
+
+
+def apply_stage(records, organized_music_root, dry_run=True, allow_apostrophe_in_filename=False, organize_mode="move",
+                duplicate_policy="skip", workers=1, tag_write_timing="after_move", triage_action="quarantine", quarantine_list_path=None,
+                retry_list_path=None):
+    """Applies every record; workers > 1 runs the moves/copies in parallel (useful across filesystems)."""
+    def apply_one(record):
+        return apply_record(record, organized_music_root, dry_run, allow_apostrophe_in_filename, organize_mode, duplicate_policy,
+                            tag_write_timing, triage_action, quarantine_list_path, retry_list_path)
+
+    yield from parallel_map(apply_one, records, workers)
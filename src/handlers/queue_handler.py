@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import threading
+
+import handlers.pipeline_handler as pipelinehandler
+import handlers.dedupe_handler as dedupehandler
+import handlers.log_handler as loghandler
+
+# Distributed mode: several hosts share one SQLite work queue on shared storage (NFS/SMB mount).
+# Each node enqueues its own shard of MUSIC_PATH (files are sharded by path hash), claims work with
+# expiring leases, and once its own shard is drained it takes pending or expired-lease items from the
+# other shards, so the files of a crashed node are picked up by the others.
+# The same database is the shared catalog: every node writes its identification results into it, and
+# cache_handler.merge_cache() pulls/pushes fingerprints and AcoustID answers through it.
+# The dedupe pre-pass only sees this node's shard, so claimed files are also registered by audio payload hash:
+# a file whose audio another item already has is not identified again, it gets that item's result instead.
+# Items are keyed by their path relative to the library root (MUSIC_PATH), so the nodes may mount the library
+# in different places; each node resolves them against its own root. The new_filepath in results is stored the
+# same way, so ORGANIZED_MUSIC_ROOT has to sit at the same place relative to MUSIC_PATH on every node.
+
+DEFAULT_LEASE_SECONDS = 900
+# A file whose lease expired this many times (its node crashed or hung on it each time) is marked failed instead of handed out again
+DEFAULT_MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_items (
+    path TEXT PRIMARY KEY,
+    shard INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    duplicates_json TEXT,
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result_json TEXT,
+    payload_hash TEXT,
+    duplicate_of TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS work_items_claim ON work_items (status, shard);
+"""
+# Columns added after the first release, for queues created by an older version
+_ADDED_COLUMNS = (("payload_hash", "TEXT"), ("duplicate_of", "TEXT"))
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS work_items_payload ON work_items (payload_hash);
+CREATE INDEX IF NOT EXISTS work_items_duplicate_of ON work_items (duplicate_of);
+"""
+
+# work_items.status
+PENDING = "pending"     # waiting to be claimed
+LEASED = "leased"       # claimed by lease_owner until lease_expires
+DONE = "done"           # identified and organized (or sent to 'reviewed'); result_json holds the catalog entry
+DEFERRED = "deferred"   # an external service was unavailable; re-opened by the next run's enqueue
+FAILED = "failed"       # its lease expired max_attempts times; left for a human, never claimed again
+DUPLICATE = "duplicate" # same audio as duplicate_of, which is not done yet; completing that item takes this one along
+
+
+def queue_key(filepath, library_root=None):
+    """The queue's key for a file: its path relative to library_root ('/'-separated), or the path itself without a root."""
+    if not library_root or not filepath:
+        return filepath
+    return os.path.relpath(os.path.abspath(filepath), library_root).replace(os.sep, '/')
+
+
+def queue_path(key, library_root=None):
+    """The local path of a queue key (see queue_key)."""
+    if not library_root or not key:
+        return key
+    return os.path.normpath(os.path.join(library_root, key.replace('/', os.sep)))
+
+
+def shard_of(filepath, node_count):
+    """Stable shard number for a path (the same on every host, unlike hash())."""
+    digest = hashlib.blake2b(filepath.encode('utf-8', 'replace'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % max(1, node_count)
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Lease-based work queue in a SQLite file. Every write runs in a BEGIN IMMEDIATE transaction,
+    so concurrent nodes serialize on the database lock. The rollback journal is used instead of WAL,
+    because WAL needs shared memory and does not work on network filesystems.
+    """
+
+    def __init__(self, db_path, node_index=0, node_count=1, node_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, library_root=None):
+        self.db_path = db_path
+        self.library_root = os.path.abspath(library_root) if library_root else None
+        self.node_index = node_index
+        self.node_count = max(1, node_count)
+        self.node_id = node_id or default_node_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.lock = threading.Lock()
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_thread = None
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.executescript(_SCHEMA)
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(work_items)")}
+        for column, column_type in _ADDED_COLUMNS:
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE work_items ADD COLUMN {column} {column_type}")
+        self.connection.executescript(_INDEXES)
+
+    def _key(self, filepath):
+        return queue_key(filepath, self.library_root)
+
+    def _path(self, key):
+        return queue_path(key, self.library_root)
+
+    def _result_json(self, result):
+        if not result:
+            return None
+        if result.get('new_filepath'):
+            result = dict(result, new_filepath=self._key(result['new_filepath']))
+        return json.dumps(result)
+
+    def _result(self, result_json):
+        result = json.loads(result_json) if result_json else {}
+        if result.get('new_filepath'):
+            result['new_filepath'] = self._path(result['new_filepath'])
+        return result
+
+    def _transaction(self, fn):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self.connection)
+                self.connection.execute("COMMIT")
+                return result
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, filepaths, duplicate_groups=None):
+        """
+        Adds this node's files. Files already in the queue keep their state (so a rerun skips what is done
+        or failed), except deferred ones, which are re-opened with a fresh attempt count.
+        Returns the number of files that are now pending.
+        """
+        duplicate_groups = duplicate_groups or {}
+        now = time.time()
+        rows = []
+        for filepath in filepaths:
+            key = self._key(filepath)
+            duplicates = duplicate_groups.get(filepath)
+            rows.append((key, shard_of(key, self.node_count), json.dumps([self._key(d) for d in duplicates]) if duplicates else None, now))
+
+        def write(connection):
+            connection.executemany(
+                "INSERT INTO work_items (path, shard, duplicates_json, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET status = 'pending', duplicates_json = excluded.duplicates_json, attempts = 0, "
+                "updated_at = excluded.updated_at WHERE status = 'deferred'",
+                rows
+            )
+            return connection.execute("SELECT COUNT(*) FROM work_items WHERE status = 'pending'").fetchone()[0]
+
+        return self._transaction(write)
+
+    def claim(self, count):
+        """
+        Leases up to count items to this node: pending or expired-lease items of its own shard first,
+        then anyone else's. Expired leases that already had max_attempts attempts are marked failed instead.
+        Returns a list of (path, duplicate_paths).
+        """
+        now = time.time()
+
+        def take(connection):
+            exhausted = [path for (path,) in connection.execute(
+                "SELECT path FROM work_items WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            )]
+            connection.executemany(
+                "UPDATE work_items SET status = 'failed', lease_owner = NULL, lease_expires = NULL, updated_at = ? WHERE path = ?",
+                [(now, path) for path in exhausted]
+            )
+            # their duplicates would wait forever; re-open them, so one of them is identified instead
+            connection.executemany(
+                "UPDATE work_items SET status = 'pending', duplicate_of = NULL, updated_at = ? WHERE status = 'duplicate' AND duplicate_of = ?",
+                [(now, path) for path in exhausted]
+            )
+            for path in exhausted:
+                loghandler.error("queue", "Lease expired after %d attempts (the file crashes or hangs its worker). Marking it failed.",
+                                 self.max_attempts, file=self._path(path), outcome=FAILED)
+            rows = connection.execute(
+                "SELECT path, duplicates_json FROM work_items "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY shard != ?, attempts, path LIMIT ?",
+                (now, self.node_index, count)
+            ).fetchall()
+            connection.executemany(
+                "UPDATE work_items SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE path = ?",
+                [(self.node_id, now + self.lease_seconds, now, path) for path, _ in rows]
+            )
+            return rows
+
+        return [(self._path(key), [self._path(d) for d in json.loads(duplicates_json)] if duplicates_json else None)
+                for key, duplicates_json in self._transaction(take)]
+
+    def renew_leases(self):
+        """Extends the leases this node still holds. Called by the heartbeat thread."""
+        now = time.time()
+        return self._transaction(lambda connection: connection.execute(
+            "UPDATE work_items SET lease_expires = ? WHERE status = 'leased' AND lease_owner = ?",
+            (now + self.lease_seconds, self.node_id)
+        ).rowcount)
+
+    def register_payload(self, path, digest):
+        """
+        Records the audio payload hash of a claimed item. If another item (on any shard) already has the same
+        audio, this one is not identified itself: returns (owner_path, owner_status, owner_result).
+        An owner that is done hands over its result right away (the item is marked done); otherwise the item
+        waits as a duplicate and complete() hands it to the owner's node. Returns None if this item is the first.
+        """
+        now = time.time()
+        path = self._key(path)
+
+        def write(connection):
+            owner = connection.execute(
+                "SELECT path, status, result_json FROM work_items "
+                "WHERE payload_hash = ? AND path != ? AND status NOT IN ('duplicate', 'failed') ORDER BY path LIMIT 1",
+                (digest, path)
+            ).fetchone()
+            if owner is None:
+                connection.execute("UPDATE work_items SET payload_hash = ? WHERE path = ?", (digest, path))
+                return None
+            owner_path, owner_status, owner_result_json = owner
+            if owner_status == DONE:
+                connection.execute(
+                    "UPDATE work_items SET status = 'done', payload_hash = ?, duplicate_of = ?, result_json = ?, lease_owner = NULL, "
+                    "lease_expires = NULL, updated_at = ? WHERE path = ?",
+                    (digest, owner_path, json.dumps({'duplicate_of': owner_path, 'node': self.node_id}), now, path)
+                )
+            else:
+                connection.execute(
+                    "UPDATE work_items SET status = 'duplicate', payload_hash = ?, duplicate_of = ?, lease_owner = NULL, "
+                    "lease_expires = NULL, updated_at = ? WHERE path = ?",
+                    (digest, owner_path, now, path)
+                )
+            return self._path(owner_path), owner_status, self._result(owner_result_json)
+
+        return self._transaction(write)
+
+    def complete(self, path, status, result=None):
+        """
+        Records the outcome of a claimed item. Ignored if the lease was lost to another node in the meantime.
+        When the item is done, the duplicates waiting on it (see register_payload) are marked done too;
+        returns their paths (with their own pre-pass duplicates), so the caller can apply the duplicate policy to them.
+        """
+        now = time.time()
+        filepath, path = path, self._key(path)
+
+        def write(connection):
+            updated = connection.execute(
+                "UPDATE work_items SET status = ?, result_json = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE path = ? AND status = 'leased' AND lease_owner = ?",
+                (status, self._result_json(result), now, path, self.node_id)
+            ).rowcount
+            if not updated:
+                return None
+            if status != DONE:
+                return []
+            duplicates = []
+            for duplicate, duplicates_json in connection.execute(
+                "SELECT path, duplicates_json FROM work_items WHERE status = 'duplicate' AND duplicate_of = ?", (path,)
+            ):
+                duplicates.append(self._path(duplicate))
+                duplicates.extend(self._path(d) for d in json.loads(duplicates_json or "[]")) # its own node's copies of it
+            connection.execute(
+                "UPDATE work_items SET status = 'done', result_json = ?, updated_at = ? WHERE status = 'duplicate' AND duplicate_of = ?",
+                (json.dumps({'duplicate_of': path, 'node': self.node_id}), now, path)
+            )
+            return duplicates
+
+        duplicates = self._transaction(write)
+        if duplicates is None:
+            loghandler.warning("queue", "Lease was lost (expired and reclaimed by another node). Result not recorded.", file=filepath, outcome="lease_lost")
+            return []
+        return duplicates
+
+    def status_counts(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM work_items GROUP BY status").fetchall())
+
+    def start_heartbeat(self):
+        """Renews this node's leases every third of the lease time, so slow files are not reclaimed while being worked on."""
+        def beat():
+            while not self.heartbeat_stop.wait(self.lease_seconds / 3.0):
+                try:
+                    self.renew_leases()
+                except sqlite3.Error as e:
+                    loghandler.error("queue", "Could not renew leases: %s", e)
+        self.heartbeat_thread = threading.Thread(target=beat, name="queue-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def close(self):
+        self.heartbeat_stop.set()
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join()
+        with self.lock:
+            self.connection.close()
+
+
+def claim_stage(queue, claim_batch_size=10, on_duplicates=None):
+    """
+    Pipeline source stage: yields TrackRecords for items claimed from the queue until nothing is left to claim.
+    Items whose audio another item already has (see WorkQueue.register_payload) are not yielded; if that item is
+    done, on_duplicates(duplicate_paths, owner_path, owner_result) applies the duplicate policy to them here.
+    """
+    while True:
+        claimed = queue.claim(claim_batch_size)
+        if not claimed:
+            return
+        for filepath, duplicates in claimed:
+            if not os.path.exists(filepath):
+                loghandler.info("queue", "No longer exists (organized by an earlier run?). Marking it done.", file=filepath, outcome="gone")
+                queue.complete(filepath, DONE)
+                continue
+            digest = dedupehandler.payload_hash(filepath)
+            owner = queue.register_payload(filepath, digest) if digest else None
+            if owner is None:
+                yield pipelinehandler.TrackRecord(filepath, duplicates=duplicates)
+                continue
+            owner_path, owner_status, owner_result = owner
+            if owner_status == DONE:
+                loghandler.info("duplicate", "Identical audio to '%s', which is already done. Reusing its result.", owner_path, file=filepath, outcome="duplicate")
+                if on_duplicates:
+                    on_duplicates([filepath] + (duplicates or []), owner_path, owner_result)
+            else:
+                loghandler.info("duplicate", "Identical audio to '%s' (%s). Its node will reuse its result for this file.", owner_path, owner_status,
+                                file=filepath, outcome="duplicate")
+
+
+def complete_stage(queue, records, on_duplicates=None):
+    """
+    Pipeline sink stage: writes each applied record's result into the shared catalog and passes it on.
+    Duplicates that other nodes found waiting on a done record are passed to on_duplicates(duplicate_paths, owner_path, result).
+    """
+    for record in records:
+        if record.rejected:
+            result = {'rejected': record.rejected, 'node': queue.node_id}
+            waiting = queue.complete(record.filepath, DONE, result)
+        elif record.deferred and not record.resolved:
+            result = None
+            waiting = queue.complete(record.filepath, DEFERRED)
+        else:
+            result = dict(record.metadata(), source=record.source, new_filepath=record.new_filepath, node=queue.node_id)
+            waiting = queue.complete(record.filepath, DONE, result)
+        if waiting and on_duplicates:
+            on_duplicates(waiting, record.filepath, result)
+        yield record
@@ -0,0 +1,224 @@
+import re
+from difflib import SequenceMatcher
+
+import handlers.llm_handler as llmhandler
+
+# Picks the best (recording, release) pair out of everything an AcoustID or MusicBrainz answer returns,
+# instead of the first recording's first release. Every candidate is scored against what is already known
+# about the file: its duration (fpcalc or the MP3 headers), its tags or filename guess, and its track number
+# prefix. Original album releases are preferred over compilations, live albums and soundtracks.
+# Candidates are plain dicts with the metadata keys plus: duration (seconds), source_score (0-1, the
+# service's own match score), status, primary_type, secondary_types and release_group_id of the release.
+
+# A candidate's score is the weighted sum of its features, each between 0 and 1
+WEIGHTS = {
+    "source": 2.0,      # AcoustID fingerprint score / MusicBrainz search score
+    "duration": 2.0,    # recording length close to the file's
+    "artist": 1.0,      # similarity to the known artist
+    "title": 1.0,
+    "album": 0.5,
+    "tracknumber": 0.5, # same position as the filename's/tags' track number
+    "release": 1.0,     # official album > single/EP > compilation, live, soundtrack, ...
+    "original": 0.25,   # earliest release in its release group (the original pressing, not a reissue)
+    "has_album": 1.0,   # without an album the file can't be organized
+}
+DURATION_TOLERANCE_SECONDS = 15.0 # a length this far off scores 0
+DEMOTED_SECONDARY_TYPES = {"compilation", "live", "soundtrack", "remix", "dj-mix", "mixtape/street", "demo"}
+DEMOTED_STATUSES = {"bootleg", "promotion", "pseudo-release"}
+
+MUSICBRAINZ_SEARCH_LIMIT = 10
+
+
+def _key(text):
+    return re.sub(r"[\W_]+", "", str(text)).casefold() if text else ""
+
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def _track_position(value):
+    match = re.match(r"\s*(\d+)", str(value)) if value is not None else None
+    return int(match.group(1)) if match else None
+
+
+def _year(date):
+    match = re.match(r"(\d{4})", str(date)) if date else None
+    return match.group(1) if match else None
+
+
+def _release_feature(candidate):
+    status = (candidate.get('status') or "").lower()
+    primary_type = (candidate.get('primary_type') or "").lower()
+    secondary_types = {t.lower() for t in candidate.get('secondary_types') or ()}
+    if status in DEMOTED_STATUSES or secondary_types & DEMOTED_SECONDARY_TYPES:
+        return 0.0
+    if primary_type == "album":
+        return 1.0
+    if primary_type in ("single", "ep"):
+        return 0.6
+    return 0.4 # unknown or "other"
+
+
+def rank_candidates(candidates, hints=None):
+    """
+    Scores every candidate in one pass and returns [(score, candidate)], best first.
+    hints: what is known about the file, any of duration (seconds), artist, title, album, tracknumber.
+    Hints that are missing add nothing to any candidate.
+    """
+    hints = hints or {}
+    duration = hints.get('duration')
+    artist_key = llmhandler.normalize_artist_key(hints.get('artist'))
+    title_key, album_key = _key(hints.get('title')), _key(hints.get('album'))
+    position = _track_position(hints.get('tracknumber'))
+
+    groups = [candidate.get('release_group_id') or candidate.get('mb_recording_id') for candidate in candidates]
+    earliest_years = {}
+    for group, candidate in zip(groups, candidates):
+        year = candidate.get('year')
+        if year and (group not in earliest_years or year < earliest_years[group]):
+            earliest_years[group] = year
+
+    ranked = []
+    for group, candidate in zip(groups, candidates):
+        features = {
+            "source": candidate.get('source_score') or 0.0,
+            "release": _release_feature(candidate),
+            "has_album": 1.0 if candidate.get('album') else 0.0,
+            "original": 1.0 if candidate.get('year') and candidate['year'] == earliest_years.get(group) else 0.0,
+        }
+        if duration:
+            candidate_duration = candidate.get('duration')
+            features["duration"] = (max(0.0, 1.0 - abs(candidate_duration - duration) / DURATION_TOLERANCE_SECONDS)
+                                    if candidate_duration else 0.5)
+        if artist_key:
+            features["artist"] = _similarity(artist_key, llmhandler.normalize_artist_key(candidate.get('artist')))
+        if title_key:
+            features["title"] = _similarity(title_key, _key(candidate.get('title')))
+        if album_key:
+            features["album"] = _similarity(album_key, _key(candidate.get('album')))
+        if position is not None:
+            features["tracknumber"] = 1.0 if _track_position(candidate.get('tracknumber')) == position else 0.0
+        ranked.append((sum(WEIGHTS[name] * value for name, value in features.items()), candidate))
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return ranked
+
+
+def best_candidate(candidates, hints=None):
+    """Returns (candidate, score) for the top-ranked candidate, or (None, None) if there are none."""
+    ranked = rank_candidates(candidates, hints)
+    if not ranked:
+        return None, None
+    score, candidate = ranked[0]
+    return candidate, score
+
+
+# --- AcoustID ---
+
+def _acoustid_artist(item):
+    artists = item.get('artists') or []
+    return "".join(artist.get('name', "") + (artist.get('joinphrase') or "") for artist in artists) or None
+
+
+def _acoustid_release_candidate(base, release, group=None):
+    group = group or {}
+    tracknumber = None
+    for medium in release.get('mediums') or []:
+        for track in medium.get('tracks') or []: # only this recording's track(s) are listed
+            tracknumber = track.get('position')
+            break
+        if tracknumber is not None:
+            break
+    date = release.get('date') or {}
+    return dict(
+        base,
+        album=release.get('title') or group.get('title'),
+        tracknumber=str(tracknumber) if tracknumber is not None else None,
+        year=str(date['year']) if isinstance(date, dict) and date.get('year') else None,
+        status=release.get('status'),
+        primary_type=group.get('type'),
+        secondary_types=tuple(group.get('secondarytypes') or ()),
+        release_group_id=group.get('id'),
+    )
+
+
+def acoustid_candidates(response):
+    """
+    Flattens an acoustid.lookup() answer (results[].recordings[], with releases and/or releasegroups[].releases)
+    into one candidate per (recording, release). Recordings without releases give one candidate with no album.
+    """
+    candidates = []
+    if not isinstance(response, dict):
+        return candidates
+    for result in response.get('results') or []:
+        score = result.get('score') or 0.0
+        for recording in result.get('recordings') or []:
+            if not recording.get('title'):
+                continue
+            base = {
+                "artist": _acoustid_artist(recording),
+                "title": recording['title'],
+                "album": None,
+                "tracknumber": None,
+                "year": None,
+                "mb_recording_id": recording.get('id'),
+                "duration": recording.get('duration'),
+                "source_score": score,
+            }
+            seen_releases = set()
+            release_candidates = []
+            for group in recording.get('releasegroups') or []:
+                for release in group.get('releases') or [{}]:
+                    seen_releases.add(release.get('id'))
+                    release_candidates.append(_acoustid_release_candidate(base, release, group))
+            for release in recording.get('releases') or []:
+                if release.get('id') not in seen_releases:
+                    release_candidates.append(_acoustid_release_candidate(base, release))
+            candidates.extend(release_candidates or [base])
+    return candidates
+
+
+# --- MusicBrainz ---
+
+def musicbrainz_candidates(search_result):
+    """Flattens a musicbrainzngs.search_recordings() answer into one candidate per (recording, release)."""
+    candidates = []
+    for recording in (search_result or {}).get('recording-list') or []:
+        if not recording.get('title'):
+            continue
+        length = recording.get('length')
+        base = {
+            "artist": recording.get('artist-credit-phrase'),
+            "title": recording['title'],
+            "album": None,
+            "tracknumber": None,
+            "year": None,
+            "mb_recording_id": recording.get('id'),
+            "duration": int(length) / 1000.0 if str(length or "").isdigit() else None,
+            "source_score": int(recording.get('ext:score', 0) or 0) / 100.0,
+        }
+        releases = recording.get('release-list') or []
+        for release in releases:
+            group = release.get('release-group') or {}
+            tracknumber = None
+            for medium in release.get('medium-list') or []:
+                for track in medium.get('track-list') or []: # search results list only this recording's track
+                    tracknumber = track.get('number') or track.get('position')
+                    break
+                if tracknumber is not None:
+                    break
+            candidates.append(dict(
+                base,
+                album=release.get('title'),
+                tracknumber=str(tracknumber) if tracknumber is not None else None,
+                year=_year(release.get('date')),
+                status=release.get('status'),
+                primary_type=group.get('primary-type') or group.get('type'),
+                secondary_types=tuple(group.get('secondary-type-list') or ()),
+                release_group_id=group.get('id'),
+            ))
+        if not releases:
+            candidates.append(base)
+    return candidates
@@ -0,0 +1,156 @@
+import os
+import re
+import csv
+import json
+import html
+
+import handlers.file_handler as filehandler
+import handlers.log_handler as loghandler
+
+# Google Takeout exports the library metadata next to the audio:
+#   Google Play Music: one CSV per track (Tracks/<Title>.csv, next to <Title>.mp3) with
+#                      Title, Album, Artist, Duration (ms), Rating, Play Count, Removed
+#   YouTube Music:     music library songs.csv with Song Title, Album Title, Artist Name 1, ...
+# Values are HTML-escaped ("&amp;", "&#39;"). JSON exports with the same field names are read too.
+
+TITLE_COLUMNS = ("Title", "Song Title", "title", "songTitle")
+ALBUM_COLUMNS = ("Album", "Album Title", "album", "albumTitle")
+ARTIST_COLUMNS = ("Artist", "Artist Name 1", "Album Artist", "artist", "artistName")
+DURATION_MS_COLUMNS = ("Duration (ms)", "durationMs", "duration_ms")
+
+# A file's length must be within this many seconds of the Takeout duration to match
+DURATION_TOLERANCE_SECONDS = 3.0
+
+
+def normalize_key(name):
+    """Filename/title -> lookup key. Drops Takeout's "(1)" copy suffixes, case and punctuation ('_' included, Takeout uses it for illegal characters)."""
+    name = html.unescape(name)
+    name = re.sub(r"\(\d+\)\s*$", "", name)
+    return re.sub(r"[\W_]+", " ", name).casefold().strip()
+
+
+def _first(row, columns):
+    for column in columns:
+        value = row.get(column)
+        if value:
+            return html.unescape(str(value)).strip()
+    return None
+
+
+class TakeoutIndex:
+    """
+    In-memory index of Takeout metadata, keyed by normalized name. Each entry is a compact
+    (artist, title, album, duration_seconds) tuple; duration_seconds is None when the export has none.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.row_count = 0
+
+    def __len__(self):
+        return self.row_count
+
+    def _add_key(self, key, entry):
+        if key:
+            entries = self.entries.setdefault(key, [])
+            if entry not in entries:
+                entries.append(entry)
+
+    def add_row(self, row):
+        """Adds one export row. Returns the entry, or None if the row has no title/artist or was removed from the library."""
+        title = _first(row, TITLE_COLUMNS)
+        artist = _first(row, ARTIST_COLUMNS)
+        if not title or not artist or str(row.get("Removed", "")).lower() == "true":
+            return None
+        duration_ms = _first(row, DURATION_MS_COLUMNS)
+        try:
+            duration = int(duration_ms) / 1000.0 if duration_ms else None
+        except ValueError:
+            duration = None
+        entry = (artist, title, _first(row, ALBUM_COLUMNS), duration)
+
+        # Takeout names the audio after the title, sometimes prefixed with the artist
+        self._add_key(normalize_key(title), entry)
+        self._add_key(normalize_key(f"{artist} - {title}"), entry)
+        self.row_count += 1
+        return entry
+
+    def _load_csv(self, path):
+        with open(path, newline='', encoding='utf-8-sig', errors='replace') as f:
+            added = [entry for entry in map(self.add_row, csv.DictReader(f)) if entry]
+        # Play Music writes one CSV per track, named like its audio file
+        if len(added) == 1:
+            self._add_key(normalize_key(os.path.splitext(os.path.basename(path))[0]), added[0])
+
+    def _load_json(self, path):
+        # The stdlib has no streaming JSON parser; Takeout JSON files are per-library, not per-track, so one load per file
+        with open(path, encoding='utf-8-sig', errors='replace') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = next((value for value in data.values() if isinstance(value, list)), [data])
+        for row in data:
+            if isinstance(row, dict):
+                self.add_row(row)
+
+    def load(self, metadata_root, skip_dirs=(), skip_files=()):
+        """
+        Walks metadata_root for Takeout .csv/.json files and indexes their rows one file at a time.
+        skip_dirs (e.g. the organized library, when it lives inside the Takeout folder) are not walked,
+        and skip_files (e.g. this tool's own CSV outputs) are not read.
+        """
+        skip_dirs = {os.path.abspath(d) for d in skip_dirs}
+        skip_files = {os.path.abspath(f) for f in skip_files}
+        for root, dirs, files in os.walk(metadata_root):
+            dirs[:] = [d for d in dirs if not d.startswith('.') and os.path.abspath(os.path.join(root, d)) not in skip_dirs]
+            for file in files:
+                path = os.path.join(root, file)
+                if os.path.abspath(path) in skip_files:
+                    continue
+                try:
+                    if file.lower().endswith('.csv'):
+                        self._load_csv(path)
+                    elif file.lower().endswith('.json'):
+                        self._load_json(path)
+                except (OSError, csv.Error, ValueError) as e:
+                    loghandler.warning("takeout", "Skipping unreadable metadata file '%s': %s", path, e)
+        return self
+
+    def lookup(self, filepath):
+        """
+        Finds the Takeout entry for an audio file by its name. When the name matches several songs,
+        or the export has a duration, the file's length (read from its headers) has to agree.
+        Returns a metadata dict, or None if there is no single match.
+        """
+        filename_no_ext = os.path.splitext(os.path.basename(filepath))[0]
+        candidates = None
+        for key in (normalize_key(filename_no_ext), normalize_key(re.sub(r"^\s*\d+\s*[-._ ]+\s*", "", filename_no_ext))):
+            candidates = self.entries.get(key)
+            if candidates:
+                break
+        if not candidates:
+            return None
+
+        if len(candidates) > 1 or candidates[0][3] is not None:
+            file_duration = filehandler.get_audio_duration(filepath)
+            if file_duration is not None:
+                candidates = [entry for entry in candidates if entry[3] is None or abs(entry[3] - file_duration) <= DURATION_TOLERANCE_SECONDS]
+        identities = {entry[:3] for entry in candidates}
+        if len(identities) != 1:
+            return None
+
+        artist, title, album = identities.pop()
+        return {'artist': artist, 'title': title, 'album': album, 'source_comment': "Google Takeout"}
+
+
+def takeout_stage(records, takeout_index):
+    """Pipeline stage (right after tags): settles records from the Takeout export. No decoding and no network calls."""
+    for record in records:
+        if record.needs_lookup:
+            takeout_meta = takeout_index.lookup(record.filepath)
+            if takeout_meta and takeout_meta.get('album'):
+                # Keep what the tags know that the export doesn't
+                takeout_meta['tracknumber'] = record.tags.get('tracknumber')
+                takeout_meta['year'] = record.tags.get('year')
+                record.settle(takeout_meta, "Google Takeout")
+                loghandler.info("takeout", "Artist: %s, Title: %s, Album: %s", record.artist, record.title, record.album, file=record.filepath, outcome="settled")
+        yield record
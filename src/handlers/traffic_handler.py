@@ -0,0 +1,357 @@
+from dotenv import load_dotenv
+import os
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+import handlers.log_handler as loghandler
+
+load_dotenv()
+
+
+def _env_number(name, default, cast=int, minimum=0):
+    """Reads a number from the environment; a value that doesn't parse or is below minimum falls back to default."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        number = cast(value)
+        if number >= minimum:
+            return number
+    except ValueError:
+        pass
+    loghandler.warning("traffic", "Invalid %s '%s'. Falling back to %s.", name, value, default)
+    return default
+
+
+# Published client limits per service. Rates are requests per second.
+#   AcoustID:    3 requests/second
+#   MusicBrainz: 1 request/second (per source IP)
+#   OpenAI:      depends on the account tier, so it is set from OPENAI_REQUESTS_PER_MINUTE
+SERVICE_LIMITS = {
+    "acoustid": {"rate": 3.0, "burst": 3, "max_concurrency": 3},
+    "musicbrainz": {"rate": 1.0, "burst": 1, "max_concurrency": 1},
+    "openai": {"rate": _env_number("OPENAI_REQUESTS_PER_MINUTE", 500.0, float, minimum=1) / 60.0, "burst": 5, "max_concurrency": 8},
+}
+
+MAX_RETRIES = _env_number("SERVICE_MAX_RETRIES", 4)
+BREAKER_FAILURE_THRESHOLD = _env_number("SERVICE_BREAKER_FAILURES", 5, minimum=1)
+BREAKER_RESET_SECONDS = _env_number("SERVICE_BREAKER_RESET_SECONDS", 60.0, float)
+
+RETRYABLE_HTTP_STATUSES = (429, 500, 502, 503, 504)
+# AcoustID error codes: 5 internal error, 13 service unavailable, 14 too many requests
+RETRYABLE_ACOUSTID_CODES = (5, 13, 14)
+RETRYABLE_ERROR_NAMES = ("Timeout", "Connection", "NetworkError")
+# How often a call waiting for a concurrency slot checks its cancel_event
+CANCEL_POLL_SECONDS = 0.1
+
+
+class ServiceUnavailableError(Exception):
+    """
+    The service could not answer right now (circuit open or retries exhausted).
+    Files that hit this should be left in place and retried on a later run, not sent to 'reviewed'.
+    """
+
+
+class RequestCancelled(Exception):
+    """The caller set the call's cancel_event while it was still waiting for a slot or a token; nothing was sent."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket. acquire() blocks until a token is available."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, cancel_event=None):
+        """Returns True once a token is taken, or False (without one) if cancel_event is set while waiting."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.last_refill = now
+                    wait = self.paused_until - now
+            if cancel_event is None:
+                time.sleep(wait)
+            elif cancel_event.wait(wait):
+                return False
+
+    def pause(self, seconds):
+        """Stops handing out tokens for a while, e.g. when the service sends Retry-After."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class CircuitBreaker:
+    """
+    closed    - calls go through
+    open      - calls fail fast with ServiceUnavailableError until reset_seconds pass
+    half_open - one trial call is let through; success closes the breaker, failure opens it again
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self.trial_in_flight = False
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def release_trial(self):
+        """Frees the half-open trial without an outcome, e.g. when the trial call was cancelled before it was sent."""
+        with self.lock:
+            if self.state == "half_open":
+                self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                loghandler.info("traffic", "%s: service recovered. Circuit closed.", self.name, service=self.name, outcome="recovered")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    loghandler.warning("traffic", "%s: %d consecutive failures. Pausing calls for %.0fs.", self.name, self.consecutive_failures, self.reset_seconds, service=self.name, outcome="circuit_open")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class ConcurrencyTuner:
+    """
+    Limits in-flight calls and adjusts the limit from what it observes (additive increase,
+    multiplicative decrease): every `window` calls, the limit is halved if the error rate or
+    average latency got worse, and raised by one if the window was healthy.
+    """
+
+    def __init__(self, name, max_concurrency, window=20, max_error_rate=0.1, latency_tolerance=2.0):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.latency_tolerance = latency_tolerance
+        self.baseline_latency = None
+        self.in_flight = 0
+        self.samples = []
+        self.condition = threading.Condition()
+
+    def acquire(self, cancel_event=None):
+        """Returns True once a slot is taken, or False (without one) if cancel_event is set while waiting."""
+        with self.condition:
+            while self.in_flight >= self.limit:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                self.condition.wait(CANCEL_POLL_SECONDS if cancel_event is not None else None)
+            self.in_flight += 1
+            return True
+
+    def saturated(self):
+        with self.condition:
+            return self.in_flight >= self.limit
+
+    def release(self, latency=None, ok=True):
+        """Frees a slot and records the call; latency None frees it without a sample (nothing was sent)."""
+        with self.condition:
+            self.in_flight -= 1
+            if latency is not None:
+                self.samples.append((latency, ok))
+                if len(self.samples) >= self.window:
+                    self._retune()
+            self.condition.notify_all()
+
+    def _retune(self):
+        error_rate = sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+        ok_latencies = [latency for latency, ok in self.samples if ok]
+        avg_latency = sum(ok_latencies) / len(ok_latencies) if ok_latencies else None
+        self.samples = []
+
+        if avg_latency is not None and (self.baseline_latency is None or avg_latency < self.baseline_latency):
+            self.baseline_latency = avg_latency
+        slow = avg_latency is not None and avg_latency > self.baseline_latency * self.latency_tolerance
+
+        old_limit = self.limit
+        if error_rate > self.max_error_rate or slow:
+            self.limit = max(1, self.limit // 2)
+        elif self.limit < self.max_concurrency:
+            self.limit += 1
+        if self.limit != old_limit:
+            loghandler.info("traffic", "%s: concurrency %d -> %d (errors %.0f%%, avg latency %.2fs)", self.name, old_limit, self.limit, error_rate * 100, avg_latency or 0, service=self.name)
+
+
+class ServiceController:
+    """Rate limit, concurrency limit, retry/backoff and circuit breaker for one external service."""
+
+    def __init__(self, name, rate, burst=1, max_concurrency=1, max_retries=MAX_RETRIES,
+                 base_delay=1.0, max_delay=60.0):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(name, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+        self.tuner = ConcurrencyTuner(name, max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_saturated(self):
+        """True if every concurrency slot is in use, so another request would only queue behind them."""
+        return self.tuner.saturated()
+
+    def call(self, fn, *args, cancel_event=None, **kwargs):
+        """
+        Calls fn(*args, **kwargs) under this service's limits.
+        If cancel_event is set while the call still waits for a slot or a token, it gives up with RequestCancelled
+        without having used either.
+        Retryable errors (429/5xx, timeouts, connection errors) are retried with exponential backoff,
+        honoring Retry-After up to max_delay. Other errors are raised as-is.
+        Raises ServiceUnavailableError when the circuit is open, retries are exhausted or the service
+        asks for a longer wait than max_delay.
+        """
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow_request():
+                raise ServiceUnavailableError(f"{self.name} is paused after repeated failures")
+
+            outcome_recorded = False
+            try:
+                if not self.tuner.acquire(cancel_event):
+                    raise RequestCancelled(self.name)
+                if not self.bucket.acquire(cancel_event):
+                    self.tuner.release()
+                    raise RequestCancelled(self.name)
+                start = time.monotonic()
+                try:
+                    result = fn(*args, **kwargs)
+                except Exception as e:
+                    self.tuner.release(time.monotonic() - start, ok=False)
+                    outcome_recorded = True
+                    if not is_retryable(e):
+                        self.breaker.record_success() # the service answered; the request itself was bad
+                        raise
+                    self.breaker.record_failure()
+                    if self.breaker.state == "open":
+                        raise ServiceUnavailableError(f"{self.name} is paused after repeated failures: {e}") from e
+                    if attempt >= self.max_retries:
+                        raise ServiceUnavailableError(f"{self.name} failed after {attempt + 1} attempts: {e}") from e
+
+                    retry_after = get_retry_after(e)
+                    if retry_after is not None and retry_after > self.max_delay:
+                        # Longer than any backoff we'd wait: defer the file instead of holding the worker (and the service) that long
+                        self.bucket.pause(self.max_delay)
+                        raise ServiceUnavailableError(f"{self.name} asked to wait {retry_after:.0f}s: {e}") from e
+                    if retry_after is not None:
+                        self.bucket.pause(retry_after)
+                        delay = retry_after
+                    else:
+                        delay = min(self.max_delay, self.base_delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                    loghandler.warning("traffic", "%s: %s: %s. Retry %d/%d in %.1fs.", self.name, type(e).__name__, e, attempt + 1, self.max_retries, delay, service=self.name, outcome="retry")
+                    time.sleep(delay)
+                    continue
+
+                self.tuner.release(time.monotonic() - start, ok=True)
+                outcome_recorded = True
+                self.breaker.record_success()
+                return result
+            finally:
+                if not outcome_recorded:
+                    # Cancelled (or interrupted) before an answer: a half-open trial must not stay taken, or the breaker never closes again
+                    self.breaker.release_trial()
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(service_name):
+    """Returns the shared controller for 'acoustid', 'musicbrainz' or 'openai'."""
+    with _controllers_lock:
+        if service_name not in _controllers:
+            limits = SERVICE_LIMITS[service_name]
+            _controllers[service_name] = ServiceController(
+                service_name, limits["rate"], limits["burst"], limits["max_concurrency"]
+            )
+        return _controllers[service_name]
+
+
+def call(service_name, fn, *args, **kwargs):
+    """Shortcut for get_controller(service_name).call(fn, *args, **kwargs)."""
+    return get_controller(service_name).call(fn, *args, **kwargs)
+
+
+def _get_status_code(exc):
+    for holder in (exc, getattr(exc, "response", None), getattr(exc, "cause", None)):
+        if holder is None:
+            continue
+        for attr in ("status_code", "status", "code"):
+            value = getattr(holder, attr, None)
+            if isinstance(value, int) and 100 <= value < 600:
+                return value
+    return None
+
+
+def is_retryable(exc):
+    """Decides from the exception alone whether the call is worth retrying."""
+    status = _get_status_code(exc)
+    if status is not None:
+        return status in RETRYABLE_HTTP_STATUSES
+
+    # pyacoustid's WebServiceError carries the AcoustID error code (or none for transport errors)
+    if type(exc).__module__ == "acoustid" and type(exc).__name__ == "WebServiceError":
+        code = getattr(exc, "code", None)
+        return code is None or code in RETRYABLE_ACOUSTID_CODES
+
+    for cls in type(exc).__mro__:
+        if any(name in cls.__name__ for name in RETRYABLE_ERROR_NAMES):
+            return True
+    return isinstance(exc, (TimeoutError, ConnectionError))
+
+
+def get_retry_after(exc):
+    """Reads a Retry-After header (seconds or HTTP date) from the error's HTTP response, if any."""
+    for holder in (getattr(exc, "response", None), getattr(exc, "cause", None), exc):
+        headers = getattr(holder, "headers", None)
+        if not headers:
+            continue
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        if not value:
+            continue
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return None
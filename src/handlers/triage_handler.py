@@ -0,0 +1,157 @@
+import handlers.file_handler as filehandler
+import handlers.log_handler as loghandler
+
+# Cheap corrupt-file check that runs before anything opens the audio. fpcalc grinds on broken MP3s until its
+# timeout, so files that fail here skip the tag, fingerprint and lookup stages and are quarantined instead.
+# Only the frame headers are read (a few KB per file); nothing is decoded.
+
+TRIAGE_ACTIONS = ("quarantine", "reviewed")
+
+# Reason codes
+UNREADABLE = "unreadable"           # could not be opened or read
+EMPTY = "empty"                     # no audio payload between the tags
+NO_SYNC = "no_sync"                 # no MPEG frame header near the start of the payload
+BAD_FRAME_CHAIN = "bad_frame_chain" # the first frames don't follow one another
+TRUNCATED = "truncated"             # the Xing/VBRI header promises more audio than the file holds
+ZERO_FILLED = "zero_filled"         # the end of the payload is all zero bytes (incomplete download)
+TOO_SHORT = "too_short"             # estimated duration is below MIN_DURATION_SECONDS
+
+SYNC_SEARCH_BYTES = 64 * 1024   # how far into the payload to look for the first frame
+CHAINED_FRAMES = 4              # consecutive frames that must parse
+TAIL_CHECK_BYTES = 16 * 1024
+TRUNCATION_TOLERANCE = 0.9      # payload may be this fraction of the Xing/VBRI byte count before it counts as truncated
+MIN_DURATION_SECONDS = 1.0
+
+# Bitrates in kbps by [version is MPEG-1][layer], indexed by the 4-bit bitrate index (0 = free format, 15 = invalid)
+_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by the 2-bit version field (0 = MPEG-2.5, 2 = MPEG-2, 3 = MPEG-1)
+_SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+
+def parse_frame_header(header):
+    """
+    Parses a 4 byte MPEG audio frame header.
+    Returns (frame_length, samples_per_frame, sample_rate, bitrate_kbps, is_mpeg1, is_mono) or None if it isn't one.
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (header[1] >> 3) & 0x03
+    layer = 4 - ((header[1] >> 1) & 0x03) # 1, 2, 3 (4 = reserved)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    is_mpeg1 = version_bits == 3
+    bitrate = _BITRATES[(is_mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version_bits][sample_rate_index]
+    padding = (header[2] >> 1) & 0x01
+    if layer == 1:
+        samples_per_frame = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples_per_frame = 1152 if (layer == 2 or is_mpeg1) else 576
+        frame_length = samples_per_frame // 8 * bitrate // sample_rate + padding
+    return frame_length, samples_per_frame, sample_rate, bitrate // 1000, is_mpeg1, (header[3] >> 6) == 3
+
+
+def _vbr_header(frame, is_mpeg1, is_mono):
+    """Reads the Xing/Info or VBRI header of the first frame. Returns (frame_count, byte_count), either may be None."""
+    xing_offset = 4 + ((17 if is_mono else 32) if is_mpeg1 else (9 if is_mono else 17))
+    tag = frame[xing_offset:xing_offset + 4]
+    if tag in (b'Xing', b'Info'):
+        flags = int.from_bytes(frame[xing_offset + 4:xing_offset + 8], 'big')
+        position = xing_offset + 8
+        frame_count = byte_count = None
+        if flags & 0x1:
+            frame_count = int.from_bytes(frame[position:position + 4], 'big')
+            position += 4
+        if flags & 0x2:
+            byte_count = int.from_bytes(frame[position:position + 4], 'big')
+        return frame_count, byte_count
+    if frame[36:40] == b'VBRI':
+        return int.from_bytes(frame[50:54], 'big'), int.from_bytes(frame[46:50], 'big')
+    return None, None
+
+
+def _frame_chain_end(head, position):
+    """Follows CHAINED_FRAMES frames from position. Returns None if they chain up, else the offset where one is missing."""
+    for _ in range(CHAINED_FRAMES):
+        frame = parse_frame_header(head[position:position + 4])
+        if frame is None:
+            if position + 4 > len(head):
+                return None # a very short file ran out of frames; the duration check catches it
+            return position
+        position += frame[0]
+    return None
+
+
+def triage_file(filepath):
+    """
+    Checks the first frame headers and the estimated duration against the file size.
+    Returns (reason_code, detail), or (None, None) if the file looks playable.
+    """
+    start, end = filehandler.get_audio_payload_bounds(filepath)
+    if start is None:
+        return UNREADABLE, "could not read the file"
+    payload_size = end - start
+    if payload_size <= 0:
+        return EMPTY, "no audio between the tags"
+
+    try:
+        with open(filepath, 'rb') as f:
+            f.seek(start)
+            head = f.read(min(payload_size, SYNC_SEARCH_BYTES + 8192))
+
+            # First frame: a header whose successors chain up (a lone 0xFFE match in junk data is common)
+            first_offset = frame = None
+            broken_chain_at = None
+            position = head.find(b'\xff')
+            while 0 <= position < SYNC_SEARCH_BYTES:
+                frame = parse_frame_header(head[position:position + 4])
+                if frame:
+                    chain_end = _frame_chain_end(head, position)
+                    if chain_end is None:
+                        first_offset = position
+                        break
+                    if broken_chain_at is None:
+                        broken_chain_at = (position, chain_end)
+                position = head.find(b'\xff', position + 1)
+            if first_offset is None:
+                if broken_chain_at:
+                    return BAD_FRAME_CHAIN, f"no frame header at payload offset {broken_chain_at[1]} (after the one at {broken_chain_at[0]})"
+                return NO_SYNC, f"no MPEG frame header in the first {SYNC_SEARCH_BYTES // 1024} KB"
+
+            frame_length, samples_per_frame, sample_rate, bitrate, is_mpeg1, is_mono = frame
+            audio_bytes = payload_size - first_offset
+            frame_count, byte_count = _vbr_header(head[first_offset:first_offset + frame_length], is_mpeg1, is_mono)
+            if byte_count and audio_bytes < byte_count * TRUNCATION_TOLERANCE:
+                return TRUNCATED, f"{audio_bytes} of {byte_count} audio bytes present"
+            if frame_count:
+                duration = frame_count * samples_per_frame / sample_rate
+            else:
+                duration = audio_bytes * 8 / (bitrate * 1000) # constant bitrate estimate
+            if duration < MIN_DURATION_SECONDS:
+                return TOO_SHORT, f"estimated duration {duration:.2f}s"
+
+            tail_size = min(TAIL_CHECK_BYTES, audio_bytes)
+            f.seek(end - tail_size)
+            if not f.read(tail_size).strip(b'\x00'):
+                return ZERO_FILLED, f"last {tail_size} bytes of audio are zero"
+    except OSError as e:
+        return UNREADABLE, str(e)
+    return None, None
+
+
+def record_quarantine(list_path, filepath, reason):
+    """Appends a rejected file to the quarantine list (CSV: path, reason), unless an earlier run already listed it."""
+    try:
+        filehandler.append_csv_row(list_path, ["path", "reason"], [filepath, reason], unique=True)
+    except OSError as e:
+        loghandler.error("triage", "Could not write quarantine list '%s': %s", list_path, e)
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+# The handlers are imported the way app.py imports them, with src/ on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+# llm_handler builds its OpenAI client at import time; no request is made by these tests
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, stereo, no padding: 417 byte frames of 1152 samples
+FRAME_HEADER = b'\xff\xfb\x90\x00'
+FRAME_LENGTH = 417
+
+
+def id3v2_tag(body=b'\x00' * 100):
+    size = len(body)
+    syncsafe = bytes([(size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f])
+    return b'ID3\x03\x00\x00' + syncsafe + body
+
+
+def id3v1_tag(title=b'Title'):
+    return (b'TAG' + title).ljust(128, b'\x00')
+
+
+def mpeg_frames(count, fill=b'\x55', xing=None):
+    """count CBR frames; xing=(frame_count, byte_count) puts a Xing header in the first one."""
+    frames = []
+    for i in range(count):
+        body = bytearray(fill * (FRAME_LENGTH - 4))
+        if i == 0 and xing:
+            frame_count, byte_count = xing
+            body[32:48] = b'Xing' + (3).to_bytes(4, 'big') + frame_count.to_bytes(4, 'big') + byte_count.to_bytes(4, 'big')
+        frames.append(FRAME_HEADER + bytes(body))
+    return b''.join(frames)
+
+
+@pytest.fixture
+def make_file(tmp_path):
+    """Writes a file under tmp_path from its parts and returns its path."""
+    def make(name, *parts):
+        path = tmp_path / name
+        path.write_bytes(b''.join(parts))
+        return str(path)
+    return make
@@ -0,0 +1,32 @@
+import handlers.cluster_handler as clusterhandler
+
+
+def clusters_of(names):
+    keys = [clusterhandler.cluster_key(name) for name in names]
+    return sorted(sorted(names[i] for i in cluster) for cluster in clusterhandler.cluster_names(keys))
+
+
+def test_cluster_key_drops_copy_suffix_and_case():
+    assert clusterhandler.cluster_key("Song (1)") == clusterhandler.cluster_key("song") == "song"
+
+
+def test_copies_of_one_name_are_merged():
+    assert clusters_of(["Song (1)", "Song(2)", "song_", "Song"]) == [["Song", "Song (1)", "Song(2)", "song_"]]
+
+
+def test_different_numbers_are_not_merged():
+    assert clusters_of(["Symphony 5", "Symphony 6"]) == [["Symphony 5"], ["Symphony 6"]]
+
+
+def test_different_names_are_not_merged():
+    assert clusters_of(["Yellow Submarine", "Hey Jude"]) == [["Hey Jude"], ["Yellow Submarine"]]
+
+
+def test_similar_names_are_merged():
+    assert clusters_of(["Bohemian Rhapsody", "Bohemian Rhapsody!"]) == [["Bohemian Rhapsody", "Bohemian Rhapsody!"]]
+
+
+def test_clusters_index_every_key_once():
+    keys = ["a b c", "a b c", "x y z", "a b c d"]
+    indexes = sorted(i for cluster in clusterhandler.cluster_names(keys) for i in cluster)
+    assert indexes == list(range(len(keys)))
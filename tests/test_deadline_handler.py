@@ -0,0 +1,192 @@
+import time
+import threading
+from concurrent.futures import ALL_COMPLETED
+
+import pytest
+
+import handlers.traffic_handler as traffichandler
+import handlers.deadline_handler as deadlinehandler
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """A fresh service with no latency history; its name is returned."""
+    monkeypatch.setitem(traffichandler.SERVICE_LIMITS, "test", {"rate": 1000.0, "burst": 10, "max_concurrency": 4})
+    monkeypatch.setitem(deadlinehandler.REQUEST_TIMEOUTS, "test", 5.0)
+    monkeypatch.setattr(deadlinehandler, "HEDGING_ENABLED", True)
+    yield "test"
+    traffichandler._controllers.pop("test", None)
+    deadlinehandler._trackers.pop("test", None)
+
+
+def learn_latency(service_name, seconds=0.01):
+    """Gives the service enough samples for a p95, so slower requests are hedged."""
+    for _ in range(deadlinehandler.HEDGE_MIN_SAMPLES):
+        deadlinehandler.get_tracker(service_name).add(seconds)
+
+
+def slow_first_call(first_seconds, answers=("first", "hedge")):
+    """The first call takes first_seconds, later ones answer right away; returns (fn, calls)."""
+    calls = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            calls.append(time.monotonic())
+            number = len(calls)
+        if number == 1:
+            time.sleep(first_seconds)
+        return answers[min(number, len(answers)) - 1]
+    return fn, calls
+
+
+# --- Deadline ---
+
+def test_deadline_expires():
+    deadline = deadlinehandler.Deadline(0.05)
+    assert not deadline.expired and 0 < deadline.remaining() <= 0.05
+    deadline.check("the lookup")
+    time.sleep(0.06)
+    assert deadline.expired and deadline.remaining() == 0.0
+    with pytest.raises(deadlinehandler.DeadlineExceeded):
+        deadline.check("the lookup")
+
+
+def test_deadline_exceeded_defers_the_file():
+    assert issubclass(deadlinehandler.DeadlineExceeded, traffichandler.ServiceUnavailableError)
+    assert deadlinehandler.defer_reason(deadlinehandler.DeadlineExceeded()) == deadlinehandler.DEFERRED_DEADLINE
+    assert deadlinehandler.defer_reason(traffichandler.ServiceUnavailableError()) == deadlinehandler.DEFERRED_UNAVAILABLE
+
+
+def test_timeout_for():
+    assert deadlinehandler.timeout_for(None, "acoustid") == deadlinehandler.REQUEST_TIMEOUTS["acoustid"]
+    assert deadlinehandler.timeout_for(deadlinehandler.Deadline(300), "acoustid") == deadlinehandler.REQUEST_TIMEOUTS["acoustid"]
+    assert 4 < deadlinehandler.timeout_for(deadlinehandler.Deadline(5), "acoustid") <= 5
+    assert deadlinehandler.timeout_for(deadlinehandler.Deadline(0), "acoustid") == deadlinehandler.MIN_TIMEOUT_SECONDS
+
+
+def test_latency_p95_needs_enough_samples():
+    tracker = deadlinehandler.LatencyTracker()
+    for i in range(deadlinehandler.HEDGE_MIN_SAMPLES - 1):
+        tracker.add(i)
+    assert tracker.p95() is None
+    tracker.add(100)
+    assert tracker.p95() == 100
+
+
+# --- call ---
+
+def test_call_gives_up_when_the_deadline_passes(service):
+    deadline = deadlinehandler.Deadline(0.1)
+    start = time.monotonic()
+    with pytest.raises(deadlinehandler.DeadlineExceeded):
+        deadlinehandler.call(service, time.sleep, 1.0, deadline=deadline)
+    assert time.monotonic() - start < 0.5
+
+
+def test_call_with_an_expired_deadline_sends_nothing(service):
+    fn, calls = slow_first_call(0)
+    with pytest.raises(deadlinehandler.DeadlineExceeded):
+        deadlinehandler.call(service, fn, deadline=deadlinehandler.Deadline(0))
+    assert calls == []
+
+
+def test_hedge_answers_a_slow_request(service):
+    learn_latency(service)
+    fn, calls = slow_first_call(1.0)
+    start = time.monotonic()
+    assert deadlinehandler.call(service, fn) == "hedge"
+    assert len(calls) == 2 and time.monotonic() - start < 0.5
+
+
+def test_no_hedge_without_latency_history(service):
+    fn, calls = slow_first_call(0.1)
+    assert deadlinehandler.call(service, fn, deadline=deadlinehandler.Deadline(5)) == "first"
+    assert len(calls) == 1
+
+
+def test_no_hedge_for_unhedged_calls(service):
+    learn_latency(service)
+    fn, calls = slow_first_call(0.1)
+    assert deadlinehandler.call(service, fn, hedge=False, deadline=deadlinehandler.Deadline(5)) == "first"
+    assert len(calls) == 1
+
+
+def test_no_hedge_while_the_service_is_saturated(service):
+    learn_latency(service)
+    controller = traffichandler.get_controller(service)
+    controller.tuner.limit = 1
+    fn, calls = slow_first_call(0.2)
+    assert deadlinehandler.call(service, fn) == "first"
+    assert len(calls) == 1
+
+
+def test_hedge_answer_wins_over_a_primary_failing_in_the_same_wait(service, monkeypatch):
+    learn_latency(service)
+    calls = []
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            time.sleep(0.2)
+            raise ValueError("primary failed")
+        return "hedge"
+
+    # once both requests are out, return them together, with the failed one first
+    real_wait = deadlinehandler.wait
+    def wait_for_both(futures, timeout=None, return_when=None):
+        if len(futures) < 2:
+            return real_wait(futures, timeout=timeout, return_when=return_when)
+        done, pending = real_wait(futures, return_when=ALL_COMPLETED)
+        return sorted(done, key=lambda future: future.exception() is None), pending
+    monkeypatch.setattr(deadlinehandler, "wait", wait_for_both)
+
+    assert deadlinehandler.call(service, fn) == "hedge"
+    assert len(calls) == 2
+
+
+def test_failure_is_raised_when_no_request_succeeds(service):
+    learn_latency(service)
+    calls = []
+    hedge_sent = threading.Event()
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            hedge_sent.wait(1.0) # fail only once both requests are out
+        else:
+            hedge_sent.set()
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        deadlinehandler.call(service, fn)
+    assert len(calls) == 2
+
+
+def test_paused_deadline_doesnt_run_out():
+    deadline = deadlinehandler.Deadline(0.05)
+    deadline.pause()
+    time.sleep(0.06)
+    assert not deadline.expired and deadline.remaining() > 0.04
+    deadline.resume()
+    assert not deadline.expired
+    time.sleep(0.06)
+    assert deadline.expired
+
+
+# --- retry queue ---
+
+def test_retry_queue_round_trip(tmp_path):
+    list_path = str(tmp_path / "retry_queue.csv")
+    done, again, gone = (str(tmp_path / name) for name in ("done.mp3", "again.mp3", "gone.mp3"))
+    for path in (done, again):
+        open(path, 'wb').close()
+    deadlinehandler.record_retry(list_path, done, deadlinehandler.DEFERRED_DEADLINE)
+    deadlinehandler.record_retry(list_path, again, deadlinehandler.DEFERRED_DEADLINE)
+    deadlinehandler.record_retry(list_path, gone, deadlinehandler.DEFERRED_UNAVAILABLE)
+    deadlinehandler.record_retry(list_path, again, deadlinehandler.DEFERRED_UNAVAILABLE)
+    assert deadlinehandler.load_retry_queue(list_path) == [done, again]
+
+    deadlinehandler.prune_retry_queue(list_path, {done})
+    with open(list_path, encoding='utf-8') as f:
+        assert f.read().splitlines() == ["path,reason", f"{again},{deadlinehandler.DEFERRED_UNAVAILABLE}"]
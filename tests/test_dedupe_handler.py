@@ -0,0 +1,50 @@
+import handlers.file_handler as filehandler
+import handlers.dedupe_handler as dedupehandler
+
+from conftest import id3v1_tag, id3v2_tag, mpeg_frames
+
+
+def test_payload_bounds_skip_id3v2_and_id3v1(make_file):
+    header, audio = id3v2_tag(), mpeg_frames(10)
+    path = make_file("a.mp3", header, audio, id3v1_tag())
+    assert filehandler.get_audio_payload_bounds(path) == (len(header), len(header) + len(audio))
+
+
+def test_payload_bounds_skip_apev2_footer(make_file):
+    audio = mpeg_frames(10)
+    items = b'\x01' * 40
+    footer = b'APETAGEX' + (2000).to_bytes(4, 'little') + (len(items) + 32).to_bytes(4, 'little') + b'\x00' * 16
+    path = make_file("a.mp3", audio, items, footer)
+    assert filehandler.get_audio_payload_bounds(path) == (0, len(audio))
+
+
+def test_payload_bounds_of_a_missing_file(tmp_path):
+    assert filehandler.get_audio_payload_bounds(str(tmp_path / "missing.mp3")) == (None, None)
+
+
+def test_hash_ignores_tags(make_file):
+    audio = mpeg_frames(10)
+    tagged = make_file("tagged.mp3", id3v2_tag(b'\x01' * 300), audio, id3v1_tag(b'Other'))
+    plain = make_file("plain.mp3", audio)
+    assert dedupehandler.payload_hash(tagged) == dedupehandler.payload_hash(plain)
+    assert dedupehandler.payload_hash(plain) != dedupehandler.payload_hash(make_file("other.mp3", mpeg_frames(10, fill=b'\x66')))
+
+
+def test_hash_of_an_empty_payload_is_none(make_file):
+    path = make_file("tags_only.mp3", id3v2_tag())
+    start, end = filehandler.get_audio_payload_bounds(path)
+    assert start == end
+    assert dedupehandler.hash_audio_payload(path, start, end) is None
+
+
+def test_duplicate_groups(make_file):
+    audio = mpeg_frames(10)
+    first = make_file("1.mp3", audio)
+    copy = make_file("2.mp3", id3v2_tag(), audio)
+    other = make_file("3.mp3", mpeg_frames(10, fill=b'\x66'))
+    assert dedupehandler.find_duplicate_groups([first, copy, other]) == {first: [copy]}
+
+
+def test_tag_only_files_are_not_duplicates(make_file):
+    paths = [make_file(f"{i}.mp3", id3v2_tag()) for i in range(3)]
+    assert dedupehandler.find_duplicate_groups(paths) == {}
@@ -0,0 +1,65 @@
+from mutagen.easyid3 import EasyID3
+
+import handlers.file_handler as filehandler
+
+from conftest import mpeg_frames
+
+
+def never_parse(*args):
+    if args:
+        raise AssertionError("the tags were parsed again")
+    return EasyID3()
+
+
+def tagged_file(make_file, **tags):
+    path = make_file("song.mp3", mpeg_frames(20))
+    audio = EasyID3()
+    audio.update(tags)
+    audio.save(path)
+    return path
+
+
+def test_read_tags(make_file):
+    path = tagged_file(make_file, artist="Artist", title="Song", tracknumber="3/12")
+    metadata, tags = filehandler.read_tags(path)
+    assert metadata == {"artist": "Artist", "title": "Song", "tracknumber": "3"}
+    assert tags["artist"] == ["Artist"]
+
+
+def test_read_tags_without_a_header(make_file):
+    metadata, tags = filehandler.read_tags(make_file("song.mp3", mpeg_frames(20)))
+    assert metadata == {} and len(tags) == 0
+
+
+def test_update_tags_saves_the_tags_it_was_given(make_file, monkeypatch):
+    path = tagged_file(make_file, artist="Artist", title="song")
+    metadata, tags = filehandler.read_tags(path)
+    monkeypatch.setattr(filehandler, "EasyID3", never_parse)
+    assert filehandler.update_tags(path, {"artist": "Artist", "title": "Song", "album": "Album"}, dry_run=False,
+                                   existing_metadata=metadata, tags=tags)
+    monkeypatch.undo()
+    assert filehandler.get_existing_metadata(path) == {"artist": "Artist", "title": "Song", "album": "Album"}
+
+
+def test_update_tags_adds_a_header_to_an_untagged_file(make_file, monkeypatch):
+    path = make_file("song.mp3", mpeg_frames(20))
+    metadata, tags = filehandler.read_tags(path)
+    monkeypatch.setattr(filehandler, "EasyID3", never_parse)
+    assert filehandler.update_tags(path, {"artist": "Artist", "title": "Song"}, dry_run=False, existing_metadata=metadata, tags=tags)
+    monkeypatch.undo()
+    assert filehandler.get_existing_metadata(path) == {"artist": "Artist", "title": "Song"}
+
+
+def test_update_tags_leaves_matching_tags_alone(make_file):
+    path = tagged_file(make_file, artist="Artist", title="Song", album="Album", tracknumber="1")
+    metadata, tags = filehandler.read_tags(path)
+    before = open(path, 'rb').read()
+    assert not filehandler.update_tags(path, {"artist": "Artist", "title": "Song", "album": "Album", "tracknumber": "01"},
+                                       dry_run=False, existing_metadata=metadata, tags=tags)
+    assert open(path, 'rb').read() == before
+
+
+def test_update_tags_without_a_tag_object_reads_the_file(make_file):
+    path = tagged_file(make_file, artist="Artist", title="song")
+    assert filehandler.update_tags(path, {"artist": "Artist", "title": "Song"}, dry_run=False)
+    assert filehandler.get_existing_metadata(path)["title"] == "Song"
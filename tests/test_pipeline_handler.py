@@ -0,0 +1,42 @@
+import time
+
+import handlers.pipeline_handler as pipelinehandler
+import handlers.metadata_handler as metadatahandler
+import handlers.llm_handler as llmhandler
+
+
+def test_window_stage_passes_every_record_on_in_order():
+    seen = []
+    records = [pipelinehandler.TrackRecord(f"/music/{i}.mp3") for i in range(5)]
+    passed = list(pipelinehandler.window_stage(iter(records), 2, lambda window: seen.append(len(window))))
+    assert passed == records
+    assert seen == [2, 2, 1]
+
+
+def test_staged_window_doesnt_use_up_the_lookup_budget(monkeypatch):
+    """Files wait at the barrier while the rest of their window is fingerprinted; that wait isn't charged to them."""
+    looked_up = []
+
+    def fingerprint(filepath, deadline=None, hints=None):
+        time.sleep(0.02)
+        return None
+
+    def musicbrainz(artist, title, album=None, deadline=None, tracknumber=None, duration=None):
+        deadline.check("MusicBrainz")
+        looked_up.append(title)
+        return {"artist": artist, "title": title, "album": "Album"}
+
+    monkeypatch.setattr(metadatahandler, "identify_song_fingerprint", fingerprint)
+    monkeypatch.setattr(metadatahandler, "get_musicbrainz_details", musicbrainz)
+    monkeypatch.setattr(llmhandler, "parse_filename_locally",
+                        lambda name, known_artists=None: {"artist": "Artist", "title": name, "confidence": 1.0})
+    monkeypatch.setattr(pipelinehandler, "record_duration", lambda record: None)
+
+    records = [pipelinehandler.TrackRecord(f"/music/Song {i}.mp3") for i in range(20)]
+    # the window takes 20 * 0.02s to fingerprint, longer than the whole budget
+    records = pipelinehandler.window_stage(pipelinehandler.fingerprint_stage(records, workers=1, file_budget=0.2), 20)
+    records = list(pipelinehandler.lookup_stage(records, llm_enabled=False, file_budget=0.2))
+
+    assert [record.deferred for record in records] == [False] * 20
+    assert len(looked_up) == 20
+    assert all(record.resolved for record in records)
@@ -0,0 +1,132 @@
+import handlers.queue_handler as queuehandler
+
+
+def make_queue(tmp_path, node_id, node_index=0, node_count=1, **kwargs):
+    return queuehandler.WorkQueue(str(tmp_path / "queue.db"), node_index=node_index, node_count=node_count, node_id=node_id, **kwargs)
+
+
+def shard_paths(node_count):
+    """One path per shard."""
+    paths = {}
+    i = 0
+    while len(paths) < node_count:
+        path = f"/music/{i}.mp3"
+        paths.setdefault(queuehandler.shard_of(path, node_count), path)
+        i += 1
+    return [paths[shard] for shard in range(node_count)]
+
+
+def expire_leases(queue):
+    with queue.lock:
+        queue.connection.execute("UPDATE work_items SET lease_expires = 0 WHERE status = 'leased'")
+
+
+def test_claim_prefers_own_shard(tmp_path):
+    shard_0, shard_1 = shard_paths(2)
+    queue = make_queue(tmp_path, "node-1", node_index=1, node_count=2)
+    assert queue.enqueue([shard_0, shard_1]) == 2
+    assert queue.claim(1) == [(shard_1, None)]
+    assert queue.claim(5) == [(shard_0, None)] # then anyone else's
+    assert queue.claim(5) == []
+
+
+def test_claim_returns_duplicates(tmp_path):
+    queue = make_queue(tmp_path, "node")
+    queue.enqueue(["/music/a.mp3"], {"/music/a.mp3": ["/music/b.mp3"]})
+    assert queue.claim(1) == [("/music/a.mp3", ["/music/b.mp3"])]
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    first = make_queue(tmp_path, "first")
+    second = make_queue(tmp_path, "second")
+    first.enqueue(["/music/a.mp3"])
+    assert first.claim(1)
+    assert second.claim(1) == [] # still leased
+    expire_leases(first)
+    assert second.claim(1) == [("/music/a.mp3", None)]
+
+    assert first.complete("/music/a.mp3", queuehandler.DONE, {"title": "Lost"}) == [] # lease lost, ignored
+    second.complete("/music/a.mp3", queuehandler.DONE, {"title": "Kept"})
+    assert first.status_counts() == {queuehandler.DONE: 1}
+
+
+def test_renewed_lease_is_not_reclaimed(tmp_path):
+    first = make_queue(tmp_path, "first", lease_seconds=60)
+    second = make_queue(tmp_path, "second")
+    first.enqueue(["/music/a.mp3"])
+    first.claim(1)
+    expire_leases(first)
+    assert first.renew_leases() == 1
+    assert second.claim(1) == []
+
+
+def test_lease_expiring_max_attempts_times_fails(tmp_path):
+    queue = make_queue(tmp_path, "node", max_attempts=2)
+    queue.enqueue(["/music/a.mp3"])
+    for _ in range(2):
+        assert queue.claim(1)
+        expire_leases(queue)
+    assert queue.claim(1) == []
+    assert queue.status_counts() == {queuehandler.FAILED: 1}
+    assert queue.enqueue(["/music/a.mp3"]) == 0 # a rerun doesn't retry it
+
+
+def test_deferred_item_is_reopened_by_enqueue(tmp_path):
+    queue = make_queue(tmp_path, "node")
+    queue.enqueue(["/music/a.mp3"])
+    queue.claim(1)
+    queue.complete("/music/a.mp3", queuehandler.DEFERRED)
+    assert queue.claim(1) == []
+    assert queue.enqueue(["/music/a.mp3"]) == 1
+
+
+def test_duplicate_waits_for_its_owner(tmp_path):
+    owner_node = make_queue(tmp_path, "owner")
+    other_node = make_queue(tmp_path, "other")
+    owner_node.enqueue(["/music/a.mp3", "/music/b.mp3"], {"/music/b.mp3": ["/music/b2.mp3"]})
+    owner_node.claim(1)
+    other_node.claim(1)
+    assert owner_node.register_payload("/music/a.mp3", "digest") is None
+    assert other_node.register_payload("/music/b.mp3", "digest") == ("/music/a.mp3", queuehandler.LEASED, {})
+    assert owner_node.complete("/music/a.mp3", queuehandler.DONE, {"title": "Song"}) == ["/music/b.mp3", "/music/b2.mp3"]
+    assert owner_node.status_counts() == {queuehandler.DONE: 2}
+
+
+def test_duplicate_of_a_done_item_reuses_its_result(tmp_path):
+    queue = make_queue(tmp_path, "node")
+    queue.enqueue(["/music/a.mp3", "/music/b.mp3"])
+    queue.claim(1)
+    queue.register_payload("/music/a.mp3", "digest")
+    queue.complete("/music/a.mp3", queuehandler.DONE, {"title": "Song"})
+    queue.claim(1)
+    assert queue.register_payload("/music/b.mp3", "digest") == ("/music/a.mp3", queuehandler.DONE, {"title": "Song"})
+    assert queue.status_counts() == {queuehandler.DONE: 2}
+
+
+def test_duplicates_of_a_failed_item_are_reopened(tmp_path):
+    queue = make_queue(tmp_path, "node", max_attempts=1)
+    queue.enqueue(["/music/a.mp3", "/music/b.mp3"])
+    queue.claim(2)
+    queue.register_payload("/music/a.mp3", "digest")
+    queue.register_payload("/music/b.mp3", "digest")
+    expire_leases(queue)
+    assert queue.claim(5) == [("/music/b.mp3", None)]
+    assert queue.status_counts() == {queuehandler.FAILED: 1, queuehandler.LEASED: 1}
+
+
+def test_nodes_may_mount_the_library_in_different_places(tmp_path):
+    first = make_queue(tmp_path, "first", node_count=2, library_root="/mnt/music")
+    second = make_queue(tmp_path, "second", node_index=1, node_count=2, library_root="/srv/library")
+    first.enqueue(["/mnt/music/a/x.mp3"], {"/mnt/music/a/x.mp3": ["/mnt/music/b/x.mp3"]})
+    assert second.enqueue(["/srv/library/a/x.mp3"]) == 1 # the same file, not a second item
+    assert queuehandler.queue_key("/mnt/music/a/x.mp3", "/mnt/music") == queuehandler.queue_key("/srv/library/a/x.mp3", "/srv/library")
+
+    assert second.claim(1) == [("/srv/library/a/x.mp3", ["/srv/library/b/x.mp3"])]
+    assert second.register_payload("/srv/library/a/x.mp3", "digest") is None
+    second.complete("/srv/library/a/x.mp3", queuehandler.DONE, {"new_filepath": "/srv/library/Artist/x.mp3"})
+
+    # results are resolved against the reading node's root too
+    first.enqueue(["/mnt/music/c/x.mp3"])
+    assert first.claim(1) == [("/mnt/music/c/x.mp3", None)]
+    assert first.register_payload("/mnt/music/c/x.mp3", "digest") == (
+        "/mnt/music/a/x.mp3", queuehandler.DONE, {"new_filepath": "/mnt/music/Artist/x.mp3"})
@@ -0,0 +1,71 @@
+import handlers.ranking_handler as rankinghandler
+
+
+def candidate(**fields):
+    base = {"artist": "Artist", "title": "Song", "album": "Album", "tracknumber": None, "year": None,
+            "duration": 200, "source_score": 0.9, "status": "official", "primary_type": "album", "secondary_types": ()}
+    base.update(fields)
+    return base
+
+
+def test_no_candidates():
+    assert rankinghandler.rank_candidates([]) == []
+    assert rankinghandler.best_candidate([]) == (None, None)
+
+
+def test_duration_match_wins():
+    close, far = candidate(album="Close", duration=201), candidate(album="Far", duration=260)
+    assert rankinghandler.best_candidate([far, close], {"duration": 200})[0] is close
+
+
+def test_official_album_beats_compilation_and_live():
+    compilation = candidate(album="Greatest Hits", secondary_types=("Compilation",))
+    live = candidate(album="Live", secondary_types=("Live",))
+    bootleg = candidate(album="Bootleg", status="Bootleg")
+    album = candidate(album="Album")
+    assert rankinghandler.best_candidate([compilation, live, bootleg, album])[0] is album
+
+
+def test_tracknumber_match_counts():
+    other, same = candidate(album="Other", tracknumber="7"), candidate(album="Same", tracknumber="3/12")
+    assert rankinghandler.best_candidate([other, same], {"tracknumber": "03"})[0] is same
+
+
+def test_earliest_release_of_a_group_is_preferred():
+    reissue = candidate(release_group_id="g", year="2011")
+    original = candidate(release_group_id="g", year="1994")
+    assert rankinghandler.best_candidate([reissue, original])[0] is original
+
+
+def test_missing_hints_add_nothing():
+    with_hints = rankinghandler.rank_candidates([candidate()], {"title": None, "artist": "", "duration": None})
+    assert with_hints == rankinghandler.rank_candidates([candidate()])
+
+
+def test_ranked_best_first():
+    scores = [score for score, _ in rankinghandler.rank_candidates(
+        [candidate(source_score=0.2), candidate(source_score=0.9), candidate(source_score=0.5)])]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_acoustid_candidates_one_per_release():
+    response = {"status": "ok", "results": [{"score": 0.95, "recordings": [
+        {"id": "rec-1", "title": "Song", "duration": 200,
+         "artists": [{"name": "A", "joinphrase": " & "}, {"name": "B"}],
+         "releasegroups": [{"id": "group-1", "type": "Album", "secondarytypes": ["Compilation"], "title": "Hits",
+                            "releases": [{"id": "rel-1", "title": "Hits", "date": {"year": 2001},
+                                          "mediums": [{"tracks": [{"position": 4}]}]}]}]},
+        {"id": "rec-2", "title": "Song (Live)"},
+        {"id": "rec-3"},
+    ]}]}
+    first, second = rankinghandler.acoustid_candidates(response)
+    assert first["artist"] == "A & B"
+    assert (first["album"], first["tracknumber"], first["year"]) == ("Hits", "4", "2001")
+    assert (first["primary_type"], first["secondary_types"], first["release_group_id"]) == ("Album", ("Compilation",), "group-1")
+    assert first["source_score"] == 0.95
+    assert second["title"] == "Song (Live)" and second["album"] is None
+
+
+def test_acoustid_candidates_of_an_error_answer():
+    assert rankinghandler.acoustid_candidates(None) == []
+    assert rankinghandler.acoustid_candidates({"status": "error"}) == []
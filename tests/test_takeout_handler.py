@@ -0,0 +1,44 @@
+import csv
+
+import handlers.takeout_handler as takeouthandler
+
+
+def write_csv(path, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def test_normalize_key():
+    assert takeouthandler.normalize_key("Rock &amp; Roll (1)") == takeouthandler.normalize_key("rock_roll") == "rock roll"
+
+
+def test_load_and_lookup(tmp_path):
+    write_csv(tmp_path / "Tracks" / "Song.csv", [{"Title": "Song", "Album": "Album", "Artist": "Artist &amp; Co", "Removed": ""}])
+    write_csv(tmp_path / "Tracks" / "Gone.csv", [{"Title": "Gone", "Album": "Album", "Artist": "Artist", "Removed": "true"}])
+    index = takeouthandler.TakeoutIndex().load(str(tmp_path))
+    assert len(index) == 1
+    assert index.lookup("/music/03 - Song (1).mp3") == {"artist": "Artist & Co", "title": "Song", "album": "Album", "source_comment": "Google Takeout"}
+    assert index.lookup("/music/Artist & Co - Song.mp3")["title"] == "Song"
+    assert index.lookup("/music/Gone.mp3") is None
+
+
+def test_ambiguous_name_without_a_duration_is_not_matched(tmp_path):
+    write_csv(tmp_path / "music library songs.csv", [
+        {"Song Title": "Intro", "Album Title": "First", "Artist Name 1": "A"},
+        {"Song Title": "Intro", "Album Title": "Second", "Artist Name 1": "B"},
+    ])
+    index = takeouthandler.TakeoutIndex().load(str(tmp_path))
+    assert index.lookup(str(tmp_path / "Intro.mp3")) is None
+
+
+def test_load_skips_the_organized_library_and_own_outputs(tmp_path):
+    write_csv(tmp_path / "Takeout" / "Song.csv", [{"Title": "Song", "Album": "Album", "Artist": "Artist"}])
+    write_csv(tmp_path / "organized" / "Artist" / "Album" / "notes.csv", [{"Title": "Other", "Artist": "Artist"}])
+    write_csv(tmp_path / "retry_queue.csv", [{"path": "/music/x.mp3", "reason": "deadline", "Title": "Retry", "Artist": "Artist"}])
+    index = takeouthandler.TakeoutIndex().load(str(tmp_path), skip_dirs=[str(tmp_path / "organized")],
+                                                skip_files=[str(tmp_path / "retry_queue.csv")])
+    assert len(index) == 1
+    assert index.lookup("/music/Song.mp3") is not None
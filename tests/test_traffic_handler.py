@@ -0,0 +1,242 @@
+import time
+import threading
+from email.utils import formatdate
+
+import pytest
+
+import handlers.traffic_handler as traffichandler
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def make_controller(max_retries=2, max_delay=0.05, failure_threshold=5, reset_seconds=60.0):
+    controller = traffichandler.ServiceController("test", rate=1000.0, burst=10, max_concurrency=2,
+                                                  max_retries=max_retries, base_delay=0.01, max_delay=max_delay)
+    controller.breaker.failure_threshold = failure_threshold
+    controller.breaker.reset_seconds = reset_seconds
+    return controller
+
+
+def failing(*errors, result="ok"):
+    """A call that raises the given errors in turn, then returns result."""
+    remaining = list(errors)
+    calls = []
+
+    def fn():
+        calls.append(time.monotonic())
+        if remaining:
+            raise remaining.pop(0)
+        return result
+    return fn, calls
+
+
+# --- settings ---
+
+def test_env_number_falls_back_on_bad_values(monkeypatch):
+    monkeypatch.setenv("TEST_LIMIT", "many")
+    assert traffichandler._env_number("TEST_LIMIT", 4) == 4
+    monkeypatch.setenv("TEST_LIMIT", "-1")
+    assert traffichandler._env_number("TEST_LIMIT", 4) == 4
+    monkeypatch.setenv("TEST_LIMIT", "2.5")
+    assert traffichandler._env_number("TEST_LIMIT", 4.0, float) == 2.5
+    monkeypatch.delenv("TEST_LIMIT")
+    assert traffichandler._env_number("TEST_LIMIT", 4) == 4
+
+
+# --- token bucket ---
+
+def test_token_bucket_hands_out_the_burst_then_refills():
+    bucket = traffichandler.TokenBucket(rate=20.0, burst=2)
+    start = time.monotonic()
+    assert bucket.acquire() and bucket.acquire()
+    assert time.monotonic() - start < 0.03
+    assert bucket.acquire()
+    assert time.monotonic() - start >= 0.04 # one token per 50 ms
+
+
+def test_token_bucket_pause():
+    bucket = traffichandler.TokenBucket(rate=1000.0, burst=5)
+    bucket.pause(0.1)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_acquire_gives_up_when_cancelled():
+    bucket = traffichandler.TokenBucket(rate=0.1, burst=1)
+    bucket.acquire()
+    cancel_event = threading.Event()
+    threading.Timer(0.05, cancel_event.set).start()
+    assert bucket.acquire(cancel_event) is False
+
+
+# --- error classification ---
+
+@pytest.mark.parametrize("error, retryable", [
+    (HTTPError(429), True),
+    (HTTPError(503), True),
+    (HTTPError(404), False),
+    (TimeoutError(), True),
+    (ConnectionResetError(), True),
+    (ValueError("bad request"), False),
+])
+def test_is_retryable(error, retryable):
+    assert traffichandler.is_retryable(error) is retryable
+
+
+def test_retry_after_seconds_and_http_date():
+    assert traffichandler.get_retry_after(HTTPError(429, {"Retry-After": "7"})) == 7.0
+    assert 25 <= traffichandler.get_retry_after(HTTPError(429, {"retry-after": formatdate(time.time() + 30, usegmt=True)})) <= 30
+    assert traffichandler.get_retry_after(HTTPError(429, {"Retry-After": "soon"})) is None
+    assert traffichandler.get_retry_after(HTTPError(429)) is None
+
+
+# --- retry/backoff ---
+
+def test_retryable_errors_are_retried():
+    fn, calls = failing(HTTPError(503), TimeoutError())
+    assert make_controller().call(fn) == "ok"
+    assert len(calls) == 3
+
+
+def test_other_errors_are_raised_as_is():
+    fn, calls = failing(ValueError("bad request"))
+    controller = make_controller(failure_threshold=1)
+    with pytest.raises(ValueError):
+        controller.call(fn)
+    assert len(calls) == 1
+    assert controller.breaker.state == "closed" # the service answered
+
+
+def test_exhausted_retries_raise_service_unavailable():
+    fn, calls = failing(*[HTTPError(503)] * 5)
+    with pytest.raises(traffichandler.ServiceUnavailableError):
+        make_controller(max_retries=2).call(fn)
+    assert len(calls) == 3
+
+
+def test_retry_after_is_honored():
+    fn, calls = failing(HTTPError(429, {"Retry-After": "0.1"}))
+    assert make_controller(max_delay=1.0).call(fn) == "ok"
+    assert calls[1] - calls[0] >= 0.09
+
+
+def test_retry_after_above_max_delay_defers_instead_of_waiting():
+    fn, calls = failing(HTTPError(429, {"Retry-After": "7200"}))
+    controller = make_controller(max_delay=0.2)
+    start = time.monotonic()
+    with pytest.raises(traffichandler.ServiceUnavailableError):
+        controller.call(fn)
+    assert len(calls) == 1
+    assert time.monotonic() - start < 0.1
+    assert controller.bucket.paused_until - time.monotonic() <= 0.2 # paused for max_delay, not two hours
+
+
+# --- circuit breaker ---
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = traffichandler.CircuitBreaker("test", failure_threshold=2, reset_seconds=60.0)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+
+def test_breaker_lets_one_trial_through_after_the_reset_time():
+    breaker = traffichandler.CircuitBreaker("test", failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    assert not breaker.allow_request() # only one trial at a time
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow_request()
+
+
+def test_failed_trial_opens_the_breaker_again():
+    breaker = traffichandler.CircuitBreaker("test", failure_threshold=3, reset_seconds=0.05)
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow_request()
+
+
+def test_open_breaker_fails_fast():
+    fn, calls = failing(*[HTTPError(503)] * 5)
+    controller = make_controller(max_retries=5, failure_threshold=2)
+    with pytest.raises(traffichandler.ServiceUnavailableError):
+        controller.call(fn)
+    assert len(calls) == 2
+    with pytest.raises(traffichandler.ServiceUnavailableError):
+        controller.call(fn)
+    assert len(calls) == 2
+
+
+# --- concurrency tuner ---
+
+def test_tuner_halves_the_limit_on_errors_and_raises_it_when_healthy():
+    tuner = traffichandler.ConcurrencyTuner("test", max_concurrency=8, window=4)
+    for ok in (False, False, True, True):
+        tuner.acquire()
+        tuner.release(0.1, ok=ok)
+    assert tuner.limit == 4
+    for _ in range(4):
+        tuner.acquire()
+        tuner.release(0.1)
+    assert tuner.limit == 5
+
+
+def test_tuner_halves_the_limit_when_latency_grows():
+    tuner = traffichandler.ConcurrencyTuner("test", max_concurrency=8, window=2)
+    for latency in (0.1, 0.1, 1.0, 1.0):
+        tuner.acquire()
+        tuner.release(latency)
+    assert tuner.limit == 4
+
+
+def test_release_without_latency_records_no_sample():
+    tuner = traffichandler.ConcurrencyTuner("test", max_concurrency=2, window=1)
+    tuner.acquire()
+    tuner.release()
+    assert tuner.samples == [] and tuner.baseline_latency is None and tuner.in_flight == 0
+
+
+def test_tuner_acquire_gives_up_when_cancelled():
+    tuner = traffichandler.ConcurrencyTuner("test", max_concurrency=1)
+    tuner.acquire()
+    assert tuner.saturated()
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert tuner.acquire(cancel_event) is False
+    assert tuner.in_flight == 1
+
+
+def test_cancelled_trial_frees_the_half_open_breaker():
+    controller = make_controller(max_retries=0, failure_threshold=1, reset_seconds=0.05)
+    with pytest.raises(traffichandler.ServiceUnavailableError):
+        controller.call(failing(HTTPError(503))[0])
+    time.sleep(0.06)
+
+    # every slot is taken, so the trial call waits for one and is cancelled before it is sent
+    controller.tuner.acquire()
+    controller.tuner.acquire()
+    cancel_event = threading.Event()
+    cancel_event.set()
+    with pytest.raises(traffichandler.RequestCancelled):
+        controller.call(lambda: "never sent", cancel_event=cancel_event)
+    controller.tuner.release()
+    controller.tuner.release()
+
+    assert controller.breaker.state == "half_open" and not controller.breaker.trial_in_flight
+    assert controller.call(lambda: "ok") == "ok"
+    assert controller.breaker.state == "closed"
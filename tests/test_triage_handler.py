@@ -0,0 +1,65 @@
+import handlers.triage_handler as triagehandler
+
+from conftest import FRAME_HEADER, FRAME_LENGTH, id3v2_tag, mpeg_frames
+
+
+def test_parse_frame_header():
+    frame_length, samples_per_frame, sample_rate, bitrate, is_mpeg1, is_mono = triagehandler.parse_frame_header(FRAME_HEADER)
+    assert (frame_length, samples_per_frame, sample_rate, bitrate, is_mpeg1, is_mono) == (FRAME_LENGTH, 1152, 44100, 128, True, False)
+
+
+def test_parse_frame_header_rejects_invalid_fields():
+    assert triagehandler.parse_frame_header(b'\x00\x00\x00\x00') is None
+    assert triagehandler.parse_frame_header(b'\xff\xfb\xf0\x00') is None # bitrate index 15
+    assert triagehandler.parse_frame_header(b'\xff\xfb\x9c\x00') is None # sample rate index 3
+    assert triagehandler.parse_frame_header(b'\xff\xfb') is None
+
+
+def test_playable_file_passes(make_file):
+    assert triagehandler.triage_file(make_file("ok.mp3", id3v2_tag(), mpeg_frames(100))) == (None, None)
+
+
+def test_empty_payload(make_file):
+    assert triagehandler.triage_file(make_file("empty.mp3", id3v2_tag()))[0] == triagehandler.EMPTY
+
+
+def test_no_sync(make_file):
+    assert triagehandler.triage_file(make_file("junk.mp3", b'\x12' * 50000))[0] == triagehandler.NO_SYNC
+
+
+def test_bad_frame_chain(make_file):
+    broken = FRAME_HEADER + b'\x55' * (FRAME_LENGTH - 4) + b'\x12' * 20000
+    assert triagehandler.triage_file(make_file("broken.mp3", broken))[0] == triagehandler.BAD_FRAME_CHAIN
+
+
+def test_truncated_by_xing_byte_count(make_file):
+    audio = mpeg_frames(100, xing=(1000, 1000 * FRAME_LENGTH))
+    assert triagehandler.triage_file(make_file("truncated.mp3", audio))[0] == triagehandler.TRUNCATED
+
+
+def test_too_short(make_file):
+    assert triagehandler.triage_file(make_file("short.mp3", mpeg_frames(10)))[0] == triagehandler.TOO_SHORT
+
+
+def test_zero_filled_tail(make_file):
+    audio = mpeg_frames(60) + b'\x00' * (triagehandler.TAIL_CHECK_BYTES + 100)
+    assert triagehandler.triage_file(make_file("zeros.mp3", audio))[0] == triagehandler.ZERO_FILLED
+
+
+def test_unreadable(tmp_path):
+    assert triagehandler.triage_file(str(tmp_path / "missing.mp3"))[0] == triagehandler.UNREADABLE
+
+
+def test_quarantine_list_has_each_file_once(tmp_path):
+    list_path = tmp_path / "quarantine.csv"
+    list_path.write_text("path,reason\n/music/old.mp3,no_sync\n", encoding='utf-8')
+    triagehandler.record_quarantine(str(list_path), "/music/old.mp3", triagehandler.NO_SYNC)
+    triagehandler.record_quarantine(str(list_path), "/music/new.mp3", triagehandler.TRUNCATED)
+    triagehandler.record_quarantine(str(list_path), "/music/new.mp3", triagehandler.TRUNCATED)
+    assert list_path.read_text(encoding='utf-8').splitlines() == ["path,reason", "/music/old.mp3,no_sync", "/music/new.mp3,truncated"]
+
+
+def test_quarantine_list_is_created_with_a_header(tmp_path):
+    list_path = tmp_path / "quarantine.csv"
+    triagehandler.record_quarantine(str(list_path), "/music/a.mp3", triagehandler.EMPTY)
+    assert list_path.read_text(encoding='utf-8').splitlines() == ["path,reason", "/music/a.mp3,empty"]